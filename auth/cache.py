@@ -0,0 +1,77 @@
+"""Short-lived cache of login results, keyed by a salted hash of the credentials"""
+
+import hashlib
+import hmac
+import os
+import time
+from collections import namedtuple
+
+from base.budget import budget
+from base.cache import LRUCache
+
+# Result of a login flow, `world_ip`, `api_token`, `api_starttime` and `flash` are None after get_osapi
+AuthResult = namedtuple('AuthResult', ['osapi_url', 'world_ip', 'api_token', 'api_starttime', 'flash', 'expires'])
+
+# Approximate memory held by one entry with its key, in bytes
+ENTRY_SIZE = 1024
+
+
+class AuthCache:
+    """This class keeps login results for a few seconds, passwords are never stored"""
+
+    def __init__(self, ttl, max_entries, salt=None):
+        """ Init an empty cache, the salt is random unless given
+
+        :param ttl: int
+        :param max_entries: int
+        :param salt: bytes
+        :return: none
+        """
+        self.ttl = ttl
+        self.salt = salt or os.urandom(32)
+        self.entries = LRUCache(0, sizeof=lambda result: ENTRY_SIZE, max_entries=max_entries,
+                                expired=lambda result: result.expires < time.time(),
+                                name='auth', cost=60, budget=budget)
+
+    def key(self, login_id, password):
+        """ Derive the cache key of a pair of credentials
+
+        :param login_id: str
+        :param password: str
+        :return: str
+        """
+        message = login_id.encode() + b'\0' + password.encode()
+        return hmac.new(self.salt, message, hashlib.sha256).hexdigest()
+
+    def get(self, key):
+        """ Return the cached result of `key` unless it has expired
+
+        :param key: str
+        :return: AuthResult or None
+        """
+        return self.entries.get(key)
+
+    def set(self, key, kancolle):
+        """ Cache the result of a finished login
+
+        :param key: str
+        :param kancolle: auth.kancolle.KancolleAuth
+        :return: AuthResult
+        """
+        result = AuthResult(osapi_url=kancolle.osapi_url,
+                            world_ip=kancolle.world_ip,
+                            api_token=kancolle.api_token,
+                            api_starttime=kancolle.api_starttime,
+                            flash=kancolle.flash,
+                            expires=time.time() + self.ttl)
+        if self.ttl > 0:
+            self.entries.set(key, result)
+        return result
+
+    def discard(self, key):
+        """ Drop the cached result of `key`
+
+        :param key: str
+        :return: none
+        """
+        self.entries.discard(key)
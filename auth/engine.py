@@ -0,0 +1,172 @@
+"""Login engine running KancolleAuth flows over a shared connection pool"""
+
+import aiohttp
+import asyncio
+
+from base import config
+from base.cache import SingleFlight
+from auth.cache import AuthCache
+from auth.exceptions import OOIAuthException
+from auth.kancolle import KancolleAuth
+from auth.tokens import TokenPool
+
+
+class LoginEngine:
+    """This class runs dmm.com logins with a shared connection pool, a cookie jar per login and bounded concurrency"""
+
+    def __init__(self, concurrency=None, queue_size=None, loop=None):
+        """ Init the login engine, at most `concurrency` logins run at once and `queue_size` more may wait
+
+        :param concurrency: int
+        :param queue_size: int
+        :param loop: asyncio.AbstractEventLoop
+        :return: none
+        """
+        self.concurrency = concurrency or config.login_concurrency
+        self.queue_size = config.login_queue_size if queue_size is None else queue_size
+        self.loop = loop
+        self.semaphore = asyncio.Semaphore(self.concurrency, loop=loop)
+        self.connector = None
+
+        # Recent login results, concurrent logins of the same account share one flow
+        self.cache = AuthCache(config.auth_cache_ttl, config.auth_cache_size)
+        self.flights = SingleFlight(loop=loop)
+
+        # Login page tokens fetched ahead of time
+        self.tokens = TokenPool(self._connector, config.login_token_pool, config.login_token_ttl, loop=loop)
+
+        # Queue depth and number of running logins
+        self.waiting = 0
+        self.running = 0
+
+    def _connector(self):
+        """ Return the connector shared by all logins, keep-alive connections to dmm.com are reused
+
+        :return: aiohttp.TCPConnector
+        """
+        if self.connector is None or self.connector.closed:
+            if config.proxy:
+                self.connector = aiohttp.ProxyConnector(proxy=config.proxy, force_close=False,
+                                                        limit=config.login_pool_limit, loop=self.loop)
+            else:
+                self.connector = aiohttp.TCPConnector(limit=config.login_pool_limit, loop=self.loop)
+        return self.connector
+
+    def status(self):
+        """ Report the login queue and the token pool
+
+        :return: dict
+        """
+        return {'concurrency': self.concurrency,
+                'running': self.running,
+                'waiting': self.waiting,
+                'tokens': self.tokens.status()}
+
+    def start(self):
+        """ Start background work, i.e. filling the token pool
+
+        :return: none
+        """
+        self.tokens.start()
+
+    @asyncio.coroutine
+    def _run(self, login_id, password, flow, osapi_url=None):
+        """ Run a login flow once a slot is free
+        The client session only lives for this login, so its cookies are never shared
+
+        :param login_id: str
+        :param password: str
+        :param flow: coroutine function
+        :param osapi_url: str
+        :return: auth.kancolle.KancolleAuth
+        """
+        if self.waiting >= self.queue_size:
+            raise OOIAuthException('Error: Too many logins in progress, please retry later')
+        self.waiting += 1
+        try:
+            yield from self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        token = self.tokens.take() if osapi_url is None else None
+        session = aiohttp.ClientSession(connector=self._connector(), loop=self.loop,
+                                        cookies=token.cookies if token is not None else None)
+        kancolle = KancolleAuth(login_id, password, session=session)
+        kancolle.osapi_url = osapi_url
+        if token is not None:
+            kancolle.dmm_token = token.dmm_token
+            kancolle.token = token.token
+        try:
+            yield from flow(kancolle)
+        finally:
+            kancolle.close()
+            self.running -= 1
+            self.semaphore.release()
+        return kancolle
+
+    @asyncio.coroutine
+    def _login(self, key, login_id, password, flow, osapi_url):
+        """ Run a login flow and cache its result, a failed login drops what was cached for the account
+        A flash login resuming from a cached osapi URL starts over once if that URL no longer works
+
+        :param key: str
+        :param login_id: str
+        :param password: str
+        :param flow: coroutine function
+        :param osapi_url: str
+        :return: auth.cache.AuthResult
+        """
+        try:
+            try:
+                kancolle = yield from self._run(login_id, password, flow, osapi_url)
+            except OOIAuthException:
+                if osapi_url is None:
+                    raise
+                kancolle = yield from self._run(login_id, password, flow)
+        except OOIAuthException:
+            self.cache.discard(key)
+            raise
+        return self.cache.set(key, kancolle)
+
+    @asyncio.coroutine
+    def get_osapi(self, login_id, password):
+        """ Log in and fetch the osapi URL
+
+        :param login_id: str
+        :param password: str
+        :return: auth.cache.AuthResult
+        """
+        key = self.cache.key(login_id, password)
+        result = self.cache.get(key)
+        if result is None:
+            result, _ = yield from self.flights.do(('osapi', key), self._login, key, login_id, password,
+                                                   KancolleAuth.get_osapi, None)
+        return result
+
+    @asyncio.coroutine
+    def get_flash(self, login_id, password):
+        """ Log in and fetch the world, API token and flash URL
+        An osapi URL cached by a recent get_osapi() of the same account is reused
+
+        :param login_id: str
+        :param password: str
+        :return: auth.cache.AuthResult
+        """
+        key = self.cache.key(login_id, password)
+        result = self.cache.get(key)
+        if result is None or result.flash is None:
+            osapi_url = result.osapi_url if result is not None else None
+            result, _ = yield from self.flights.do(('flash', key), self._login, key, login_id, password,
+                                                   KancolleAuth.get_flash, osapi_url)
+        return result
+
+    def close(self):
+        """ Stop the token pool and close all pooled connections
+
+        :return: none
+        """
+        self.tokens.close()
+        if self.connector is not None:
+            self.connector.close()
+            self.connector = None
@@ -9,6 +9,7 @@ from urllib.parse import urlparse, parse_qs
 
 from base import config
 from auth.exceptions import OOIAuthException
+from auth.scanner import scan
 
 
 class KancolleAuth:
@@ -32,7 +33,7 @@ class KancolleAuth:
         "125.6.187.205",
         "125.6.187.229",
         "203.104.209.134",
-+       "203.104.209.167",
+        "203.104.209.167",
         "203.104.248.135",
         "125.6.189.7",
         "125.6.189.39",
@@ -51,18 +52,20 @@ class KancolleAuth:
     # Define user-agent, default is IE11.0 on Windows 7 x64
     user_agent = 'Mozilla/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko'
 
-    # RegEx patterns for parsing auth messages
+    # RegEx patterns for parsing auth messages, dmm.com pages are scanned as they arrive and only up to the matches
     patterns = {'dmm_token': re.compile(r'"DMM_TOKEN", "([\d|\w]+)"'),
                 'token': re.compile(r'"token": "([\d|\w]+)"'),
                 'reset': re.compile(r'認証エラー'),
                 'osapi': re.compile(r'URL\W+:\W+"(.*)",')}
 
-    def __init__(self, login_id, password):
+    def __init__(self, login_id, password, session=None):
         """ Define auth function __init__() with `login_id`和`password`
         'login_id' can be the email address used for registration or the unique dmm.com account ID
+        'session' is normally given by the login engine, a private session is opened without it
 
         :param login_id: str
         :param password: str
+        :param session: aiohttp.ClientSession
         :return: none
         """
 
@@ -71,11 +74,14 @@ class KancolleAuth:
         self.password = password
 
         # Init aiohttp session, use proxy if configured
-        if config.proxy:
-            self.connector = aiohttp.ProxyConnector(proxy=config.proxy, force_close=False)
-        else:
-            self.connector = None
-        self.session = aiohttp.ClientSession(connector=self.connector)
+        self.own_session = session is None
+        if self.own_session:
+            if config.proxy:
+                connector = aiohttp.ProxyConnector(proxy=config.proxy, force_close=False)
+            else:
+                connector = None
+            session = aiohttp.ClientSession(connector=connector)
+        self.session = session
         self.headers = {'User-Agent': self.user_agent}
 
         # Re-init all variables for auth
@@ -91,12 +97,15 @@ class KancolleAuth:
         self.api_starttime = None
         self.flash = None
 
-    def __del__(self):
-        """Define function to close this session
+    def close(self):
+        """Define function to close this session, a session given by the login engine keeps its connections pooled
 
         :return: none
         """
-        self.session.close()
+        if self.own_session:
+            self.session.close()
+        else:
+            self.session.detach()
 
     @asyncio.coroutine
     def _request(self, url, method='GET', data=None, timeout_message='Connection timed out', timeout=10):
@@ -124,15 +133,15 @@ class KancolleAuth:
         """
         response = yield from self._request(self.urls['login'], method='GET', data=None,
                                             timeout_message='Error: Cannot connect to dmm.com')
-        html = yield from response.text()
+        matches = yield from scan(response, {name: self.patterns[name] for name in ('dmm_token', 'token')})
 
-        m = self.patterns['dmm_token'].search(html)
+        m = matches.get('dmm_token')
         if m:
             self.dmm_token = m.group(1)
         else:
             raise OOIAuthException('Error: Failed to query dmm_token')
 
-        m = self.patterns['token'].search(html)
+        m = matches.get('token')
         if m:
             self.token = m.group(1)
         else:
@@ -175,15 +184,14 @@ class KancolleAuth:
                 self.pwdKey: self.password}
         response = yield from self._request(self.urls['auth'], method='POST', data=data,
                                        timeout_message='Error: Authentication Timed Out')
-        html = yield from response.text()
-        m = self.patterns['reset'].search(html)
-        if m:
+        matches = yield from scan(response, {'reset': self.patterns['reset']})
+        if 'reset' in matches:
             raise OOIAuthException('Error: Password Reset Prompt Detected - Please visit dmm.com to reset your password')
 
         response = yield from self._request(self.urls['game'],
                                        timeout_message='Error: Connection Timed Out')
-        html = yield from response.text()
-        m = self.patterns['osapi'].search(html)
+        matches = yield from scan(response, {'osapi': self.patterns['osapi']})
+        m = matches.get('osapi')
         if m:
             self.osapi_url = m.group(1)
         else:
@@ -248,22 +256,24 @@ class KancolleAuth:
 
     @asyncio.coroutine
     def get_osapi(self):
-        """Fetch osapi URL and return
+        """Fetch osapi URL and return, the login page is skipped if dmm_token and token were handed in
 
         :return: str
         """
-        yield from self._get_dmm_tokens()
+        if self.dmm_token is None or self.token is None:
+            yield from self._get_dmm_tokens()
         yield from self._get_ajax_token()
         yield from self._get_osapi_url()
         return self.osapi_url
 
     @asyncio.coroutine
     def get_flash(self):
-        """Fetch flash URL and return
+        """Fetch flash URL and return, the dmm.com login is skipped if osapi_url is already known
 
         :return: str
         """
-        yield from self.get_osapi()
+        if self.osapi_url is None:
+            yield from self.get_osapi()
         yield from self._get_world()
         yield from self._get_api_token()
         return self.flash
@@ -0,0 +1,110 @@
+"""Incremental search of regex patterns in HTTP response bodies, reading stops once every pattern matched"""
+
+import asyncio
+import codecs
+import re
+
+import aiohttp
+
+
+class StreamScanner:
+    """This class searches patterns in text fed chunk by chunk
+    Text is searched one batch of complete lines at a time, so a greedy pattern bounded by the end of a line
+    matches as it would in the whole text. The last `overlap` characters already searched are searched again
+    with the next batch, so a match straddling two batches is still found."""
+
+    charset_pattern = re.compile(r'charset=["\']?([\w.:-]+)', re.I)
+
+    def __init__(self, patterns, encoding='utf-8', overlap=256, max_line=65536):
+        """ Init the scanner
+
+        :param patterns: dict name => compiled pattern
+        :param encoding: str
+        :param overlap: int characters searched again with the next batch
+        :param max_line: int characters searched even though no end of line was seen
+        :return: none
+        """
+        self.patterns = dict(patterns)
+        self.matches = {}
+        self.overlap = overlap
+        self.max_line = max_line
+        try:
+            self.decoder = codecs.getincrementaldecoder(encoding)('replace')
+        except LookupError:
+            self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.pending = ''
+        self.carry = ''
+
+    @property
+    def done(self):
+        return not self.patterns
+
+    def feed(self, data, final=False):
+        """ Search the complete lines received so far, everything left is searched when `final` is set
+
+        :param data: bytes
+        :param final: bool
+        :return: bool whether every pattern matched
+        """
+        self.pending += self.decoder.decode(data, final)
+        if final or len(self.pending) >= self.max_line:
+            end = len(self.pending)
+        else:
+            end = self.pending.rfind('\n') + 1
+        if end == 0:
+            return self.done
+
+        window = self.carry + self.pending[:end]
+        self.pending = self.pending[end:]
+        for name, pattern in list(self.patterns.items()):
+            m = pattern.search(window)
+            if m:
+                self.matches[name] = m
+                del self.patterns[name]
+        self.carry = window[-self.overlap:]
+        return self.done
+
+    @classmethod
+    def encoding(cls, response):
+        """ Charset of a response as declared in its headers, utf-8 otherwise
+
+        :param response: aiohttp.ClientResponse
+        :return: str
+        """
+        m = cls.charset_pattern.search(response.headers.get(aiohttp.hdrs.CONTENT_TYPE, ''))
+        return m.group(1) if m else 'utf-8'
+
+
+@asyncio.coroutine
+def scan(response, patterns, chunk_size=8192, drain_limit=32768):
+    """ Read a response until every pattern matched or the body ended, then let go of the connection
+    A short unread remainder is drained so the keep-alive connection goes back to the pool,
+    a long one is not worth the transfer and the connection is closed instead
+
+    :param response: aiohttp.ClientResponse
+    :param patterns: dict name => compiled pattern
+    :param chunk_size: int
+    :param drain_limit: int bytes read past the last match to keep the connection
+    :return: dict name => match object, patterns without a match are left out
+    """
+    scanner = StreamScanner(patterns, StreamScanner.encoding(response))
+    received = 0
+    try:
+        while True:
+            chunk = yield from response.content.read(chunk_size)
+            received += len(chunk)
+            if scanner.feed(chunk, final=not chunk) or not chunk:
+                break
+    except Exception:
+        response.close()
+        raise
+
+    # The length of a compressed body cannot be compared with the decoded bytes received
+    length = None
+    if aiohttp.hdrs.CONTENT_ENCODING not in response.headers:
+        length = response.headers.get(aiohttp.hdrs.CONTENT_LENGTH)
+    if response.content.at_eof() or (length is not None and int(length) - received <= drain_limit):
+        yield from response.release()
+    else:
+        response.close()
+    return scanner.matches
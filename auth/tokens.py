@@ -0,0 +1,142 @@
+"""Pool of pre-fetched dmm.com login page tokens"""
+
+import aiohttp
+import asyncio
+import http.cookies
+import time
+from collections import deque, namedtuple
+
+from auth.kancolle import KancolleAuth
+
+# Anonymous tokens of the dmm.com login page with the cookies they were issued with
+LoginToken = namedtuple('LoginToken', ['dmm_token', 'token', 'cookies', 'fetched'])
+
+
+class TokenPool:
+    """This class keeps a few fresh, unused login page tokens so logins can skip the first round trip"""
+
+    def __init__(self, connector, size, ttl, loop=None):
+        """ Init an empty pool, call start() to fill it in the background
+
+        :param connector: function returning the aiohttp connector to use
+        :param size: int
+        :param ttl: int
+        :param loop: asyncio.AbstractEventLoop
+        :return: none
+        """
+        self.connector = connector
+        self.size = size
+        self.ttl = ttl
+        self.loop = loop
+        self.tokens = deque()
+        self.wakeup = asyncio.Event(loop=loop)
+        self.task = None
+
+        # Pool statistics, `age` sums the age of every token handed out
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.fetched = 0
+        self.errors = 0
+        self.age = 0.0
+
+    def status(self):
+        """ Report pool statistics
+
+        :return: dict
+        """
+        return {'size': len(self.tokens),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'fetched': self.fetched,
+                'errors': self.errors,
+                'mean_age': self.age / self.hits if self.hits else 0.0}
+
+    def _expire(self):
+        """ Drop tokens older than `ttl`
+
+        :return: none
+        """
+        deadline = time.time() - self.ttl
+        while self.tokens and self.tokens[0].fetched < deadline:
+            self.tokens.popleft()
+            self.stale += 1
+
+    def take(self):
+        """ Hand out the freshest token, every token is used at most once
+
+        :return: LoginToken or None
+        """
+        self._expire()
+        if self.tokens:
+            token = self.tokens.pop()
+            self.hits += 1
+            self.age += time.time() - token.fetched
+        else:
+            token = None
+            self.misses += 1
+        self.wakeup.set()
+        return token
+
+    @asyncio.coroutine
+    def _fetch(self):
+        """ Load the login page anonymously and keep its tokens and cookies
+
+        :return: none
+        """
+        session = aiohttp.ClientSession(connector=self.connector(), loop=self.loop)
+        kancolle = KancolleAuth(None, None, session=session)
+        try:
+            yield from kancolle._get_dmm_tokens()
+            cookies = http.cookies.SimpleCookie()
+            cookies.update(session.cookies)
+        finally:
+            kancolle.close()
+        self.tokens.append(LoginToken(dmm_token=kancolle.dmm_token, token=kancolle.token,
+                                      cookies=cookies, fetched=time.time()))
+        self.fetched += 1
+
+    @asyncio.coroutine
+    def _fill(self):
+        """ Keep the pool full, refreshing tokens before they expire and backing off after errors
+
+        :return: none
+        """
+        backoff = 1
+        while True:
+            self._expire()
+            if len(self.tokens) < self.size:
+                try:
+                    yield from self._fetch()
+                    backoff = 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.errors += 1
+                    yield from asyncio.sleep(backoff, loop=self.loop)
+                    backoff = min(backoff * 2, 60)
+                continue
+            self.wakeup.clear()
+            timeout = self.tokens[0].fetched + self.ttl - time.time() if self.tokens else None
+            try:
+                yield from asyncio.wait_for(self.wakeup.wait(), timeout, loop=self.loop)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        """ Start filling the pool in the background
+
+        :return: none
+        """
+        if self.size > 0 and self.task is None:
+            self.task = asyncio.ensure_future(self._fill(), loop=self.loop)
+
+    def close(self):
+        """ Stop filling the pool
+
+        :return: none
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,157 @@
+"""OOI3 admission control - token buckets and load shedding in front of the login entry points
+"""
+
+import math
+import time
+from collections import OrderedDict
+
+from base.metrics import registry
+
+admission_admitted = registry.counter('ooi_admission_admitted_total', 'Logins admitted by endpoint', ('endpoint',))
+admission_rejected = registry.counter('ooi_admission_rejected_total', 'Logins turned away by endpoint and reason',
+                                      ('endpoint', 'reason'))
+
+# Reasons for turning a login away
+OVERLOAD = 'overload'
+GLOBAL = 'global'
+CLIENT = 'client'
+
+
+class TokenBucket:
+    """This class allows `rate` events per second on average with bursts of up to `burst` events"""
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now, rate=None):
+        """ Take one token if there is one, refilling at `rate` since the last call
+
+        :param now: float
+        :param rate: float, the bucket rate unless given
+        :return: float 0 if a token was taken, else seconds until the next one
+        """
+        rate = self.rate if rate is None else rate
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate if rate > 0 else math.inf
+
+    def full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class AdmissionController:
+    """This class decides whether a login may start
+    Every client address has its own bucket unless `per_client` is off, and all logins share a global one.
+    The global rate shrinks with the load, the larger of event loop lag over `max_lag` and logins in flight
+    over `max_inflight`; at a load of 1 every login is turned away, so logins never take the loop from the game
+    API traffic"""
+
+    def __init__(self, rate, burst, client_rate, client_burst, max_clients, max_lag, max_inflight,
+                 lag=None, inflight=None, retry_after=5, per_client=True):
+        """ Init the controller
+
+        :param rate: float logins per second for all clients
+        :param burst: int
+        :param client_rate: float logins per second for one client address
+        :param client_burst: int
+        :param max_clients: int client buckets remembered
+        :param max_lag: float seconds of event loop lag at which logins are shed
+        :param max_inflight: int logins running or waiting at which logins are shed
+        :param lag: function returning the current event loop lag in seconds
+        :param inflight: function returning the number of logins running or waiting
+        :param retry_after: int seconds a client is told to wait when logins are shed
+        :param per_client: bool, off when client addresses are unknown and all logins are limited by the global bucket
+        :return: none
+        """
+        self.rate = rate
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_clients = max_clients
+        self.max_lag = max_lag
+        self.max_inflight = max_inflight
+        self.lag = lag or (lambda: 0.0)
+        self.inflight = inflight or (lambda: 0)
+        self.retry_after = retry_after
+        self.per_client = per_client
+        self.bucket = TokenBucket(rate, burst)
+        self.clients = OrderedDict()
+
+    def load(self):
+        """ Current load between 0 and 1 or more
+
+        :return: float
+        """
+        load = self.lag() / self.max_lag if self.max_lag else 0.0
+        if self.max_inflight:
+            load = max(load, self.inflight() / self.max_inflight)
+        return load
+
+    def _client(self, address, now):
+        bucket = self.clients.get(address)
+        if bucket is None:
+            bucket = self.clients[address] = TokenBucket(self.client_rate, self.client_burst, now)
+            # Forget the least recently seen clients
+            while len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+        else:
+            self.clients.move_to_end(address)
+        return bucket
+
+    def admit(self, address, endpoint):
+        """ Decide whether a login of `address` on `endpoint` may start
+
+        :param address: str
+        :param endpoint: str
+        :return: tuple (reason, retry_after), reason is None when the login is admitted
+        """
+        now = time.monotonic()
+        load = self.load()
+        if load >= 1:
+            reason, wait = OVERLOAD, self.retry_after
+        else:
+            client = self._client(address, now) if self.per_client else None
+            wait = client.take(now) if client is not None else 0.0
+            reason = CLIENT
+            if not wait:
+                wait = self.bucket.take(now, self.rate * (1 - load))
+                reason = GLOBAL
+                if wait and client is not None:
+                    # The client is not to blame, it keeps its token
+                    client.tokens += 1
+        if not wait:
+            admission_admitted.inc((endpoint,))
+            return None, 0
+        admission_rejected.inc((endpoint, reason))
+        return reason, max(int(math.ceil(min(wait, 60))), 1)
+
+    def status(self):
+        """ Report the load and the buckets
+
+        :return: dict
+        """
+        now = time.monotonic()
+        return {'load': self.load(),
+                'tokens': self.bucket.tokens,
+                'clients': len(self.clients),
+                'limited_clients': sum(1 for bucket in self.clients.values() if not bucket.full(now))}
+
+
+def client_address(request, header=None):
+    """ Address of the client of a request, read from `header` when set by a trusted reverse proxy
+
+    :param request: aiohttp.web.Request
+    :param header: str e.g. X-Forwarded-For, the last address is the one the proxy saw
+    :return: str
+    """
+    if header:
+        value = request.headers.get(header)
+        if value:
+            return value.split(',')[-1].strip()
+    peername = request.transport.get_extra_info('peername') if request.transport is not None else None
+    return peername[0] if peername else ''
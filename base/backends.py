@@ -0,0 +1,335 @@
+"""OOI3 cache backends - the tier shared by worker processes or nodes under the in-process caches
+"""
+
+import asyncio
+import binascii
+import json
+import os
+import time
+from collections import namedtuple
+from urllib.parse import quote, urlsplit
+
+from base import config
+from base.metrics import registry
+
+backend_errors = registry.counter('ooi_cache_backend_errors_total', 'Failed requests to the remote cache backend')
+
+# A blob read from a backend, `body` is bytes or a read-only memoryview
+SharedBlob = namedtuple('SharedBlob', ['body', 'meta', 'expires'])
+
+
+class CacheBackend:
+    """This class defines the interface of a shared cache tier
+    Blobs are immutable bytes with JSON meta data and an expiry, locks let one process or node fill a key
+    while the others wait for its result"""
+
+    # Seconds after which a lock of a crashed filler goes stale
+    lock_timeout = 30
+    loop = None
+
+    @asyncio.coroutine
+    def get(self, key):
+        """ Return the blob of `key`
+
+        :param key: str
+        :return: SharedBlob or None
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def set(self, key, body, meta=None, ttl=0):
+        """ Store `body` under `key`
+
+        :param key: str
+        :param body: bytes
+        :param meta: dict
+        :param ttl: int seconds, 0 never expires
+        :return: SharedBlob
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def lock(self, key):
+        """ Try to become the only filler of `key`
+
+        :param key: str
+        :return: bool
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def unlock(self, key):
+        """ Release the lock of `key`
+
+        :param key: str
+        :return: none
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def locked(self, key):
+        """ Check whether another filler holds the lock of `key`
+
+        :param key: str
+        :return: bool
+        """
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def get_or_fill(self, key, fill, timeout=30, interval=0.05):
+        """ Return the blob of `key`, on a miss only one filler runs `fill` while the others wait for its result
+        `fill` is a coroutine function returning (body, meta, ttl), or None when there is nothing to store
+
+        :param key: str
+        :param fill: coroutine function
+        :param timeout: int
+        :param interval: float
+        :return: SharedBlob or None
+        """
+        blob = yield from self.get(key)
+        if blob is not None:
+            return blob
+
+        locked = yield from self.lock(key)
+        if not locked:
+            deadline = time.time() + timeout
+            while time.time() < deadline and (yield from self.locked(key)):
+                yield from asyncio.sleep(interval, loop=self.loop)
+            blob = yield from self.get(key)
+            if blob is not None:
+                return blob
+            # The other filler gave up without a result, fill it here
+            locked = yield from self.lock(key)
+
+        try:
+            result = yield from fill()
+            if result is None:
+                return None
+            body, meta, ttl = result
+            return (yield from self.set(key, body, meta, ttl))
+        finally:
+            if locked:
+                yield from self.unlock(key)
+
+    def close(self):
+        """ Release the resources of the backend
+
+        :return: none
+        """
+
+
+class MemoryBackend(CacheBackend):
+    """This class keeps blobs in the memory of this process, a reference backend for a single process"""
+
+    def __init__(self):
+        self.blobs = {}
+        self.locks = {}
+
+    @asyncio.coroutine
+    def get(self, key):
+        blob = self.blobs.get(key)
+        if blob is not None and blob.expires and blob.expires < time.time():
+            del self.blobs[key]
+            return None
+        return blob
+
+    @asyncio.coroutine
+    def set(self, key, body, meta=None, ttl=0):
+        blob = self.blobs[key] = SharedBlob(body=bytes(body), meta=meta or {},
+                                            expires=time.time() + ttl if ttl else 0)
+        return blob
+
+    @asyncio.coroutine
+    def lock(self, key):
+        if (yield from self.locked(key)):
+            return False
+        self.locks[key] = time.time() + self.lock_timeout
+        return True
+
+    @asyncio.coroutine
+    def unlock(self, key):
+        self.locks.pop(key, None)
+
+    @asyncio.coroutine
+    def locked(self, key):
+        expires = self.locks.get(key)
+        if expires is not None and expires < time.time():
+            del self.locks[key]
+            expires = None
+        return expires is not None
+
+
+class BackendError(Exception):
+    """Raised when a cache server answers out of protocol"""
+
+
+class RemoteBackend(CacheBackend):
+    """This class shares blobs and locks between nodes through a cache server, see base.cacheserver
+    The protocol is line based, one command line per request and one status line per reply, blobs follow
+    their line as raw bytes. Keys are URL-quoted and a ttl of 0 never expires:
+
+        GET <key>                                  VALUE <ttl> <meta length> <body length>, meta, body or MISS
+        SET <key> <ttl> <meta length> <body length>, meta, body                                            OK
+        LOCK <key> <ttl> <token>                   OK or BUSY
+        UNLOCK <key> <token>                       OK
+        LOCKED <key>                               YES or NO
+
+    While the server is unreachable every lookup misses and every lock is granted for `retry` seconds,
+    so each node falls back to fetching on its own instead of waiting for timeouts"""
+
+    def __init__(self, host, port, timeout=0.5, max_connections=8, retry=5, lock_timeout=30, loop=None):
+        """ Init the backend, connections are opened on demand and kept for later requests
+
+        :param host: str
+        :param port: int
+        :param timeout: float seconds for connecting and for every reply
+        :param max_connections: int
+        :param retry: float seconds the server is left alone after a failure
+        :param lock_timeout: int seconds after which the lock of a crashed node expires on the server
+        :param loop: asyncio.AbstractEventLoop
+        :return: none
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retry = retry
+        self.lock_timeout = lock_timeout
+        self.loop = loop
+        self.slots = asyncio.Semaphore(max_connections, loop=loop)
+        self.idle = []
+        self.down_until = 0
+        # Tokens of the locks held by this process, key => token
+        self.tokens = {}
+
+    @asyncio.coroutine
+    def _reply(self, reader):
+        """ Read one reply
+
+        :param reader: asyncio.StreamReader
+        :return: tuple (status, fields, data), data is the payload of a VALUE reply
+        """
+        line = yield from reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise asyncio.IncompleteReadError(line, None)
+        fields = line.decode().split()
+        if not fields:
+            raise BackendError('Empty reply')
+        data = None
+        if fields[0] == 'VALUE':
+            data = yield from reader.readexactly(int(fields[2]) + int(fields[3]))
+        elif fields[0] == 'ERROR':
+            raise BackendError(line.decode().strip())
+        return fields[0], fields, data
+
+    @asyncio.coroutine
+    def _request(self, command, payload=b''):
+        """ Send one command on a pooled connection and read its reply
+        A kept connection closed by the server meanwhile is replaced by a new one once
+
+        :param command: str
+        :param payload: bytes
+        :return: tuple (status, fields, data)
+        """
+        with (yield from self.slots):
+            while True:
+                reused = bool(self.idle)
+                if reused:
+                    reader, writer = self.idle.pop()
+                else:
+                    reader, writer = yield from asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port, loop=self.loop), self.timeout, loop=self.loop)
+                try:
+                    writer.write(command.encode() + b'\r\n' + payload)
+                    reply = yield from asyncio.wait_for(self._reply(reader), self.timeout, loop=self.loop)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                self.idle.append((reader, writer))
+                return reply
+
+    @asyncio.coroutine
+    def _call(self, command, payload=b''):
+        """ Send one command, failures are logged and leave the server alone for `retry` seconds
+
+        :param command: str
+        :param payload: bytes
+        :return: tuple (status, fields, data) or None when the server is unavailable
+        """
+        if self.down_until > time.time():
+            return None
+        try:
+            return (yield from self._request(command, payload))
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, BackendError, ValueError) as e:
+            backend_errors.inc()
+            self.down_until = time.time() + self.retry
+            print('Cache backend %s:%d unavailable: %r' % (self.host, self.port, e))
+            return None
+
+    @asyncio.coroutine
+    def get(self, key):
+        reply = yield from self._call('GET ' + quote(key, safe=''))
+        if reply is None or reply[0] != 'VALUE':
+            return None
+        _, fields, data = reply
+        ttl = float(fields[1])
+        meta_length = int(fields[2])
+        return SharedBlob(body=data[meta_length:], meta=json.loads(data[:meta_length].decode()),
+                          expires=time.time() + ttl if ttl else 0)
+
+    @asyncio.coroutine
+    def set(self, key, body, meta=None, ttl=0):
+        meta = meta or {}
+        encoded = json.dumps(meta).encode()
+        yield from self._call('SET %s %d %d %d' % (quote(key, safe=''), ttl, len(encoded), len(body)),
+                              encoded + bytes(body))
+        return SharedBlob(body=bytes(body), meta=meta, expires=time.time() + ttl if ttl else 0)
+
+    @asyncio.coroutine
+    def lock(self, key):
+        token = binascii.hexlify(os.urandom(8)).decode()
+        reply = yield from self._call('LOCK %s %d %s' % (quote(key, safe=''), self.lock_timeout, token))
+        if reply is not None and reply[0] != 'OK':
+            return False
+        self.tokens[key] = token
+        return True
+
+    @asyncio.coroutine
+    def unlock(self, key):
+        token = self.tokens.pop(key, None)
+        if token is not None:
+            yield from self._call('UNLOCK %s %s' % (quote(key, safe=''), token))
+
+    @asyncio.coroutine
+    def locked(self, key):
+        reply = yield from self._call('LOCKED ' + quote(key, safe=''))
+        return reply is not None and reply[0] == 'YES'
+
+    def close(self):
+        while self.idle:
+            _, writer = self.idle.pop()
+            writer.close()
+
+
+def open_backend(spec, shared=None, loop=None):
+    """ Build the cache backend named by `spec`
+
+    :param spec: str '' or 'shared' for the store of this host's workers, 'memory' for one process,
+                 'tcp://host:port' for a cache server shared by several nodes
+    :param shared: base.shared.SharedStore of this host's workers or None with a single process
+    :param loop: asyncio.AbstractEventLoop
+    :return: CacheBackend or None
+    """
+    if spec in ('', 'shared'):
+        return shared
+    if spec == 'memory':
+        return MemoryBackend()
+    url = urlsplit(spec)
+    if url.scheme != 'tcp' or not url.hostname or not url.port:
+        raise ValueError('Unknown cache backend %r' % spec)
+    return RemoteBackend(url.hostname, url.port, config.cache_backend_timeout, config.cache_backend_connections,
+                         config.cache_backend_retry, loop=loop)
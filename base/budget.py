@@ -0,0 +1,79 @@
+"""OOI3 memory budget - one byte limit shared by all in-process caches
+"""
+
+from base import config
+
+
+class MemoryBudget:
+    """This class bounds the bytes held by all registered caches together
+    Over the budget, the least recently used entry is evicted across caches. A cache's `cost` is the number
+    of seconds its entries are treated as more recently used than they were, so entries that are expensive
+    to fetch again outlive cheap ones of the same age"""
+
+    def __init__(self, max_size):
+        """ Init the budget, 0 disables the global limit and only keeps the accounting
+
+        :param max_size: int bytes
+        :return: none
+        """
+        self.max_size = max_size
+        self.caches = {}
+        self.evictions = 0
+
+    def register(self, cache):
+        """ Account for a cache, a cache registered again under the same name replaces the former one
+        The cache provides `name`, `cost`, `size`, `oldest()` returning the last use of its least recently
+        used entry or None when empty, and `evict()` dropping that entry
+
+        :param cache: base.cache.LRUCache
+        :return: none
+        """
+        self.caches[cache.name] = cache
+
+    @property
+    def size(self):
+        return sum(cache.size for cache in self.caches.values())
+
+    def trim(self):
+        """ Evict entries until all caches together fit in the budget
+
+        :return: int entries evicted
+        """
+        if not self.max_size:
+            return 0
+        evicted = 0
+        size = self.size
+        while size > self.max_size:
+            victim = None
+            score = None
+            for cache in self.caches.values():
+                used = cache.oldest()
+                if used is not None and (victim is None or used + cache.cost < score):
+                    victim, score = cache, used + cache.cost
+            if victim is None:
+                break
+            size -= victim.evict()
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def status(self):
+        """ Report size, entries, hit rate and evictions of every cache
+
+        :return: dict
+        """
+        caches = {}
+        for name, cache in self.caches.items():
+            lookups = cache.hits + cache.misses
+            caches[name] = {'size': cache.size,
+                            'entries': len(cache),
+                            'hits': cache.hits,
+                            'misses': cache.misses,
+                            'hit_rate': cache.hits / lookups if lookups else 0.0,
+                            'evictions': cache.evictions,
+                            'budget_evictions': cache.budget_evictions}
+        return {'max_size': self.max_size, 'size': self.size, 'evictions': self.evictions, 'caches': caches}
+
+
+# Budget of the caches of this process
+budget = MemoryBudget(config.cache_budget)
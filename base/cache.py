@@ -0,0 +1,481 @@
+"""OOI3 cache - in-memory caches with single-flight upstream fetches
+"""
+
+import asyncio
+import gzip
+import json
+import re
+import time
+from collections import namedtuple, OrderedDict
+
+# Game API responses start with svdata= and the api_result member, read without parsing the whole body
+svdata_head = re.compile(rb'^svdata=\{\s*"api_result"\s*:\s*(-?\d+)\s*[,}]')
+
+
+def api_result(body):
+    """ Read api_result of a game API response, errors such as an expired token are sent with HTTP status 200
+
+    :param body: bytes
+    :return: int or None if the body is not a game API response
+    """
+    match = svdata_head.match(bytes(body[:64]))
+    if match is not None:
+        return int(match.group(1))
+    if bytes(body[:7]) != b'svdata=':
+        return None
+    try:
+        svdata = json.loads(bytes(body[7:]).decode())
+    except ValueError:
+        return None
+    return svdata.get('api_result') if isinstance(svdata, dict) else None
+
+
+class SingleFlight:
+    """This class coalesces concurrent calls for the same key into one call"""
+
+    def __init__(self, loop=None):
+        """ Init the in-flight call table
+
+        :param loop: asyncio.AbstractEventLoop
+        :return: none
+        """
+        self.loop = loop
+        self.calls = {}
+
+    @asyncio.coroutine
+    def do(self, key, func, *args):
+        """ Run `func(*args)` once for `key`, concurrent callers wait for the same result
+        The call is shielded so a cancelled caller never cancels the shared call
+
+        :param key: hashable
+        :param func: coroutine function
+        :return: tuple (result, shared)
+        """
+        future = self.calls.get(key)
+        if future is not None:
+            return (yield from asyncio.shield(future, loop=self.loop)), True
+
+        future = asyncio.ensure_future(func(*args), loop=self.loop)
+        self.calls[key] = future
+        future.add_done_callback(lambda f: self.calls.pop(key, None))
+        return (yield from asyncio.shield(future, loop=self.loop)), False
+
+
+class LRUCache:
+    """This class keeps values up to a total size, evicting the least recently used first
+    With a memory budget the cache also gives up entries when all caches together are over the budget"""
+
+    def __init__(self, max_size, sizeof=len, max_entries=0, expired=None, name=None, cost=0, budget=None):
+        """ Init an empty cache
+
+        :param max_size: int, 0 leaves the size to the budget
+        :param sizeof: function returning the size of a value in bytes
+        :param max_entries: int, 0 for no limit
+        :param expired: function telling whether a value has expired, expired values are dropped on lookup
+        :param name: str
+        :param cost: int seconds the entries are kept longer than entries of a cost 0 cache under the budget
+        :param budget: base.budget.MemoryBudget
+        :return: none
+        """
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.max_entries = max_entries
+        self.expired = expired
+        self.name = name
+        self.cost = cost
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.used = {}
+        self.size = 0
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.budget_evictions = 0
+
+        if budget is not None:
+            budget.register(self)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """ Return the value of `key` and mark it as recently used
+
+        :param key: hashable
+        :param default: object
+        :return: object
+        """
+        value = self.entries.get(key)
+        if value is None or (self.expired is not None and self.expired(value)):
+            if value is not None:
+                self.discard(key)
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        self.used[key] = time.monotonic()
+        return value
+
+    def items(self):
+        """ Return the cached pairs, least recently used first, without marking them as used
+
+        :return: list of tuple
+        """
+        return list(self.entries.items())
+
+    def set(self, key, value):
+        """ Store `value` under `key`, values larger than the whole cache are not stored
+
+        :param key: hashable
+        :param value: object
+        :return: none
+        """
+        self.discard(key)
+        size = self.sizeof(value)
+        if self.max_size and size > self.max_size:
+            return
+        self.entries[key] = value
+        self.used[key] = time.monotonic()
+        self.size += size
+        while ((self.max_size and self.size > self.max_size) or
+               (self.max_entries and len(self.entries) > self.max_entries)):
+            self._pop()
+            self.evictions += 1
+        if self.budget is not None:
+            self.budget.trim()
+
+    def discard(self, key):
+        """ Remove `key` if it is cached
+
+        :param key: hashable
+        :return: none
+        """
+        if key in self.entries:
+            self.size -= self.sizeof(self.entries.pop(key))
+            del self.used[key]
+
+    def _pop(self):
+        key, value = self.entries.popitem(last=False)
+        del self.used[key]
+        size = self.sizeof(value)
+        self.size -= size
+        return size
+
+    def oldest(self):
+        """ Last use of the least recently used entry
+
+        :return: float or None
+        """
+        for key in self.entries:
+            return self.used[key]
+        return None
+
+    def evict(self):
+        """ Drop the least recently used entry, called by the budget
+
+        :return: int bytes freed
+        """
+        self.budget_evictions += 1
+        return self._pop()
+
+
+# Cache policy of one action
+# ttl: seconds before an entry expires, 0 to keep it until evicted
+# key: parts a response is bound to besides the action, any of 'world' and 'member'
+# min_size, max_size: only bodies within these bounds are cached
+# gzip: also keep a pre-gzipped copy of the body
+CachePolicy = namedtuple('CachePolicy', ['ttl', 'key', 'min_size', 'max_size', 'gzip'])
+
+# A cached response, `body` and `gzip` are stored ready to be written
+CacheEntry = namedtuple('CacheEntry', ['body', 'gzip', 'expires', 'size'])
+
+
+def load_policies(table):
+    """ Build the policy table from its configuration form {action: {option: value}}
+
+    :param table: dict
+    :return: dict
+    """
+    policies = {}
+    for action, rule in table.items():
+        policies[action] = CachePolicy(ttl=rule.get('ttl', 0),
+                                       key=tuple(rule.get('key', ())),
+                                       min_size=rule.get('min_size', 0),
+                                       max_size=rule.get('max_size', None),
+                                       gzip=rule.get('gzip', False))
+    return policies
+
+
+class ResponseCache:
+    """This class caches game API responses of the actions listed in its policy table"""
+
+    def __init__(self, policies, max_size, shared=None, loop=None, budget=None, timeout=None):
+        """ Init the cache with its policy table and a byte limit for all entries
+        With a shared backend, entries not bound to a member are also kept in the tier shared by all workers or nodes
+
+        :param policies: dict
+        :param max_size: int
+        :param shared: base.backends.CacheBackend
+        :param loop: asyncio.AbstractEventLoop
+        :param budget: base.budget.MemoryBudget
+        :param timeout: function returning the upstream timeout of an action in seconds, bounding the wait
+                        for another worker or node filling the same entry
+        :return: none
+        """
+        self.policies = load_policies(policies)
+        self.max_size = max_size
+        self.shared = shared
+        self.timeout = timeout or (lambda action: 30)
+        self.loop = loop
+        # Responses cost an upstream round trip, they outlive other cache entries by 5 minutes under the budget
+        self.entries = LRUCache(max_size, sizeof=lambda entry: entry.size,
+                                expired=lambda entry: entry.expires and entry.expires < time.time(),
+                                name='api', cost=300, budget=budget)
+        self.flights = SingleFlight(loop=loop)
+
+    @property
+    def size(self):
+        return self.entries.size
+
+    def policy(self, action):
+        """ Return the cache policy of `action`, None if it is not cacheable
+
+        :param action: str
+        :return: CachePolicy or None
+        """
+        return self.policies.get(action)
+
+    def key(self, action, policy, world_ip, member):
+        """ Build the cache key of a request according to the policy
+
+        :param action: str
+        :param policy: CachePolicy
+        :param world_ip: str
+        :param member: str
+        :return: tuple
+        """
+        return (action,
+                world_ip if 'world' in policy.key else None,
+                member if 'member' in policy.key else None)
+
+    def _shared_key(self, key):
+        """ Name of an entry in the shared backend, entries bound to a member are never shared
+
+        :param key: tuple
+        :return: str or None
+        """
+        if self.shared is None or key[2] is not None:
+            return None
+        return 'api/%s/%s' % (key[0], key[1] or '')
+
+    @asyncio.coroutine
+    def _get_shared(self, key):
+        """ Load an entry from the shared backend, the gzip copy is only looked up for policies keeping one
+
+        :param key: tuple
+        :return: CacheEntry or None
+        """
+        shared_key = self._shared_key(key)
+        if shared_key is None:
+            return None
+        blob = yield from self.shared.get(shared_key)
+        if blob is None:
+            return None
+        return (yield from self._shared_entry(key, shared_key, blob))
+
+    @asyncio.coroutine
+    def _shared_entry(self, key, shared_key, blob, compressed=None):
+        """ Build an entry from a blob of the shared backend, the gzip copy is loaded unless given
+
+        :param key: tuple
+        :param shared_key: str
+        :param blob: base.backends.SharedBlob
+        :param compressed: bytes or None
+        :return: CacheEntry
+        """
+        policy = self.policies.get(key[0])
+        if compressed is None and policy is not None and policy.gzip:
+            compressed = yield from self.shared.get(shared_key + '.gz')
+            compressed = compressed.body if compressed is not None else None
+        size = len(blob.body) + (len(compressed) if compressed is not None else 0)
+        return CacheEntry(body=blob.body, gzip=compressed, expires=blob.expires, size=size)
+
+    def _insert(self, key, entry):
+        """ Add an entry and evict the least recently used ones over the byte limit
+
+        :param key: tuple
+        :param entry: CacheEntry
+        :return: none
+        """
+        self.entries.set(key, entry)
+
+    @asyncio.coroutine
+    def get(self, key):
+        """ Return a fresh entry for `key`, expired entries are dropped and misses are looked up in the shared backend
+
+        :param key: tuple
+        :return: CacheEntry or None
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = yield from self._get_shared(key)
+            if entry is not None:
+                self._insert(key, entry)
+        return entry
+
+    def discard(self, key):
+        """ Remove the entry of `key` if there is one
+
+        :param key: tuple
+        :return: none
+        """
+        self.entries.discard(key)
+
+    def dump(self):
+        """ Records of the fresh entries for a snapshot, entries bound to a member are left out
+
+        :return: list of (key, meta, blobs)
+        """
+        now = time.time()
+        return [(list(key), {'expires': entry.expires}, [entry.body, entry.gzip])
+                for key, entry in self.entries.items()
+                if key[2] is None and not (entry.expires and entry.expires < now)]
+
+    def restore(self, records):
+        """ Insert the entries of a snapshot, skipping expired ones and actions no longer cached
+
+        :param records: list of (key, meta, blobs)
+        :return: none
+        """
+        now = time.time()
+        for key, meta, (body, compressed) in records:
+            expires = meta['expires']
+            if key[0] not in self.policies or (expires and expires < now):
+                continue
+            size = len(body) + (len(compressed) if compressed is not None else 0)
+            self._insert(tuple(key), CacheEntry(body=body, gzip=compressed, expires=expires, size=size))
+
+    def _admits(self, policy, body):
+        """ Check the size bounds of a policy
+
+        :param policy: CachePolicy
+        :param body: bytes
+        :return: bool
+        """
+        return len(body) >= policy.min_size and (policy.max_size is None or len(body) <= policy.max_size)
+
+    @asyncio.coroutine
+    def _cacheable(self, policy, body):
+        """ Check that a body fits the policy and reports success, game errors are never cached
+        Bodies whose api_result is not at their head are parsed in a worker thread
+
+        :param policy: CachePolicy
+        :param body: bytes
+        :return: bool
+        """
+        if not self._admits(policy, body):
+            return False
+        match = svdata_head.match(bytes(body[:64]))
+        if match is not None:
+            return int(match.group(1)) == 1
+        loop = self.loop or asyncio.get_event_loop()
+        return (yield from loop.run_in_executor(None, api_result, body)) == 1
+
+    @asyncio.coroutine
+    def _compress(self, policy, body):
+        """ Build the gzip copy of a body in a worker thread if the policy asks for one
+
+        :param policy: CachePolicy
+        :param body: bytes
+        :return: bytes or None
+        """
+        if not policy.gzip:
+            return None
+        loop = self.loop or asyncio.get_event_loop()
+        return (yield from loop.run_in_executor(None, gzip.compress, body))
+
+    @asyncio.coroutine
+    def store(self, key, policy, body):
+        """ Store `body` under `key` if the policy allows it and the body is not a game error
+
+        :param key: tuple
+        :param policy: CachePolicy
+        :param body: bytes
+        :return: CacheEntry or None
+        """
+        if not (yield from self._cacheable(policy, body)):
+            return None
+        body = bytes(body)
+        compressed = yield from self._compress(policy, body)
+        size = len(body) + (len(compressed) if compressed is not None else 0)
+        expires = time.time() + policy.ttl if policy.ttl else 0
+        entry = CacheEntry(body=body, gzip=compressed, expires=expires, size=size)
+        self._insert(key, entry)
+        return entry
+
+    @asyncio.coroutine
+    def _fill(self, key, policy, fetch, args):
+        """ Fetch a response from upstream and store it when it is cacheable
+        Shared entries are fetched by one worker process or node while the others wait for the shared backend
+
+        :param key: tuple
+        :param policy: CachePolicy
+        :param fetch: coroutine function returning (status, body)
+        :param args: tuple
+        :return: tuple (entry, status, body)
+        """
+        shared_key = self._shared_key(key)
+        if shared_key is None:
+            status, body = yield from fetch(*args)
+            entry = None
+            if status == 200:
+                entry = yield from self.store(key, policy, body)
+            return entry, status, body
+
+        fetched = []
+        compressed = []
+
+        @asyncio.coroutine
+        def fill():
+            status, body = yield from fetch(*args)
+            fetched.extend((status, body))
+            if status != 200 or not (yield from self._cacheable(policy, body)):
+                return None
+            gzipped = yield from self._compress(policy, body)
+            if gzipped is not None:
+                compressed.append(gzipped)
+                yield from self.shared.set(shared_key + '.gz', gzipped, ttl=policy.ttl)
+            return body, None, policy.ttl
+
+        blob = yield from self.shared.get_or_fill(shared_key, fill, timeout=self.timeout(key[0]))
+        if blob is not None:
+            # An entry filled here is built from what was just stored, only another filler's gzip copy is loaded
+            entry = yield from self._shared_entry(key, shared_key, blob, compressed[0] if compressed else None)
+            self._insert(key, entry)
+            return entry, 200, entry.body
+        if fetched:
+            return None, fetched[0], fetched[1]
+        status, body = yield from fetch(*args)
+        return None, status, body
+
+    @asyncio.coroutine
+    def fetch(self, key, policy, fetch, *args):
+        """ Fetch a missing entry, concurrent misses for the same key share one upstream request
+        A waiter whose shared result turned out uncacheable fetches its own response instead,
+        since that response may belong to another member
+
+        :param key: tuple
+        :param policy: CachePolicy
+        :param fetch: coroutine function returning (status, body)
+        :return: tuple (entry, status, body)
+        """
+        result, shared = yield from self.flights.do(key, self._fill, key, policy, fetch, args)
+        if shared and result[0] is None:
+            status, body = yield from fetch(*args)
+            return None, status, body
+        return result
@@ -0,0 +1,165 @@
+"""OOI3 cache server - a minimal stand-in for the cache tier shared by several nodes, see base.backends.RemoteBackend
+"""
+
+import argparse
+import asyncio
+import time
+from collections import OrderedDict
+from urllib.parse import unquote
+
+
+class CacheServer:
+    """This class serves blobs and locks to RemoteBackend clients, blobs are evicted least recently used first"""
+
+    def __init__(self, max_size=256 * 1024 * 1024):
+        """ Init an empty server
+
+        :param max_size: int bytes of all blobs
+        :return: none
+        """
+        self.max_size = max_size
+        self.size = 0
+        # key => (expires, meta, body), least recently used first
+        self.entries = OrderedDict()
+        # key => (token, expires)
+        self.locks = {}
+        self.server = None
+        self.writers = set()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] and entry[0] < time.time():
+            self.discard(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key, ttl, meta, body):
+        self.discard(key)
+        self.entries[key] = (time.time() + ttl if ttl else 0, meta, body)
+        self.size += len(meta) + len(body)
+        while self.size > self.max_size and self.entries:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1]) + len(entry[2])
+
+    def locked(self, key):
+        lock = self.locks.get(key)
+        if lock is not None and lock[1] < time.time():
+            del self.locks[key]
+            lock = None
+        return lock
+
+    def lock(self, key, ttl, token):
+        lock = self.locked(key)
+        if lock is not None and lock[0] != token:
+            return False
+        self.locks[key] = (token, time.time() + ttl)
+        return True
+
+    def unlock(self, key, token):
+        lock = self.locked(key)
+        if lock is not None and lock[0] == token:
+            del self.locks[key]
+
+    @asyncio.coroutine
+    def handle(self, reader, writer):
+        """ Serve the commands of one connection until it is closed
+
+        :param reader: asyncio.StreamReader
+        :param writer: asyncio.StreamWriter
+        :return: none
+        """
+        self.writers.add(writer)
+        try:
+            while True:
+                line = yield from reader.readline()
+                if not line:
+                    break
+                fields = line.decode().split()
+                command = fields[0] if fields else ''
+                if command == 'GET' and len(fields) == 2:
+                    entry = self.get(unquote(fields[1]))
+                    if entry is None:
+                        writer.write(b'MISS\r\n')
+                    else:
+                        expires, meta, body = entry
+                        ttl = max(expires - time.time(), 0.001) if expires else 0
+                        writer.write(('VALUE %.3f %d %d\r\n' % (ttl, len(meta), len(body))).encode())
+                        writer.write(meta)
+                        writer.write(body)
+                elif command == 'SET' and len(fields) == 5:
+                    meta_length, body_length = int(fields[3]), int(fields[4])
+                    data = yield from reader.readexactly(meta_length + body_length)
+                    self.set(unquote(fields[1]), int(fields[2]), data[:meta_length], data[meta_length:])
+                    writer.write(b'OK\r\n')
+                elif command == 'LOCK' and len(fields) == 4:
+                    writer.write(b'OK\r\n' if self.lock(unquote(fields[1]), int(fields[2]), fields[3]) else b'BUSY\r\n')
+                elif command == 'UNLOCK' and len(fields) == 3:
+                    self.unlock(unquote(fields[1]), fields[2])
+                    writer.write(b'OK\r\n')
+                elif command == 'LOCKED' and len(fields) == 2:
+                    writer.write(b'YES\r\n' if self.locked(unquote(fields[1])) else b'NO\r\n')
+                else:
+                    writer.write(b'ERROR unknown command\r\n')
+                    break
+                yield from writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    @asyncio.coroutine
+    def start(self, host, port, loop=None):
+        """ Start listening
+
+        :param host: str
+        :param port: int
+        :param loop: asyncio.AbstractEventLoop
+        :return: asyncio.AbstractServer
+        """
+        self.server = yield from asyncio.start_server(self.handle, host, port, loop=loop)
+        return self.server
+
+    @asyncio.coroutine
+    def close(self):
+        """ Stop listening and close the connections of the clients
+
+        :return: none
+        """
+        if self.server is not None:
+            self.server.close()
+            yield from self.server.wait_closed()
+            self.server = None
+        for writer in list(self.writers):
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cache server shared by several OOI nodes')
+    parser.add_argument('-H', '--host', default='127.0.0.1', help='The host to listen on')
+    parser.add_argument('-p', '--port', type=int, default=9898, help='The port to listen on')
+    parser.add_argument('--max-size', type=int, default=256, help='Megabytes of blobs kept')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    cache = CacheServer(args.max_size * 1024 * 1024)
+    server = loop.run_until_complete(cache.start(args.host, args.port, loop))
+    print('OOI cache server on %s:%d' % server.sockets[0].getsockname()[:2])
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(cache.close())
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""OOI3 capture log - game API request/response pairs written to rotated gzip segments by a background thread
+"""
+
+import gzip
+import json
+import os
+import queue
+import re
+import threading
+import time
+from urllib.parse import parse_qsl
+
+from base.metrics import registry
+
+capture_records = registry.counter('ooi_capture_records_total', 'Game API exchanges written to the capture log')
+capture_dropped = registry.counter('ooi_capture_dropped_total', 'Game API exchanges dropped on a full capture queue')
+capture_bytes = registry.counter('ooi_capture_bytes_total', 'Compressed bytes written to the capture log')
+
+# Counters of the log are incremented by the event loop and by the writer thread
+counters_lock = threading.Lock()
+
+# Request fields never written to the log, their values are also scrubbed from the responses
+PRIVATE_FIELDS = ('api_token',)
+REDACTED = '<redacted>'
+private_members = re.compile('"(%s)"\\s*:\\s*"[^"]*"' % '|'.join(PRIVATE_FIELDS))
+
+
+def _count(counter, value=1):
+    with counters_lock:
+        counter.inc(value=value)
+
+
+def _scrub(text, secrets):
+    for secret in secrets:
+        text = text.replace(secret, REDACTED)
+    return text
+
+
+class CaptureLog:
+    """This class queues game API exchanges and writes them from a background thread
+    The event loop only appends a tuple to a bounded queue, exchanges arriving on a full queue are dropped.
+    The writer appends each batch as one gzip member of a JSON lines segment, readable with zcat or gzip.open"""
+
+    def __init__(self, directory, actions=None, queue_size=10000, batch_size=256, flush_interval=1.0,
+                 segment_size=64 * 1024 * 1024, segment_age=3600, max_segments=0):
+        """ Init the log and start its writer thread
+
+        :param directory: str
+        :param actions: list of actions to capture, all actions when empty
+        :param queue_size: int exchanges waiting for the writer
+        :param batch_size: int exchanges compressed together
+        :param flush_interval: float seconds a batch may wait for more exchanges
+        :param segment_size: int compressed bytes after which a new segment is started
+        :param segment_age: int seconds after which a new segment is started
+        :param max_segments: int segments kept in `directory`, 0 keeps all
+        :return: none
+        """
+        self.directory = directory
+        self.actions = frozenset(actions or ())
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.max_segments = max_segments
+        self.queue = queue.Queue(queue_size)
+
+        # Current segment, only touched by the writer thread
+        self.segment = None
+        self.segment_started = 0.0
+        self.segment_written = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='ooi-capture', daemon=True)
+        self.thread.start()
+
+    def wants(self, action):
+        """ Check whether exchanges of `action` are captured
+
+        :param action: str
+        :return: bool
+        """
+        return not self.actions or action in self.actions
+
+    def record(self, action, world_ip, data, status, body, cached=False):
+        """ Queue one exchange without blocking, the request is copied and the body kept as is
+
+        :param action: str
+        :param world_ip: str
+        :param data: bytes or aiohttp.MultiDictProxy
+        :param status: int
+        :param body: bytes or memoryview
+        :param cached: bool whether the response was served from the response cache
+        :return: bool whether the exchange was queued
+        """
+        if not self.wants(action):
+            return False
+        if not isinstance(data, bytes):
+            data = list(data.items())
+        if isinstance(body, memoryview):
+            body = body.tobytes()
+        try:
+            self.queue.put_nowait((time.time(), action, world_ip, data, status, body, cached))
+        except queue.Full:
+            _count(capture_dropped)
+            return False
+        return True
+
+    @staticmethod
+    def _encode(item):
+        """ Serialize one exchange as a JSON line, private request fields are left out and their values
+        are replaced wherever they appear, as are private members of the response
+
+        :param item: tuple
+        :return: bytes
+        """
+        timestamp, action, world_ip, data, status, body, cached = item
+        if isinstance(data, bytes):
+            data = parse_qsl(data.decode('utf-8', 'replace'), keep_blank_values=True)
+        secrets = [v for k, v in data if k in PRIVATE_FIELDS and v]
+        params = {k: _scrub(v, secrets) for k, v in data if k not in PRIVATE_FIELDS}
+        response = private_members.sub('"\\1":"%s"' % REDACTED, _scrub(body.decode('utf-8', 'replace'), secrets))
+        line = json.dumps({'time': timestamp,
+                           'action': action,
+                           'world': world_ip,
+                           'request': params,
+                           'status': status,
+                           'cached': cached,
+                           'response': response},
+                          ensure_ascii=False, separators=(',', ':'))
+        return line.encode('utf-8') + b'\n'
+
+    def _rotate(self):
+        """ Close the current segment, start a new one and delete the oldest beyond max_segments
+        Segments written to within segment_age may still be open in another worker and are kept
+
+        :return: none
+        """
+        if self.segment is not None:
+            self.segment.close()
+        now = time.time()
+        name = 'capture-%s-%d.jsonl.gz' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), os.getpid())
+        self.segment = open(os.path.join(self.directory, name), 'ab')
+        self.segment_started = now
+        self.segment_written = 0
+
+        if self.max_segments:
+            names = sorted(n for n in os.listdir(self.directory)
+                           if n.startswith('capture-') and n.endswith('.jsonl.gz'))
+            for old in names[:-self.max_segments]:
+                path = os.path.join(self.directory, old)
+                try:
+                    if os.path.getmtime(path) < now - self.segment_age:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def _write(self, batch):
+        """ Append a batch to the current segment as one gzip member
+
+        :param batch: list of tuple
+        :return: none
+        """
+        if (self.segment is None or self.segment_written >= self.segment_size or
+                time.time() - self.segment_started >= self.segment_age):
+            self._rotate()
+        data = gzip.compress(b''.join(self._encode(item) for item in batch))
+        self.segment.write(data)
+        self.segment.flush()
+        self.segment_written += len(data)
+        _count(capture_records, len(batch))
+        _count(capture_bytes, len(data))
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                if self.stopped.is_set():
+                    break
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                # A full disk must not stop the writer, the batch is lost and counted as dropped
+                _count(capture_dropped, len(batch))
+                print('Capture log write failed: %s' % e)
+        if self.segment is not None:
+            self.segment.close()
+
+    def close(self):
+        """ Write the queued exchanges and stop the writer thread
+
+        :return: none
+        """
+        self.stopped.set()
+        self.thread.join()
@@ -1,3 +1,4 @@
+import json
 import os
 
 # Define proxy
@@ -11,3 +12,144 @@ base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 template_dir = os.path.join(base_dir, 'templates')
 static_dir = os.path.join(base_dir, 'static')
 kcs_dir = os.path.join(base_dir, '_kcs')
+
+# Define template mode, production compiles templates once at startup and caches rendered game pages
+# Set OOI_TEMPLATE_PRODUCTION=0 while editing templates
+template_production = bool(int(os.environ.get('OOI_TEMPLATE_PRODUCTION', 1)))
+page_cache_size = int(os.environ.get('OOI_PAGE_CACHE_SIZE', 4 * 1024 * 1024))
+
+# Define static pipeline, fingerprinted and pre-compressed copies of static files are written to static_build_dir
+static_pipeline = bool(int(os.environ.get('OOI_STATIC_PIPELINE', 1)))
+static_build_dir = os.environ.get('OOI_STATIC_BUILD_DIR', os.path.join(base_dir, '_static'))
+
+# Define upstream connection pool for game worlds
+upstream_pool_limit = int(os.environ.get('OOI_UPSTREAM_POOL_LIMIT', 32))
+upstream_keepalive = int(os.environ.get('OOI_UPSTREAM_KEEPALIVE', 30))
+upstream_prewarm = int(os.environ.get('OOI_UPSTREAM_PREWARM', 0))
+
+# Define upstream scheduler: game API calls in flight per world and in total, calls beyond that wait
+# at most max_wait seconds in a queue of at most max_waiting calls, served round-robin across clients
+upstream_world_limit = int(os.environ.get('OOI_UPSTREAM_WORLD_LIMIT', upstream_pool_limit))
+upstream_global_limit = int(os.environ.get('OOI_UPSTREAM_GLOBAL_LIMIT', 256))
+upstream_max_wait = float(os.environ.get('OOI_UPSTREAM_MAX_WAIT', 2))
+upstream_max_waiting = int(os.environ.get('OOI_UPSTREAM_MAX_WAITING', 2048))
+
+# Define circuit breaker of each game world: it opens when error_rate of at least min_calls calls in the last
+# window seconds failed, calls fail fast for cooldown seconds, then one probe call decides whether it closes
+breaker_window = int(os.environ.get('OOI_BREAKER_WINDOW', 60))
+breaker_min_calls = int(os.environ.get('OOI_BREAKER_MIN_CALLS', 10))
+breaker_error_rate = float(os.environ.get('OOI_BREAKER_ERROR_RATE', 0.5))
+breaker_cooldown = int(os.environ.get('OOI_BREAKER_COOLDOWN', 15))
+
+# Define timeout of game API calls in seconds, with overrides keyed by action
+api_timeout = float(os.environ.get('OOI_API_TIMEOUT', 5))
+api_timeouts = json.loads(os.environ.get('OOI_API_TIMEOUTS', json.dumps({'api_start2': 15})))
+
+# Forward game API bodies untouched and stream responses back to the client
+api_passthrough = bool(int(os.environ.get('OOI_API_PASSTHROUGH', 0)))
+
+# Define cache policy of game API responses, keyed by action
+# Options: ttl (seconds, 0 never expires), key (any of "world", "member"), min_size, max_size, gzip
+api_cache_policy = json.loads(os.environ.get('OOI_API_CACHE_POLICY', json.dumps({
+    'api_start2': {'ttl': 3600, 'key': [], 'min_size': 100000, 'gzip': True},
+})))
+api_cache_size = int(os.environ.get('OOI_API_CACHE_SIZE', 64 * 1024 * 1024))
+
+# Define gzip/deflate compression of game API responses, negotiated with the client, bodies below min_size are sent as is
+api_compression = bool(int(os.environ.get('OOI_API_COMPRESSION', 1)))
+api_compression_min_size = int(os.environ.get('OOI_API_COMPRESSION_MIN_SIZE', 1024))
+api_compression_level = int(os.environ.get('OOI_API_COMPRESSION_LEVEL', 6))
+
+# Serve cached bodies from their immutable buffers and files with sendfile, 0 copies them into each response
+zero_copy = bool(int(os.environ.get('OOI_ZERO_COPY', 1)))
+
+# Define pull-through cache of game assets kept in kcs_dir
+kcs_origin = os.environ.get('OOI_KCS_ORIGIN', '203.104.209.102')
+kcs_cache_size = int(os.environ.get('OOI_KCS_CACHE_SIZE', 1024 * 1024 * 1024))
+# Seconds between rescans of kcs_dir picking up the downloads and evictions of the other worker processes
+kcs_rescan_interval = int(os.environ.get('OOI_KCS_RESCAN_INTERVAL', 60))
+
+# Define world banner cache, size in bytes
+banner_cache_size = int(os.environ.get('OOI_BANNER_CACHE_SIZE', 8 * 1024 * 1024))
+banner_prefetch = bool(int(os.environ.get('OOI_BANNER_PREFETCH', 0)))
+
+# Define login engine, bounded concurrency over a shared connection pool to dmm.com
+login_concurrency = int(os.environ.get('OOI_LOGIN_CONCURRENCY', 16))
+login_queue_size = int(os.environ.get('OOI_LOGIN_QUEUE_SIZE', 128))
+login_pool_limit = int(os.environ.get('OOI_LOGIN_POOL_LIMIT', 16))
+
+# Define cache of login results, in seconds and entries
+auth_cache_ttl = int(os.environ.get('OOI_AUTH_CACHE_TTL', 60))
+auth_cache_size = int(os.environ.get('OOI_AUTH_CACHE_SIZE', 1024))
+
+# Define pool of pre-fetched dmm.com login page tokens, size 0 disables it
+login_token_pool = int(os.environ.get('OOI_LOGIN_TOKEN_POOL', 0))
+login_token_ttl = int(os.environ.get('OOI_LOGIN_TOKEN_TTL', 300))
+
+# Define cache of decrypted sessions used by the proxy routes, in seconds and entries, ttl 0 disables it
+session_cache_ttl = int(os.environ.get('OOI_SESSION_CACHE_TTL', 300))
+session_cache_size = int(os.environ.get('OOI_SESSION_CACHE_SIZE', 10000))
+
+# Define directory of caches shared by worker processes
+shared_dir = os.environ.get('OOI_SHARED_DIR', os.path.join(base_dir, '_shared'))
+
+# Define tier shared by the caches of game API responses and world banners: '' uses shared_dir with several
+# workers, 'memory' keeps it in one process and 'tcp://host:port' shares it between nodes through base.cacheserver
+# Requests to a cache server time out after cache_backend_timeout seconds, then it is skipped for cache_backend_retry
+cache_backend = os.environ.get('OOI_CACHE_BACKEND', '')
+cache_backend_timeout = float(os.environ.get('OOI_CACHE_BACKEND_TIMEOUT', 0.5))
+cache_backend_connections = int(os.environ.get('OOI_CACHE_BACKEND_CONNECTIONS', 8))
+cache_backend_retry = float(os.environ.get('OOI_CACHE_BACKEND_RETRY', 5))
+
+# Define event loop diagnostics, in seconds: heartbeat interval and lag recorded as a stall with the loop stack
+# Requests slower than diag_profile_threshold keep sampled stacks of the loop thread, 0 disables the profiler
+diag_enabled = bool(int(os.environ.get('OOI_DIAG', 1)))
+diag_interval = float(os.environ.get('OOI_DIAG_INTERVAL', 0.25))
+diag_stall_threshold = float(os.environ.get('OOI_DIAG_STALL_THRESHOLD', 0.1))
+diag_profile_threshold = float(os.environ.get('OOI_DIAG_PROFILE_THRESHOLD', 0))
+diag_profile_interval = float(os.environ.get('OOI_DIAG_PROFILE_INTERVAL', 0.005))
+
+# Define capture log of game API exchanges, written to rotated gzip JSON lines segments in capture_dir
+# Empty capture_actions captures every action; api_token is never written
+capture_enabled = bool(int(os.environ.get('OOI_CAPTURE', 0)))
+capture_dir = os.environ.get('OOI_CAPTURE_DIR', os.path.join(base_dir, '_capture'))
+capture_actions = json.loads(os.environ.get('OOI_CAPTURE_ACTIONS', '[]'))
+capture_queue_size = int(os.environ.get('OOI_CAPTURE_QUEUE_SIZE', 10000))
+capture_segment_size = int(os.environ.get('OOI_CAPTURE_SEGMENT_SIZE', 64 * 1024 * 1024))
+capture_segment_age = int(os.environ.get('OOI_CAPTURE_SEGMENT_AGE', 3600))
+capture_max_segments = int(os.environ.get('OOI_CAPTURE_MAX_SEGMENTS', 0))
+
+# Define warm-start snapshot of the game API response cache and world banners, saved every snapshot_interval
+# seconds and on shutdown, snapshots older than snapshot_max_age seconds are not loaded
+snapshot_enabled = bool(int(os.environ.get('OOI_SNAPSHOT', 1)))
+snapshot_path = os.environ.get('OOI_SNAPSHOT_PATH', os.path.join(base_dir, '_snapshot', 'caches.snapshot'))
+snapshot_interval = int(os.environ.get('OOI_SNAPSHOT_INTERVAL', 300))
+snapshot_max_age = int(os.environ.get('OOI_SNAPSHOT_MAX_AGE', 6 * 3600))
+
+# Define memory budget in bytes shared by all in-process caches on top of their own limits, 0 disables it
+cache_budget = int(os.environ.get('OOI_CACHE_BUDGET', 64 * 1024 * 1024))
+
+# Header holding the client address when OOI runs behind a trusted reverse proxy, e.g. X-Forwarded-For
+client_ip_header = os.environ.get('OOI_CLIENT_IP_HEADER', '')
+
+# Define admission control of the login entry points: token buckets for all clients and per client address,
+# the global rate shrinks with event loop lag and logins in flight, logins are shed once either reaches its maximum
+admission_enabled = bool(int(os.environ.get('OOI_ADMISSION', 1)))
+admission_rate = float(os.environ.get('OOI_ADMISSION_RATE', 20))
+admission_burst = int(os.environ.get('OOI_ADMISSION_BURST', 50))
+admission_client_rate = float(os.environ.get('OOI_ADMISSION_CLIENT_RATE', 0.2))
+admission_client_burst = int(os.environ.get('OOI_ADMISSION_CLIENT_BURST', 5))
+admission_max_clients = int(os.environ.get('OOI_ADMISSION_MAX_CLIENTS', 10000))
+# Per-client buckets need the real client address, behind a reverse proxy every player connects from the proxy's,
+# so they are only on with client_ip_header set; set OOI_ADMISSION_PER_CLIENT=1 when players connect directly
+admission_per_client = bool(int(os.environ.get('OOI_ADMISSION_PER_CLIENT', 1 if client_ip_header else 0)))
+admission_max_lag = float(os.environ.get('OOI_ADMISSION_MAX_LAG', 0.5))
+admission_max_inflight = int(os.environ.get('OOI_ADMISSION_MAX_INFLIGHT', login_concurrency + login_queue_size))
+admission_retry_after = int(os.environ.get('OOI_ADMISSION_RETRY_AFTER', 5))
+
+# Define listener of the admin endpoints /metrics and /diagnostics, worker processes listen on admin_port plus
+# their index; admin_port 0 disables it. With admin_token set, clients must send Authorization: Bearer <token>,
+# otherwise only clients connecting from the local host are served
+admin_host = os.environ.get('OOI_ADMIN_HOST', '127.0.0.1')
+admin_port = int(os.environ.get('OOI_ADMIN_PORT', 9990))
+admin_token = os.environ.get('OOI_ADMIN_TOKEN', '')
@@ -0,0 +1,202 @@
+"""OOI3 diagnostics - event loop lag, stalls of the loop thread and sampled profiles of slow requests
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+from base.metrics import LabelLimiter, registry
+
+loop_lag = registry.histogram('ooi_loop_lag_seconds', 'Delay of the event loop heartbeat',
+                              buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+handler_label = LabelLimiter(64)
+loop_stalls = registry.counter('ooi_loop_stalls_total', 'Event loop stalls by the handler running at the time',
+                               ('handler',))
+
+
+def _folded(frame, limit=48):
+    """ Collapse a stack into one line, outermost frame first
+
+    :param frame: frame
+    :param limit: int
+    :return: str
+    """
+    names = []
+    while frame is not None and len(names) < limit:
+        names.append('%s:%s' % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Diagnostics:
+    """This class watches the event loop from a helper thread
+    A heartbeat scheduled on the loop measures its lag; when the heartbeat is late by more than `threshold`
+    the thread records the stack of the loop thread and the handler running at the time.
+    With profiling on, the thread also samples the stack of the loop thread and keeps the samples
+    of requests slower than `profile_threshold`"""
+
+    def __init__(self, loop, interval=0.25, threshold=0.1, profile_threshold=0, profile_interval=0.005,
+                 max_events=50):
+        """ Init the monitor, call start() from the loop thread
+
+        :param loop: asyncio.AbstractEventLoop
+        :param interval: float seconds between heartbeats
+        :param threshold: float seconds of lag recorded as a stall
+        :param profile_threshold: float seconds above which a request profile is kept, 0 disables profiling
+        :param profile_interval: float seconds between stack samples
+        :param max_events: int stalls and profiles kept
+        :return: none
+        """
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.profile_threshold = profile_threshold
+        self.period = profile_interval if profile_threshold else threshold / 2
+        self.thread_id = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.handle = None
+
+        # Heartbeat, lag statistics and the stall waiting for its duration
+        self.heartbeat = time.monotonic()
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.pending = None
+
+        # Requests running on the loop, task => (handler, path, stack samples or None)
+        self.requests = {}
+        # Guards the stack samples, counted by the watchdog thread and read by the loop thread
+        self.samples_lock = threading.Lock()
+        self.stalls = deque(maxlen=max_events)
+        self.profiles = deque(maxlen=max_events)
+
+    def start(self):
+        """ Start the heartbeat and the watchdog thread
+
+        :return: none
+        """
+        self.thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.handle = self.loop.call_later(self.interval, self._beat)
+        self.thread = threading.Thread(target=self._watch, name='ooi-diagnostics', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the heartbeat and the watchdog thread
+
+        :return: none
+        """
+        self.stopped.set()
+        if self.handle is not None:
+            self.handle.cancel()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _beat(self):
+        now = time.monotonic()
+        lag = max(now - self.heartbeat - self.interval, 0.0)
+        self.heartbeat = now
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        loop_lag.observe((), lag)
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            pending['duration'] = lag
+        self.handle = self.loop.call_later(self.interval, self._beat)
+
+    def _current(self):
+        """ Return the request running on the loop thread, read from the watchdog thread
+
+        :return: tuple or None
+        """
+        task = asyncio.Task.current_task(loop=self.loop)
+        return self.requests.get(task) if task is not None else None
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.period):
+            frame = None
+            beat = self.heartbeat
+            if time.monotonic() - beat > self.interval + self.threshold and reported != beat:
+                reported = beat
+                frame = sys._current_frames().get(self.thread_id)
+                current = self._current()
+                handler = current[0] if current is not None else None
+                stall = {'time': time.time(),
+                         'duration': None,
+                         'handler': handler,
+                         'path': current[1] if current is not None else None,
+                         'stack': ''.join(traceback.format_stack(frame)) if frame is not None else ''}
+                self.stalls.append(stall)
+                self.pending = stall
+                loop_stalls.inc((handler_label(handler or 'none'),))
+
+            if self.profile_threshold:
+                current = self._current()
+                if current is not None and current[2] is not None:
+                    frame = frame or sys._current_frames().get(self.thread_id)
+                    if frame is not None:
+                        stack = _folded(frame)
+                        with self.samples_lock:
+                            current[2][stack] += 1
+
+    @asyncio.coroutine
+    def middleware(self, app, handler):
+        """ Middleware factory tracking which handler runs in which task
+
+        :param app: aiohttp.web.Application
+        :param handler: coroutine function
+        :return: coroutine function
+        """
+        @asyncio.coroutine
+        def track(request):
+            task = asyncio.Task.current_task(loop=self.loop)
+            match_handler = request.match_info.handler
+            name = getattr(match_handler, '__qualname__', None) or repr(match_handler)
+            samples = Counter() if self.profile_threshold else None
+            self.requests[task] = (name, request.path, samples)
+            started = time.monotonic()
+            try:
+                return (yield from handler(request))
+            finally:
+                self.requests.pop(task, None)
+                elapsed = time.monotonic() - started
+                if samples is not None and elapsed >= self.profile_threshold:
+                    with self.samples_lock:
+                        top = samples.most_common(20)
+                    self.profiles.append({'time': time.time(),
+                                          'duration': elapsed,
+                                          'handler': name,
+                                          'method': request.method,
+                                          'path': request.path,
+                                          'samples': top})
+        return track
+
+    def dump(self):
+        """ Render lag statistics, recent stalls and slow request profiles as text
+
+        :return: str
+        """
+        lines = ['Event loop lag: last %.1f ms, max %.1f ms, requests running %d' %
+                 (self.last_lag * 1000, self.max_lag * 1000, len(self.requests)),
+                 '',
+                 'Stalls over %.0f ms (%d kept):' % (self.threshold * 1000, len(self.stalls))]
+        for stall in list(self.stalls):
+            duration = '%.1f ms' % (stall['duration'] * 1000) if stall['duration'] is not None else 'ongoing'
+            lines.append('  %s %s in %s %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stall['time'])),
+                                               duration, stall['handler'], stall['path'] or ''))
+            lines.extend('    ' + line for line in stall['stack'].splitlines())
+        if self.profile_threshold:
+            lines.append('')
+            lines.append('Requests over %.0f ms, stack samples every %.1f ms (%d kept):' %
+                         (self.profile_threshold * 1000, self.period * 1000, len(self.profiles)))
+            for profile in list(self.profiles):
+                lines.append('  %s %.1f ms %s %s in %s' %
+                             (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(profile['time'])),
+                              profile['duration'] * 1000, profile['method'], profile['path'], profile['handler']))
+                lines.extend('    %5d %s' % (count, stack) for stack, count in profile['samples'])
+        return '\n'.join(lines) + '\n'
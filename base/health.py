@@ -0,0 +1,164 @@
+"""OOI3 upstream health - rolling statistics and a circuit breaker per game world
+"""
+
+import itertools
+import math
+import time
+from collections import deque
+
+# States of a circuit breaker
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling a world whose circuit breaker is open"""
+
+    def __init__(self, world_ip, retry_after):
+        super().__init__('World %s is unavailable, retry in %d seconds' % (world_ip, retry_after))
+        self.world_ip = world_ip
+        self.retry_after = retry_after
+
+
+class WorldHealth:
+    """This class keeps the outcome of recent calls to one world and the state of its breaker"""
+
+    def __init__(self, window, max_samples):
+        self.window = window
+        self.samples = deque(maxlen=max_samples)
+        self.errors = 0
+        self.latency = 0.0
+        self.state = CLOSED
+        self.opened = 0.0
+        self.cooldown = 0.0
+        # Token of the probe call let through in the half-open state, None while no probe is out
+        self.probe = None
+
+    def _expire(self, now):
+        while self.samples and (self.samples[0][0] < now - self.window or
+                                len(self.samples) == self.samples.maxlen):
+            _, ok, latency = self.samples.popleft()
+            self.errors -= not ok
+            self.latency -= latency
+
+    def add(self, now, ok, latency):
+        self._expire(now)
+        self.samples.append((now, ok, latency))
+        self.errors += not ok
+        self.latency += latency
+
+    def reset(self):
+        self.samples.clear()
+        self.errors = 0
+        self.latency = 0.0
+
+    def error_rate(self):
+        return self.errors / len(self.samples) if self.samples else 0.0
+
+    def mean_latency(self):
+        return self.latency / len(self.samples) if self.samples else 0.0
+
+
+class HealthTracker:
+    """This class decides whether a world may be called, a world failing too often is skipped for a while
+    After the cooldown one call is let through as a probe, its success closes the breaker again. Only the probe
+    decides, outcomes of calls that started before the breaker opened are not taken for the probe's"""
+
+    def __init__(self, window=60, min_calls=10, error_rate=0.5, cooldown=15, max_cooldown=120, max_samples=1000):
+        """ Init the tracker, the breaker of a world opens once `error_rate` of at least `min_calls`
+        calls in the last `window` seconds failed; every failed probe doubles the cooldown up to `max_cooldown`
+
+        :param window: int
+        :param min_calls: int
+        :param error_rate: float
+        :param cooldown: int
+        :param max_cooldown: int
+        :param max_samples: int
+        :return: none
+        """
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_samples = max_samples
+        self.worlds = {}
+        self.probes = itertools.count(1)
+
+    def _world(self, world_ip):
+        health = self.worlds.get(world_ip)
+        if health is None:
+            health = self.worlds[world_ip] = WorldHealth(self.window, self.max_samples)
+        return health
+
+    def _open(self, health, now, cooldown):
+        health.state = OPEN
+        health.opened = now
+        health.cooldown = cooldown
+        health.probe = None
+
+    def check(self, world_ip):
+        """ Raise UpstreamUnavailable unless a call to `world_ip` may go ahead
+        The probe call gets a token, which it passes back to record() or abandon()
+
+        :param world_ip: str
+        :return: int probe token, or None for an ordinary call
+        """
+        health = self._world(world_ip)
+        if health.state == CLOSED:
+            return None
+        now = time.monotonic()
+        if health.state == OPEN and now >= health.opened + health.cooldown:
+            health.state = HALF_OPEN
+        if health.state == HALF_OPEN and health.probe is None:
+            health.probe = next(self.probes)
+            return health.probe
+        raise UpstreamUnavailable(world_ip, max(int(math.ceil(health.opened + health.cooldown - now)), 1))
+
+    def abandon(self, world_ip, probe=None):
+        """ Forget a call that was cancelled before it had an outcome, so a probe can be sent again
+
+        :param world_ip: str
+        :param probe: int token returned by check()
+        :return: none
+        """
+        health = self._world(world_ip)
+        if probe is not None and health.state == HALF_OPEN and health.probe == probe:
+            health.probe = None
+
+    def record(self, world_ip, ok, latency, probe=None):
+        """ Record the outcome of a call to `world_ip`, only the probe holding the token closes or reopens
+        a half-open breaker
+
+        :param world_ip: str
+        :param ok: bool
+        :param latency: float
+        :param probe: int token returned by check()
+        :return: none
+        """
+        health = self._world(world_ip)
+        now = time.monotonic()
+        if probe is not None and health.state == HALF_OPEN and health.probe == probe:
+            if ok:
+                health.state = CLOSED
+                health.probe = None
+                health.reset()
+            else:
+                self._open(health, now, min(health.cooldown * 2, self.max_cooldown))
+            return
+        health.add(now, ok, latency)
+        if (health.state == CLOSED and len(health.samples) >= self.min_calls and
+                health.error_rate() >= self.error_rate):
+            self._open(health, now, self.cooldown)
+
+    def status(self):
+        """ Report the state, error rate and mean latency of every world called so far
+
+        :return: dict
+        """
+        return {world_ip: {'state': health.state,
+                           'calls': len(health.samples),
+                           'error_rate': health.error_rate(),
+                           'latency': health.mean_latency()}
+                for world_ip, health in self.worlds.items()}
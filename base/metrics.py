@@ -0,0 +1,277 @@
+"""OOI3 metrics - counters, gauges and histograms rendered in the Prometheus text format
+"""
+
+import aiohttp.web
+import asyncio
+import bisect
+import resource
+import sys
+import time
+
+# Default latency buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LabelLimiter:
+    """This class bounds the values of a label, values beyond the first `max_values` are reported as 'other'"""
+
+    def __init__(self, max_values, allowed=None):
+        """ Init the limiter, with `allowed` only those values are ever reported
+
+        :param max_values: int
+        :param allowed: iterable
+        :return: none
+        """
+        self.max_values = max_values
+        self.values = set(allowed) if allowed is not None else set()
+        self.fixed = allowed is not None
+
+    def __call__(self, value):
+        if value in self.values:
+            return value
+        if self.fixed or len(self.values) >= self.max_values:
+            return 'other'
+        self.values.add(value)
+        return value
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """This class counts events per label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, labels=(), value=1):
+        """ Add `value` to the counter of `labels`
+
+        :param labels: tuple
+        :param value: int or float
+        :return: none
+        """
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        # A copy, counters of writer threads may gain labels while they are rendered
+        for labels, value in list(self.values.items()):
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+class Gauge:
+    """This class reports a value read from a callback when metrics are collected
+    The callback returns a number, or a dict mapping label value tuples to numbers"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, func, labelnames=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        value = self.func()
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                yield self.name, _labels(self.labelnames, labels), v
+        else:
+            yield self.name, '', value
+
+
+class CounterFunc(Gauge):
+    """This class reports a total kept elsewhere, read from a callback like a gauge but only ever increasing"""
+
+    kind = 'counter'
+
+
+class Histogram:
+    """This class counts observations per label values into cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, labels, value):
+        """ Record one observation for `labels`
+
+        :param labels: tuple
+        :param value: float
+        :return: none
+        """
+        counts = self.values.get(labels)
+        if counts is None:
+            # One count per bucket plus +Inf, then the sum of all observations
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for labels, counts in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield self.name + '_bucket', _labels(self.labelnames, labels, ('le', bound)), total
+            yield self.name + '_count', _labels(self.labelnames, labels), total
+            yield self.name + '_sum', _labels(self.labelnames, labels), counts[-1]
+
+
+class Registry:
+    """This class holds all metrics of the process"""
+
+    def __init__(self):
+        self.metrics = []
+        # Label added to every sample, set to the worker index when several worker processes are running
+        self.constant = ''
+
+    def set_worker(self, worker):
+        """ Label every sample with the index of this worker process, so scrapes of the workers add up
+
+        :param worker: int
+        :return: none
+        """
+        self.constant = 'worker="%d"' % worker
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, func, labelnames=()):
+        return self._register(Gauge(name, help, func, labelnames))
+
+    def counter_func(self, name, help, func, labelnames=()):
+        return self._register(CounterFunc(name, help, func, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        """ Render all metrics in the Prometheus text exposition format
+
+        :return: str
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                if self.constant:
+                    labels = '{' + self.constant + (',' + labels[1:] if labels else '}')
+                lines.append('%s%s %s' % (name, labels, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process
+registry = Registry()
+
+
+class Stopwatch:
+    """This class measures the phases of a request"""
+
+    __slots__ = ('last',)
+
+    def __init__(self):
+        self.last = time.monotonic()
+
+    def lap(self):
+        """ Return the seconds since the previous lap
+
+        :return: float
+        """
+        now = time.monotonic()
+        elapsed, self.last = now - self.last, now
+        return elapsed
+
+
+def _process_cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _process_rss():
+    # Current resident size from /proc, the peak size reported by getrusage elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+registry.counter_func('ooi_process_cpu_seconds_total', 'User and system CPU time of this process', _process_cpu)
+registry.gauge('ooi_process_resident_memory_bytes', 'Resident memory of this process', _process_rss)
+
+# Metrics of every HTTP request, labelled by the route they matched
+UNMATCHED = 'unmatched'
+# Label of every route seen so far, route => label
+route_labels = {}
+http_requests = registry.counter('ooi_http_requests_total', 'HTTP requests by route and status',
+                                 ('route', 'status'))
+http_seconds = registry.histogram('ooi_http_request_seconds', 'HTTP request latency by route', ('route',))
+
+
+def route_label(request):
+    """ Label a request by the name or the path template of the route it matched
+    Requests matching no route share one label, so probes of made-up paths never take the place of real routes
+
+    :param request: aiohttp.web.Request
+    :return: str
+    """
+    match_info = request.match_info
+    if match_info.http_exception is not None:
+        return UNMATCHED
+    route = match_info.route
+    label = route_labels.get(route)
+    if label is None:
+        info = route.get_info()
+        label = route_labels[route] = (route.name or info.get('formatter') or info.get('path') or
+                                       info.get('prefix') or UNMATCHED)
+    return label
+
+
+@asyncio.coroutine
+def middleware(app, handler):
+    """ Middleware factory counting every request, static routes included
+
+    :param app: aiohttp.web.Application
+    :param handler: coroutine function
+    :return: coroutine function
+    """
+    @asyncio.coroutine
+    def count(request):
+        watch = Stopwatch()
+        route = route_label(request)
+        status = 500
+        try:
+            response = yield from handler(request)
+            status = response.status
+            return response
+        except aiohttp.web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            http_requests.inc((route, str(status)))
+            http_seconds.observe((route,), watch.lap())
+    return count
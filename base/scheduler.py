@@ -0,0 +1,164 @@
+"""OOI3 upstream scheduler - per-world and global limits on in-flight upstream calls, with fair queueing
+"""
+
+import asyncio
+import time
+from collections import deque, OrderedDict
+
+from base.health import UpstreamUnavailable
+from base.metrics import registry
+
+queue_seconds = registry.histogram('ooi_upstream_queue_seconds', 'Time upstream calls waited for a free slot')
+
+
+class UpstreamBusy(UpstreamUnavailable):
+    """Raised when a call waited too long for a free slot, or the queue is full"""
+
+    def __init__(self, world_ip, retry_after=1):
+        Exception.__init__(self, 'World %s is busy, retry in %d seconds' % (world_ip, retry_after))
+        self.world_ip = world_ip
+        self.retry_after = retry_after
+
+
+class UpstreamScheduler:
+    """This class bounds the calls in flight to every world and to all worlds together
+    Waiting calls are queued per world and per client and served round-robin,
+    so a client sending many requests at once only delays its own calls"""
+
+    def __init__(self, world_limit, global_limit, max_wait, max_waiting, loop=None):
+        """ Init the scheduler
+
+        :param world_limit: int calls in flight to one world
+        :param global_limit: int calls in flight to all worlds
+        :param max_wait: float seconds a call may wait for a slot
+        :param max_waiting: int calls that may wait at once
+        :param loop: asyncio.AbstractEventLoop
+        :return: none
+        """
+        self.world_limit = world_limit
+        self.global_limit = global_limit
+        self.max_wait = max_wait
+        self.max_waiting = max_waiting
+        self.loop = loop
+
+        # Calls in flight by world, waiting calls by world then client
+        self.running = {}
+        self.total = 0
+        self.queues = OrderedDict()
+        self.waiting = 0
+
+        # Statistics
+        self.queued = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+
+    def _free(self, world_ip):
+        return self.total < self.global_limit and self.running.get(world_ip, 0) < self.world_limit
+
+    def _take(self, world_ip):
+        self.running[world_ip] = self.running.get(world_ip, 0) + 1
+        self.total += 1
+
+    def _pop(self, world_ip):
+        """ Take the next waiting call of a world, clients take turns
+
+        :param world_ip: str
+        :return: asyncio.Future or None
+        """
+        clients = self.queues.get(world_ip)
+        while clients:
+            client, futures = next(iter(clients.items()))
+            future = futures.popleft()
+            if futures:
+                clients.move_to_end(client)
+            else:
+                del clients[client]
+            if not future.done():
+                return future
+        self.queues.pop(world_ip, None)
+        return None
+
+    def _wake(self):
+        """ Hand free slots to waiting calls, worlds take turns for the global slots
+
+        :return: none
+        """
+        progressed = True
+        while progressed and self.queues and self.total < self.global_limit:
+            progressed = False
+            for world_ip in list(self.queues):
+                if not self._free(world_ip):
+                    continue
+                future = self._pop(world_ip)
+                if future is None:
+                    continue
+                self._take(world_ip)
+                future.set_result(None)
+                progressed = True
+                if world_ip in self.queues:
+                    self.queues.move_to_end(world_ip)
+
+    @asyncio.coroutine
+    def acquire(self, world_ip, client):
+        """ Wait for a slot to call `world_ip`, release() must be called once the call is over
+
+        :param world_ip: str
+        :param client: hashable identifying the client, e.g. its API token
+        :return: none
+        :raise UpstreamBusy: when no slot was free within max_wait or too many calls are waiting
+        """
+        if self._free(world_ip) and world_ip not in self.queues:
+            self._take(world_ip)
+            return
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise UpstreamBusy(world_ip)
+
+        future = asyncio.Future(loop=self.loop)
+        self.queues.setdefault(world_ip, OrderedDict()).setdefault(client, deque()).append(future)
+        self.waiting += 1
+        self.queued += 1
+        started = time.monotonic()
+        # The queue may only hold calls that gave up already
+        self._wake()
+        try:
+            yield from asyncio.wait_for(future, self.max_wait, loop=self.loop)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # The slot may have been handed over just before the timeout or the cancellation
+            if future.done() and not future.cancelled():
+                self.release(world_ip)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+                raise UpstreamBusy(world_ip)
+            raise
+        finally:
+            self.waiting -= 1
+            elapsed = time.monotonic() - started
+            self.wait_time += elapsed
+            queue_seconds.observe((), elapsed)
+
+    def release(self, world_ip):
+        """ Give back the slot of a finished call
+
+        :param world_ip: str
+        :return: none
+        """
+        self.running[world_ip] -= 1
+        self.total -= 1
+        self._wake()
+
+    def status(self):
+        """ Report calls in flight and waiting by world, and queueing statistics
+
+        :return: dict
+        """
+        return {'running': self.total,
+                'waiting': self.waiting,
+                'worlds': {world_ip: {'running': self.running.get(world_ip, 0),
+                                      'waiting': sum(len(f) for f in self.queues.get(world_ip, {}).values())}
+                           for world_ip in set(self.running) | set(self.queues)},
+                'queued': self.queued,
+                'timeouts': self.timeouts,
+                'rejected': self.rejected,
+                'mean_wait': self.wait_time / self.queued if self.queued else 0.0}
@@ -0,0 +1,164 @@
+"""OOI3 serving helpers - responses for cache-backed bodies and files
+"""
+
+import aiohttp
+import aiohttp.web
+import asyncio
+import gzip
+import os
+import zlib
+
+from base import config
+
+# Content codings offered to clients, in order of preference
+ENCODINGS = ('gzip', 'deflate')
+
+
+@asyncio.coroutine
+def send_body(request, body, headers=None, status=200):
+    """ Send a bytes-like body, unlike aiohttp.web.Response this accepts memoryviews over shared maps
+    `headers` is only read, cached entries pass the headers they were built with.
+    The HTTP writer of aiohttp only takes bytes, memoryviews are copied once into the response here
+
+    :param request: aiohttp.web.Request
+    :param body: bytes or memoryview
+    :param headers: dict
+    :param status: int
+    :return: aiohttp.web.StreamResponse
+    """
+    if not config.zero_copy:
+        return aiohttp.web.Response(body=bytes(body), headers=headers, status=status)
+    resp = aiohttp.web.StreamResponse(status=status, headers=headers)
+    resp.content_length = len(body)
+    yield from resp.prepare(request)
+    resp.write(body if isinstance(body, (bytes, bytearray)) else bytes(body))
+    yield from resp.write_eof()
+    return resp
+
+
+def accepted_encoding(request):
+    """ Pick the content coding of a response from the Accept-Encoding header of the request
+
+    :param request: aiohttp.web.Request
+    :return: str 'gzip', 'deflate' or None for identity
+    """
+    accepted = {}
+    for item in request.headers.get(aiohttp.hdrs.ACCEPT_ENCODING, '').split(','):
+        name, _, params = item.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+@asyncio.coroutine
+def compress(body, encoding, level=6, loop=None):
+    """ Compress a body in a worker thread, keeping the event loop free
+
+    :param body: bytes or memoryview
+    :param encoding: str 'gzip' or 'deflate'
+    :param level: int
+    :param loop: asyncio.AbstractEventLoop
+    :return: bytes
+    """
+    loop = loop or asyncio.get_event_loop()
+    func = gzip.compress if encoding == 'gzip' else zlib.compress
+    return (yield from loop.run_in_executor(None, func, body, level))
+
+
+# Bytes sent through the transport while waiting for a full socket between two sendfile calls
+WAIT_CHUNK_SIZE = 16384
+
+
+class FileTruncated(Exception):
+    """Raised when a file ends before the Content-Length announced for it was sent"""
+
+
+@asyncio.coroutine
+def _send_chunks(resp, f, offset, count, chunk_size):
+    f.seek(offset)
+    while count > 0:
+        chunk = f.read(min(chunk_size, count))
+        if not chunk:
+            raise FileTruncated('%d bytes missing at offset %d' % (count, f.tell()))
+        resp.write(chunk)
+        yield from resp.drain()
+        count -= len(chunk)
+
+
+def _sendfile(out_fd, in_fd, offset, count):
+    """ Send what the socket takes of `count` bytes of a file without blocking
+
+    :param out_fd: int
+    :param in_fd: int
+    :param offset: int
+    :param count: int
+    :return: int bytes sent, 0 when the socket buffer is full
+    :raise FileTruncated: when the file ends at `offset`
+    """
+    try:
+        n = os.sendfile(out_fd, in_fd, offset, count)
+    except (BlockingIOError, InterruptedError):
+        return 0
+    if n == 0:
+        # The file shrank after the headers were sent
+        raise FileTruncated('%d bytes missing at offset %d' % (count, offset))
+    return n
+
+
+@asyncio.coroutine
+def send_file(request, resp, f, offset, count, chunk_size=262144):
+    """ Write `count` bytes of the open file `f` from `offset` after the prepared headers of `resp`
+    The sendfile system call is used where available, TLS connections fall back to chunked reads.
+    A file shorter than `count` closes the connection, so the client never waits for the missing bytes
+
+    :param request: aiohttp.web.Request
+    :param resp: aiohttp.web.StreamResponse
+    :param f: file object
+    :param offset: int
+    :param count: int
+    :param chunk_size: int
+    :return: none
+    :raise FileTruncated: when the file ends early
+    """
+    try:
+        yield from _send_file(request, resp, f, offset, count, chunk_size)
+    except FileTruncated:
+        request.transport.close()
+        raise
+
+
+@asyncio.coroutine
+def _send_file(request, resp, f, offset, count, chunk_size):
+    transport = request.transport
+    if not config.zero_copy or not hasattr(os, 'sendfile') or transport.get_extra_info('sslcontext'):
+        yield from _send_chunks(resp, f, offset, count, chunk_size)
+        return
+
+    out_fd = transport.get_extra_info('socket').fileno()
+    in_fd = f.fileno()
+    # The transport owns the socket, so the loop cannot wait on it for sendfile. With no buffer allowed drain()
+    # returns once everything written through the transport is sent: first the headers written by aiohttp,
+    # which must reach the socket before the file does, then a small chunk sent instead each time the socket is full
+    transport.set_write_buffer_limits(0)
+    try:
+        yield from resp.drain()
+        while count > 0:
+            n = _sendfile(out_fd, in_fd, offset, count)
+            offset += n
+            count -= n
+            if count > 0:
+                n = min(count, WAIT_CHUNK_SIZE)
+                yield from _send_chunks(resp, f, offset, n, n)
+                offset += n
+                count -= n
+    finally:
+        transport.set_write_buffer_limits()
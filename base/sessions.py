@@ -0,0 +1,69 @@
+"""OOI3 session cache - decrypted session fields of the proxy routes, keyed by the session cookie
+"""
+
+import asyncio
+import time
+from collections import namedtuple
+from aiohttp_session import get_session
+
+from base.budget import budget
+from base.cache import LRUCache
+
+# Session fields read by the proxy routes
+SessionInfo = namedtuple('SessionInfo', ['world_ip', 'api_token', 'expires'])
+
+# Approximate memory held by one entry with its cookie key, in bytes
+ENTRY_SIZE = 1024
+
+
+class SessionCache:
+    """This class remembers the session behind a cookie value, so repeated game API calls skip decrypting it
+    A cookie value is immutable, any change to the session makes the browser send a new one"""
+
+    def __init__(self, storage, ttl, max_entries):
+        """ Init an empty cache for the cookies of `storage`, a ttl of 0 disables the cache
+
+        :param storage: aiohttp_session.AbstractStorage
+        :param ttl: int
+        :param max_entries: int
+        :return: none
+        """
+        self.cookie_name = storage.cookie_name
+        self.ttl = ttl
+        if storage.max_age:
+            self.ttl = min(self.ttl, storage.max_age)
+        self.entries = LRUCache(0, sizeof=lambda info: ENTRY_SIZE, max_entries=max_entries,
+                                expired=lambda info: info.expires < time.time(),
+                                name='session', cost=30, budget=budget)
+
+    @asyncio.coroutine
+    def get(self, request):
+        """ Return the proxy fields of the session of `request`, decrypting the cookie only on a miss
+
+        :param request: aiohttp.web.Request
+        :return: SessionInfo
+        """
+        cookie = request.cookies.get(self.cookie_name)
+        if cookie is not None:
+            info = self.entries.get(cookie)
+            if info is not None:
+                return info
+
+        session = yield from get_session(request)
+        info = SessionInfo(world_ip=session.get('world_ip'),
+                           api_token=session.get('api_token'),
+                           expires=time.time() + self.ttl)
+        # Only sessions of logged in players are worth remembering
+        if cookie is not None and info.world_ip and self.ttl > 0:
+            self.entries.set(cookie, info)
+        return info
+
+    def discard(self, request):
+        """ Forget the session of `request`, called when the session is cleared or replaced
+
+        :param request: aiohttp.web.Request
+        :return: none
+        """
+        cookie = request.cookies.get(self.cookie_name)
+        if cookie is not None:
+            self.entries.discard(cookie)
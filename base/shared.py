@@ -0,0 +1,147 @@
+"""OOI3 shared store - immutable blobs in memory-mapped files shared by all worker processes
+"""
+
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from base.backends import CacheBackend, SharedBlob
+
+
+class SharedStore(CacheBackend):
+    """This class keeps cached blobs on disk so every worker maps the same pages instead of holding a copy
+    Blob bodies are read-only memoryviews over the mapped files"""
+
+    # File header: magic, expiry timestamp (0 never expires), length of the JSON meta, length of the body
+    header = struct.Struct('!4sdII')
+    magic = b'OOI1'
+
+    def __init__(self, directory, lock_timeout=30, loop=None):
+        """ Init the store in `directory`, which is created if missing
+
+        :param directory: str
+        :param lock_timeout: int
+        :param loop: asyncio.AbstractEventLoop
+        :return: none
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock_timeout = lock_timeout
+        self.loop = loop
+
+        # Files mapped by this process, path => (file identity, blob)
+        self.maps = {}
+
+    def _path(self, key):
+        """ Map a key to its file name
+
+        :param key: str
+        :return: str
+        """
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    @asyncio.coroutine
+    def get(self, key):
+        """ Return the blob of `key`, mapping its file once per version of the file
+
+        :param key: str
+        :return: SharedBlob or None
+        """
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.maps.pop(path, None)
+            return None
+
+        identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = self.maps.get(path)
+        if cached is None or cached[0] != identity:
+            if st.st_size < self.header.size:
+                return None
+            with open(path, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, expires, meta_length, body_length = self.header.unpack_from(m)
+            if magic != self.magic or self.header.size + meta_length + body_length != len(m):
+                return None
+            view = memoryview(m)
+            meta = json.loads(bytes(view[self.header.size:self.header.size + meta_length]).decode())
+            blob = SharedBlob(body=view[self.header.size + meta_length:], meta=meta, expires=expires)
+            cached = (identity, blob)
+            self.maps[path] = cached
+
+        blob = cached[1]
+        if blob.expires and blob.expires < time.time():
+            return None
+        return blob
+
+    @asyncio.coroutine
+    def set(self, key, body, meta=None, ttl=0):
+        """ Store `body` under `key`, readers never see a partially written file
+
+        :param key: str
+        :param body: bytes
+        :param meta: dict
+        :param ttl: int
+        :return: SharedBlob
+        """
+        meta = json.dumps(meta or {}).encode()
+        expires = time.time() + ttl if ttl else 0
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.header.pack(self.magic, expires, len(meta), len(body)))
+                f.write(meta)
+                f.write(body)
+            os.replace(tmp, self._path(key))
+        except Exception:
+            os.remove(tmp)
+            raise
+        return (yield from self.get(key))
+
+    @asyncio.coroutine
+    def lock(self, key):
+        """ Try to become the only process filling `key`, locks of crashed workers go stale after `lock_timeout`
+
+        :param key: str
+        :return: bool
+        """
+        path = self._path(key) + '.lock'
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if os.stat(path).st_mtime + self.lock_timeout > time.time():
+                    return False
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return (yield from self.lock(key))
+        os.close(fd)
+        return True
+
+    @asyncio.coroutine
+    def unlock(self, key):
+        """ Release the lock of `key`
+
+        :param key: str
+        :return: none
+        """
+        try:
+            os.remove(self._path(key) + '.lock')
+        except FileNotFoundError:
+            pass
+
+    @asyncio.coroutine
+    def locked(self, key):
+        """ Check whether another process is filling `key`
+
+        :param key: str
+        :return: bool
+        """
+        return os.path.exists(self._path(key) + '.lock')
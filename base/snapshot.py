@@ -0,0 +1,202 @@
+"""OOI3 snapshot - in-memory caches written to disk periodically and on shutdown, mapped back at startup
+"""
+
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot file is corrupt, stale or of another format version"""
+
+
+class Snapshot:
+    """This class saves the entries of registered caches into one checksummed file and restores them
+    Every cache registers a dump function returning (key, meta, blobs) records and a restore function
+    taking them back. Restored blobs are read-only memoryviews over the mapped file, so loading copies nothing"""
+
+    # File header: magic, format version, creation timestamp, length of the JSON index, length of all blobs,
+    # SHA-256 of the index and the blobs
+    header = struct.Struct('!4sHdIQ32s')
+    magic = b'OOIS'
+    version = 1
+
+    def __init__(self, path, interval=300, max_age=21600, loop=None):
+        """ Init the snapshot, nothing is read before load()
+
+        :param path: str
+        :param interval: int seconds between periodic saves
+        :param max_age: int seconds after which a snapshot is too old to be loaded
+        :param loop: asyncio.AbstractEventLoop
+        :return: none
+        """
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.loop = loop
+        self.caches = {}
+        self.task = None
+
+    def register(self, name, dump, restore):
+        """ Add a cache to the snapshot
+
+        :param name: str
+        :param dump: function returning a list of (key, meta, blobs), keys and meta must be JSON serializable
+                     and blobs is a list of bytes-like objects or None
+        :param restore: function taking a list of (key, meta, blobs) with blobs as memoryviews or None
+        :return: none
+        """
+        self.caches[name] = (dump, restore)
+
+    def _collect(self):
+        """ Dump every registered cache, the blobs are referenced and not copied
+
+        :return: dict name => list of (key, meta, blobs)
+        """
+        return {name: list(dump()) for name, (dump, _) in self.caches.items()}
+
+    def _write(self, records):
+        """ Write a snapshot file atomically, readers never see a partially written file
+
+        :param records: dict name => list of (key, meta, blobs)
+        :return: int bytes written
+        """
+        index = {}
+        blobs = []
+        offset = 0
+        for name, items in records.items():
+            entries = index[name] = []
+            for key, meta, values in items:
+                spans = []
+                for value in values:
+                    if value is None:
+                        spans.append(None)
+                        continue
+                    spans.append((offset, len(value)))
+                    blobs.append(value)
+                    offset += len(value)
+                entries.append((key, meta, spans))
+        index = json.dumps(index, separators=(',', ':')).encode()
+
+        digest = hashlib.sha256(index)
+        for blob in blobs:
+            digest.update(blob)
+        head = self.header.pack(self.magic, self.version, time.time(), len(index), offset, digest.digest())
+
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(head)
+                f.write(index)
+                for blob in blobs:
+                    f.write(blob)
+            os.replace(tmp, self.path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        return self.header.size + len(index) + offset
+
+    def save(self):
+        """ Write the snapshot from the calling thread, used on shutdown
+
+        :return: int bytes written
+        """
+        return self._write(self._collect())
+
+    @asyncio.coroutine
+    def save_async(self):
+        """ Dump the caches in the loop thread and write the file in a worker thread
+
+        :return: int bytes written
+        """
+        records = self._collect()
+        loop = self.loop or asyncio.get_event_loop()
+        return (yield from loop.run_in_executor(None, self._write, records))
+
+    def _map(self):
+        """ Map and validate the snapshot file
+
+        :return: tuple (index, blobs memoryview)
+        :raise SnapshotError: when the file is truncated, corrupt, stale or of another version
+        """
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.header.size:
+                raise SnapshotError('Snapshot is truncated')
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, created, index_length, blobs_length, checksum = self.header.unpack_from(m)
+        if magic != self.magic:
+            raise SnapshotError('Not a snapshot file')
+        if version != self.version:
+            raise SnapshotError('Snapshot format version %d, expected %d' % (version, self.version))
+        if time.time() - created > self.max_age:
+            raise SnapshotError('Snapshot is %d seconds old' % (time.time() - created))
+        if self.header.size + index_length + blobs_length != size:
+            raise SnapshotError('Snapshot is truncated')
+        view = memoryview(m)[self.header.size:]
+        if hashlib.sha256(view).digest() != checksum:
+            raise SnapshotError('Snapshot checksum mismatch')
+        index = json.loads(bytes(view[:index_length]).decode())
+        return index, view[index_length:]
+
+    def load(self):
+        """ Restore the registered caches from the snapshot file, a missing or invalid file is ignored
+
+        :return: int records restored
+        """
+        try:
+            index, blobs = self._map()
+        except FileNotFoundError:
+            return 0
+        except (SnapshotError, ValueError, OSError) as e:
+            print('Snapshot %s rejected: %s' % (self.path, e))
+            return 0
+
+        restored = 0
+        for name, items in index.items():
+            cache = self.caches.get(name)
+            if cache is None:
+                continue
+            records = [(key, meta, [blobs[span[0]:span[0] + span[1]] if span is not None else None
+                                    for span in spans])
+                       for key, meta, spans in items]
+            cache[1](records)
+            restored += len(records)
+        return restored
+
+    @asyncio.coroutine
+    def _run(self):
+        while True:
+            yield from asyncio.sleep(self.interval, loop=self.loop)
+            try:
+                yield from self.save_async()
+            except Exception as e:
+                print('Snapshot %s not saved: %s' % (self.path, e))
+
+    def start(self):
+        """ Start saving the snapshot every `interval` seconds
+
+        :return: none
+        """
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run(), loop=self.loop)
+
+    def close(self):
+        """ Stop the periodic saves and write a last snapshot
+
+        :return: none
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        try:
+            self.save()
+        except Exception as e:
+            print('Snapshot %s not saved: %s' % (self.path, e))
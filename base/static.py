@@ -0,0 +1,224 @@
+"""OOI3 static pipeline - fingerprinted, pre-compressed copies of the files under static_dir
+Templates call static_url() for single files and static_tags() for bundles of CSS or JS files
+"""
+
+import aiohttp
+import aiohttp.web
+import ast
+import asyncio
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import tempfile
+from jinja2 import Markup
+
+from base import config
+from base.serving import accepted_encoding, send_file
+
+
+class StaticPipeline:
+    """This class builds content-addressed copies of static files and serves them as immutable"""
+
+    # Files worth a gzip variant, the other formats are compressed already
+    compressible = ('.css', '.js', '.svg', '.ttf', '.otf', '.eot', '.ico', '.json', '.txt')
+
+    # static_tags() calls in templates, the bundles they name are built at startup
+    tags_pattern = re.compile(r'static_tags\(([^)]*)\)')
+
+    # url() references in CSS files
+    url_pattern = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+    suffix_pattern = re.compile(r'([^?#]*)(.*)$')
+
+    tag_formats = {'css': '<link href="%s" rel="stylesheet">',
+                   'js': '<script src="%s"></script>'}
+
+    def __init__(self, source=None, target=None, prefix='/static/build/', enabled=None):
+        """ Init the pipeline, nothing is written before build() or the first URL lookup
+        When disabled, URLs point at the original files and bundles are emitted as one tag per file
+
+        :param source: str
+        :param target: str
+        :param prefix: str
+        :param enabled: bool
+        :return: none
+        """
+        self.source = os.path.abspath(source or config.static_dir)
+        self.target = os.path.abspath(target or config.static_build_dir)
+        self.prefix = prefix
+        self.enabled = config.static_pipeline if enabled is None else enabled
+
+        # Source path or bundle key => built name, built name => (path, content type, gzip path or None)
+        self.manifest = {}
+        self.files = {}
+
+    def _write(self, relpath, data):
+        """ Write `data` under a name carrying its digest, with a gzip variant when it pays off
+
+        :param relpath: str
+        :param data: bytes
+        :return: str built name
+        """
+        root, ext = posixpath.splitext(relpath)
+        name = '%s.%s%s' % (root, hashlib.md5(data).hexdigest()[:12], ext)
+        path = os.path.join(self.target, *name.split('/'))
+        variants = [(path, data)]
+        if ext in self.compressible:
+            compressed = gzip.compress(data, 9)
+            if len(compressed) < len(data) * 0.9:
+                variants.append((path + '.gz', compressed))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for variant, content in variants:
+            # Same name, same content: files of an earlier build or another worker are kept as they are
+            if os.path.exists(variant):
+                continue
+            fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, variant)
+
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=utf-8'
+        self.files[name] = (path, content_type, path + '.gz' if len(variants) > 1 else None)
+        return name
+
+    def _rewrite_css(self, relpath, data):
+        """ Point the relative url() references of a CSS file at the fingerprinted files
+
+        :param relpath: str
+        :param data: bytes
+        :return: bytes
+        """
+        def rewrite(m):
+            ref = m.group(2).strip()
+            if ref.startswith(('data:', '/', '#')) or '://' in ref:
+                return m.group(0)
+            path, suffix = self.suffix_pattern.match(ref).groups()
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(relpath), path))
+            if not os.path.isfile(os.path.join(self.source, *target.split('/'))):
+                return m.group(0)
+            return 'url(%s%s)' % (self.url(target), suffix)
+
+        return self.url_pattern.sub(rewrite, data.decode('utf-8')).encode('utf-8')
+
+    def _read(self, relpath):
+        """ Read a source file, CSS files get their references rewritten
+
+        :param relpath: str
+        :return: bytes
+        """
+        with open(os.path.join(self.source, *relpath.split('/')), 'rb') as f:
+            data = f.read()
+        if relpath.endswith('.css'):
+            data = self._rewrite_css(relpath, data)
+        return data
+
+    def url(self, relpath):
+        """ Return the URL of a static file, fingerprinted unless the pipeline is disabled
+
+        :param relpath: str path under static_dir, e.g. img/logo.png
+        :return: str
+        """
+        if not self.enabled:
+            return '/static/' + relpath
+        name = self.manifest.get(relpath)
+        if name is None:
+            try:
+                name = self._write(relpath, self._read(relpath))
+            except FileNotFoundError:
+                return '/static/' + relpath
+            self.manifest[relpath] = name
+        return self.prefix + name
+
+    def bundle(self, kind, *relpaths):
+        """ Return the URL of the concatenation of `relpaths`
+
+        :param kind: str 'css' or 'js'
+        :return: str
+        """
+        key = kind + ':' + '+'.join(relpaths)
+        name = self.manifest.get(key)
+        if name is None:
+            separator = b'\n' if kind == 'css' else b'\n;\n'
+            data = separator.join(self._read(relpath) for relpath in relpaths)
+            name = self._write('bundle/%s.%s' % (kind, kind), data)
+            self.manifest[key] = name
+        return self.prefix + name
+
+    def tags(self, kind, *relpaths):
+        """ Template helper emitting the tags of a CSS or JS bundle
+
+        :param kind: str 'css' or 'js'
+        :return: jinja2.Markup
+        """
+        tag = self.tag_formats[kind]
+        if not self.enabled:
+            return Markup('\n'.join(tag % self.url(relpath) for relpath in relpaths))
+        return Markup(tag % self.bundle(kind, *relpaths))
+
+    def build(self, template_dir=None):
+        """ Fingerprint every static file and build the bundles named in templates, then write the manifest
+
+        :param template_dir: str
+        :return: dict
+        """
+        if not self.enabled:
+            return self.manifest
+        for root, _, names in os.walk(self.source):
+            for name in sorted(names):
+                if not name.startswith('.'):
+                    relpath = os.path.relpath(os.path.join(root, name), self.source)
+                    self.url(relpath.replace(os.sep, '/'))
+
+        template_dir = template_dir or config.template_dir
+        for name in sorted(os.listdir(template_dir)):
+            with open(os.path.join(template_dir, name), encoding='utf-8') as f:
+                for m in self.tags_pattern.finditer(f.read()):
+                    args = ast.literal_eval('(%s,)' % m.group(1))
+                    self.bundle(*args)
+
+        os.makedirs(self.target, exist_ok=True)
+        with open(os.path.join(self.target, 'manifest.json'), 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        return self.manifest
+
+    @asyncio.coroutine
+    def serve(self, request):
+        """ Serve a built file, the gzip variant goes to clients accepting it
+
+        :param request: aiohttp.web.Request
+        :return: aiohttp.web.StreamResponse or aiohttp.web.HTTPNotFound
+        """
+        entry = self.files.get(request.match_info['path'])
+        if entry is None:
+            return aiohttp.web.HTTPNotFound()
+        path, content_type, gzip_path = entry
+
+        resp = aiohttp.web.StreamResponse()
+        resp.headers[aiohttp.hdrs.CONTENT_TYPE] = content_type
+        resp.headers[aiohttp.hdrs.CACHE_CONTROL] = 'public, max-age=31536000, immutable'
+        if gzip_path is not None:
+            resp.headers[aiohttp.hdrs.VARY] = aiohttp.hdrs.ACCEPT_ENCODING
+            if accepted_encoding(request) == 'gzip':
+                path = gzip_path
+                resp.headers[aiohttp.hdrs.CONTENT_ENCODING] = 'gzip'
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return aiohttp.web.HTTPNotFound()
+        with f:
+            resp.content_length = os.fstat(f.fileno()).st_size
+            yield from resp.prepare(request)
+            yield from send_file(request, resp, f, 0, resp.content_length)
+        return resp
+
+
+if __name__ == '__main__':
+    # Build ahead of deployment: python -m base.static
+    print(json.dumps(StaticPipeline(enabled=True).build(), indent=2, sort_keys=True))
@@ -0,0 +1,108 @@
+"""OOI3 upstream pool - keep-alive connections to game world servers
+"""
+
+import aiohttp
+import asyncio
+import time
+
+from base import config
+from base.health import HealthTracker
+
+
+class UpstreamPool:
+    """This class keeps a long-lived connection pool for every game world, shared by all proxied requests"""
+
+    def __init__(self, limit=None, keepalive_timeout=None, loop=None):
+        """ Init the upstream pool, connectors are created lazily on first use of a world
+
+        :param limit: int
+        :param keepalive_timeout: int
+        :param loop: asyncio.AbstractEventLoop
+        :return: none
+        """
+        self.limit = limit or config.upstream_pool_limit
+        self.keepalive_timeout = keepalive_timeout or config.upstream_keepalive
+        self.loop = loop
+        self.connectors = {}
+
+        # Calls to a failing world fail fast until its circuit breaker closes again
+        self.health = HealthTracker(window=config.breaker_window, min_calls=config.breaker_min_calls,
+                                    error_rate=config.breaker_error_rate, cooldown=config.breaker_cooldown)
+
+    def connector(self, world_ip):
+        """ Return the keep-alive connector of a world, idle connections are evicted after `keepalive_timeout`
+
+        :param world_ip: str
+        :return: aiohttp.TCPConnector
+        """
+        connector = self.connectors.get(world_ip)
+        if connector is None or connector.closed:
+            if config.proxy:
+                connector = aiohttp.ProxyConnector(proxy=config.proxy, force_close=False, limit=self.limit,
+                                                   keepalive_timeout=self.keepalive_timeout, loop=self.loop)
+            else:
+                connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive_timeout,
+                                                 loop=self.loop)
+            self.connectors[world_ip] = connector
+        return connector
+
+    @asyncio.coroutine
+    def request(self, method, world_ip, path, timeout=5, **kwargs):
+        """ Send a request to a world server over its pooled connections
+        A throwaway client session is used for every request, so cookies never leak between users
+        Errors, timeouts and 5xx responses count against the health of the world
+
+        :param method: str
+        :param world_ip: str
+        :param path: str
+        :param timeout: int
+        :return: aiohttp.ClientResponse
+        :raise base.health.UpstreamUnavailable: while the circuit breaker of the world is open
+        """
+        probe = self.health.check(world_ip)
+        started = time.monotonic()
+        session = aiohttp.ClientSession(connector=self.connector(world_ip), loop=self.loop)
+        try:
+            response = yield from asyncio.wait_for(session.request(method, 'http://' + world_ip + path, **kwargs),
+                                                   timeout, loop=self.loop)
+        except asyncio.CancelledError:
+            self.health.abandon(world_ip, probe)
+            raise
+        except Exception:
+            self.health.record(world_ip, False, time.monotonic() - started, probe)
+            raise
+        finally:
+            session.detach()
+        self.health.record(world_ip, response.status < 500, time.monotonic() - started, probe)
+        return response
+
+    @asyncio.coroutine
+    def _warm(self, world_ip):
+        """ Open one keep-alive connection to a world and put it back into the pool
+
+        :param world_ip: str
+        :return: none
+        """
+        response = yield from self.request('HEAD', world_ip, '/', timeout=10)
+        yield from response.release()
+
+    @asyncio.coroutine
+    def prewarm(self, world_ips, connections=1):
+        """ Open `connections` keep-alive connections to every world in `world_ips`
+        Failures are ignored, the pool simply stays cold for that world
+
+        :param world_ips: iterable
+        :param connections: int
+        :return: none
+        """
+        coros = [self._warm(world_ip) for world_ip in world_ips for _ in range(connections)]
+        yield from asyncio.gather(*coros, loop=self.loop, return_exceptions=True)
+
+    def close(self):
+        """ Close all pooled connections
+
+        :return: none
+        """
+        for connector in self.connectors.values():
+            connector.close()
+        self.connectors.clear()
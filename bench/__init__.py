@@ -0,0 +1,2 @@
+"""OOI3 benchmark suite, runs without network access against local stand-ins for dmm.com and the game worlds
+"""
@@ -0,0 +1,213 @@
+"""Local stand-ins for dmm.com, osapi.dmm.com and the game world servers
+The routes follow the URL shapes of auth.kancolle.KancolleAuth.urls, with every host mapped to a local port
+"""
+
+import aiohttp.web
+import asyncio
+import binascii
+import json
+import os
+import random
+import signal
+import time
+from collections import namedtuple
+
+# Latency in seconds and payload sizes in bytes of the fake servers
+FakeOptions = namedtuple('FakeOptions', ['dmm_latency', 'world_latency', 'login_page_size', 'api_size',
+                                         'start2_size', 'asset_size', 'banner_size'])
+
+# Prefix of osapi makeRequest responses and of game API responses
+MAKE_REQUEST_PREFIX = "throw 1; < don't be evil' >"
+SVDATA_PREFIX = 'svdata='
+
+
+# Hosts of KancolleAuth.urls played by the fake dmm.com, URLs on world servers are left alone
+DMM_HOSTS = ('https://www.dmm.com', 'http://www.dmm.com', 'http://osapi.dmm.com', 'http://203.104.209.7')
+
+
+def local_urls(urls, dmm_host):
+    """ Map the dmm.com URLs of KancolleAuth.urls to the fake dmm.com, paths are kept as they are
+
+    :param urls: dict
+    :param dmm_host: str host:port of the fake dmm.com
+    :return: dict
+    """
+    local = {}
+    for name, url in urls.items():
+        for host in DMM_HOSTS:
+            if url.startswith(host + '/'):
+                url = 'http://' + dmm_host + url[len(host):]
+                break
+        local[name] = url
+    return local
+
+
+def _padding(size):
+    return 'x' * max(size, 0)
+
+
+def _hex(size):
+    return binascii.hexlify(os.urandom(size)).decode()
+
+
+class FakeDMM:
+    """This class plays dmm.com, osapi.dmm.com and the world list server"""
+
+    def __init__(self, options, worlds):
+        """ Init the fake with the number of game worlds it hands out
+
+        :param options: FakeOptions
+        :param worlds: int
+        :return: none
+        """
+        self.options = options
+        self.worlds = worlds
+
+    @asyncio.coroutine
+    def _delay(self):
+        if self.options.dmm_latency:
+            yield from asyncio.sleep(self.options.dmm_latency)
+
+    def _html(self, text):
+        return aiohttp.web.Response(body=text.encode(), headers={'Content-Type': 'text/html; charset=utf-8'})
+
+    @asyncio.coroutine
+    def login(self, request):
+        yield from self._delay()
+        tokens = '"DMM_TOKEN", "%s"\n"token": "%s"\n' % (_hex(16), _hex(16))
+        return self._html('<html><script>%s</script><!-- %s --></html>' %
+                          (tokens, _padding(self.options.login_page_size - len(tokens))))
+
+    @asyncio.coroutine
+    def ajax(self, request):
+        yield from self._delay()
+        yield from request.post()
+        body = json.dumps({'token': _hex(16), 'login_id': 'id_key', 'password': 'pwd_key'})
+        return aiohttp.web.Response(body=body.encode(), headers={'Content-Type': 'application/json'})
+
+    @asyncio.coroutine
+    def auth(self, request):
+        yield from self._delay()
+        yield from request.post()
+        return self._html('<html>%s</html>' % _padding(self.options.login_page_size // 4))
+
+    @asyncio.coroutine
+    def game(self, request):
+        yield from self._delay()
+        owner = random.randint(1, 10 ** 8)
+        osapi_url = 'http://%s/gadgets/ifr?owner=%d&st=%s' % (request.host, owner, _hex(8))
+        return self._html('<script>var gadgetInfo = {\n    URL    : "%s",\n};</script>' % osapi_url)
+
+    @asyncio.coroutine
+    def get_world(self, request):
+        yield from self._delay()
+        world_id = int(request.match_info['owner']) % self.worlds + 1
+        body = SVDATA_PREFIX + json.dumps({'api_result': 1, 'api_data': {'api_world_id': world_id}})
+        return aiohttp.web.Response(body=body.encode(), headers={'Content-Type': 'text/plain'})
+
+    @asyncio.coroutine
+    def make_request(self, request):
+        yield from self._delay()
+        data = yield from request.post()
+        svdata = SVDATA_PREFIX + json.dumps({'api_result': 1, 'api_token': _hex(20),
+                                             'api_starttime': int(time.time() * 1000)})
+        body = MAKE_REQUEST_PREFIX + json.dumps({data['url']: {'rc': 200, 'body': svdata}})
+        return aiohttp.web.Response(body=body.encode(), headers={'Content-Type': 'application/json'})
+
+    def app(self, loop):
+        """ Build the aiohttp application of the fake
+
+        :param loop: asyncio.AbstractEventLoop
+        :return: aiohttp.web.Application
+        """
+        app = aiohttp.web.Application(loop=loop)
+        app.router.add_route('GET', '/my/-/login/', self.login)
+        app.router.add_route('POST', '/my/-/login/ajax-get-token/', self.ajax)
+        app.router.add_route('POST', '/my/-/login/auth/', self.auth)
+        app.router.add_route('GET', '/netgame/social/-/gadgets/=/app_id=854854/', self.game)
+        app.router.add_route('GET', r'/kcsapi/api_world/get_id/{owner:\d+}/1/{ts:\d+}', self.get_world)
+        app.router.add_route('POST', '/gadgets/makeRequest', self.make_request)
+        return app
+
+
+class FakeWorld:
+    """This class plays a game world server: the game API, the asset files and the world banners"""
+
+    def __init__(self, options):
+        """ Init the fake with the payloads it serves
+
+        :param options: FakeOptions
+        :return: none
+        """
+        self.options = options
+        self.api_body = self._svdata(options.api_size)
+        self.start2_body = self._svdata(options.start2_size)
+        self.asset_body = os.urandom(options.asset_size)
+        self.banner_body = b'\x89PNG\r\n\x1a\n' + os.urandom(max(options.banner_size - 8, 0))
+
+    @staticmethod
+    def _svdata(size):
+        head = '{"api_result":1,"api_result_msg":"\\u6210\\u529f","api_data":"'
+        return (SVDATA_PREFIX + head + _padding(size - len(head) - 2) + '"}').encode()
+
+    @asyncio.coroutine
+    def _delay(self):
+        if self.options.world_latency:
+            yield from asyncio.sleep(self.options.world_latency)
+
+    @asyncio.coroutine
+    def api(self, request):
+        yield from self._delay()
+        yield from request.read()
+        body = self.start2_body if request.match_info['action'] == 'api_start2' else self.api_body
+        return aiohttp.web.Response(body=body, headers={'Content-Type': 'text/plain'})
+
+    @asyncio.coroutine
+    def banner(self, request):
+        yield from self._delay()
+        return aiohttp.web.Response(body=self.banner_body, headers={'Content-Type': 'image/png'})
+
+    @asyncio.coroutine
+    def asset(self, request):
+        yield from self._delay()
+        return aiohttp.web.Response(body=self.asset_body, headers={'Content-Type': 'application/octet-stream'})
+
+    @asyncio.coroutine
+    def index(self, request):
+        return aiohttp.web.Response(body=b'')
+
+    def app(self, loop):
+        """ Build the aiohttp application of the fake
+
+        :param loop: asyncio.AbstractEventLoop
+        :return: aiohttp.web.Application
+        """
+        app = aiohttp.web.Application(loop=loop)
+        app.router.add_route('POST', '/kcsapi/{action:.+}', self.api)
+        app.router.add_route('GET', '/kcs/resources/image/world/{name:.+}.png', self.banner)
+        app.router.add_route('GET', '/kcs/{path:.+}', self.asset)
+        app.router.add_route('HEAD', '/', self.index)
+        return app
+
+
+def run(dmm_sock, world_socks, options):
+    """ Serve the fakes on sockets bound by the parent process until SIGTERM
+
+    :param dmm_sock: socket.socket
+    :param world_socks: list of socket.socket, one per game world
+    :param options: FakeOptions
+    :return: none
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    dmm = FakeDMM(options, len(world_socks)).app(loop)
+    world = FakeWorld(options).app(loop)
+    servers = [loop.run_until_complete(loop.create_server(dmm.make_handler(), sock=dmm_sock))]
+    world_handler = world.make_handler()
+    for sock in world_socks:
+        servers.append(loop.run_until_complete(loop.create_server(world_handler, sock=sock)))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.run_forever()
+    for server in servers:
+        server.close()
+    loop.close()
@@ -0,0 +1,380 @@
+"""OOI3 benchmark - drive scripted client load against an OOI server talking to local fake upstreams
+
+Usage: python -m bench.run [--players 200] [--duration 10] [--json results.json] [--compare-serving]
+"""
+
+import aiohttp
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+from bench import fakes
+
+parser = argparse.ArgumentParser(description='Offline benchmark of OOI with fake dmm.com and world servers')
+parser.add_argument('--players', type=int, default=200, help='Number of simulated players')
+parser.add_argument('--worlds', type=int, default=4, help='Number of fake world servers')
+parser.add_argument('--duration', type=float, default=10, help='Seconds of steady API traffic')
+parser.add_argument('--think', type=float, default=0.5, help='Seconds a player waits between two API calls')
+parser.add_argument('--stampedes', type=int, default=3, help='Number of api_start2 stampedes, the first one is cold')
+parser.add_argument('--assets', type=int, default=20, help='Number of distinct assets fetched by every player')
+parser.add_argument('--connections', type=int, default=256, help='Client connections to the OOI server')
+parser.add_argument('--timeout', type=float, default=30, help='Client request timeout in seconds')
+parser.add_argument('--dmm-latency', type=float, default=0.05, help='Latency of fake dmm.com responses')
+parser.add_argument('--world-latency', type=float, default=0.02, help='Latency of fake world server responses')
+parser.add_argument('--login-page-size', type=int, default=60000, help='Size of the dmm.com login page')
+parser.add_argument('--api-size', type=int, default=4000, help='Size of ordinary game API responses')
+parser.add_argument('--start2-size', type=int, default=600000, help='Size of the api_start2 response')
+parser.add_argument('--asset-size', type=int, default=200000, help='Size of asset files')
+parser.add_argument('--banner-size', type=int, default=8000, help='Size of world banners')
+parser.add_argument('--rounds', type=int, default=5,
+                    help='Rounds of cached api_start2, banner and asset fetches by every player')
+parser.add_argument('--no-zero-copy', action='store_true',
+                    help='Serve cached bodies through copies and chunked file reads instead of sendfile')
+parser.add_argument('--compare-serving', action='store_true',
+                    help='Run twice, with and without the zero-copy serving path, and report both')
+parser.add_argument('--json', help='Also write the results to this file')
+
+
+class Stats:
+    """This class collects the outcome of the requests of one scenario"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    def record(self, latency, ok, size):
+        self.latencies.append(latency)
+        self.bytes += size
+        if not ok:
+            self.errors += 1
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def percentile(self, p):
+        """ Return the latency at percentile `p` in milliseconds
+
+        :param p: float
+        :return: float
+        """
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] * 1000
+
+    def result(self, server_before, server_after):
+        """ Summarise the scenario with the CPU time and memory of the server
+
+        :param server_before: dict
+        :param server_after: dict
+        :return: dict
+        """
+        elapsed = self.finished - self.started
+        cpu = server_after['cpu'] - server_before['cpu']
+        return {'scenario': self.name,
+                'requests': len(self.latencies),
+                'errors': self.errors,
+                'seconds': elapsed,
+                'throughput': len(self.latencies) / elapsed if elapsed else 0.0,
+                'bytes': self.bytes,
+                'p50_ms': self.percentile(50),
+                'p99_ms': self.percentile(99),
+                'cpu_seconds': cpu,
+                'cpu_percent': 100 * cpu / elapsed if elapsed else 0.0,
+                'rss_bytes': server_after['rss']}
+
+
+class Player:
+    """This class plays one browser with its own OOI session cookie"""
+
+    def __init__(self, base_url, connector, index, timeout):
+        self.base_url = base_url
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.login_id = 'player%d@example.com' % index
+        self.index = index
+        self.timeout = timeout
+
+    @asyncio.coroutine
+    def request(self, stats, method, path, expect=None, **kwargs):
+        """ Send a request and record its latency, redirects are not followed
+
+        :param stats: Stats
+        :param method: str
+        :param path: str
+        :param expect: tuple of statuses counted as success, any status below 400 without it
+        :return: none
+        """
+        started = time.monotonic()
+        size = 0
+        try:
+            response = yield from asyncio.wait_for(
+                self.session.request(method, self.base_url + path, allow_redirects=False, **kwargs), self.timeout)
+            body = yield from response.read()
+            size = len(body)
+            ok = response.status in expect if expect else response.status < 400
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            ok = False
+        stats.record(time.monotonic() - started, ok, size)
+
+    @asyncio.coroutine
+    def login(self, stats):
+        data = {'login_id': self.login_id, 'password': 'password', 'mode': '1'}
+        yield from self.request(stats, 'POST', '/', expect=(302,), data=data)
+
+    @asyncio.coroutine
+    def api(self, stats, action):
+        headers = {'Referer': self.base_url + '/kcs/mainD2.swf?api_token=0&api_starttime=0'}
+        data = {'api_token': '0', 'api_verno': '1'}
+        yield from self.request(stats, 'POST', '/kcsapi/' + action, headers=headers, data=data)
+
+    def close(self):
+        self.session.detach()
+
+
+@asyncio.coroutine
+def server_stats(admin_url):
+    """ Read the CPU time and resident memory of the OOI server from its metrics
+
+    :param admin_url: str
+    :return: dict
+    """
+    response = yield from aiohttp.get(admin_url + '/metrics')
+    text = yield from response.text()
+    values = {}
+    for line in text.splitlines():
+        if line.startswith('ooi_process_cpu_seconds_total '):
+            values['cpu'] = float(line.split()[1])
+        elif line.startswith('ooi_process_resident_memory_bytes '):
+            values['rss'] = float(line.split()[1])
+    return values
+
+
+@asyncio.coroutine
+def wait_ready(admin_url, timeout=30):
+    """ Wait for the OOI server to answer
+
+    :param admin_url: str
+    :param timeout: int
+    :return: none
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            yield from server_stats(admin_url)
+            return
+        except (aiohttp.ClientError, OSError):
+            if time.monotonic() > deadline:
+                raise
+            yield from asyncio.sleep(0.1)
+
+
+@asyncio.coroutine
+def scenario(admin_url, name, coros):
+    """ Run the requests of a scenario concurrently and measure them
+
+    :param admin_url: str
+    :param name: str
+    :param coros: function taking a Stats and returning coroutines
+    :return: dict
+    """
+    before = yield from server_stats(admin_url)
+    stats = Stats(name)
+    yield from asyncio.gather(*coros(stats))
+    stats.finish()
+    after = yield from server_stats(admin_url)
+    return stats.result(before, after)
+
+
+@asyncio.coroutine
+def drive(base_url, admin_url, args):
+    """ Run every scenario in turn with the same players
+
+    :param base_url: str
+    :param admin_url: str
+    :param args: argparse.Namespace
+    :return: list of dict
+    """
+    yield from wait_ready(admin_url)
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    players = [Player(base_url, connector, i, args.timeout) for i in range(args.players)]
+    results = []
+
+    # Every player logs in at once
+    results.append((yield from scenario(admin_url, 'login burst',
+                                        lambda stats: [p.login(stats) for p in players])))
+
+    # Every player asks for the master data at once, the first stampede finds a cold cache
+    for i in range(args.stampedes):
+        results.append((yield from scenario(admin_url, 'api_start2 stampede %d' % (i + 1),
+                                            lambda stats: [p.api(stats, 'api_start2') for p in players])))
+
+    # Ordinary API calls spaced by the think time of the players
+    @asyncio.coroutine
+    def steady(player, stats):
+        deadline = time.monotonic() + args.duration
+        yield from asyncio.sleep(args.think * player.index / len(players))
+        while time.monotonic() < deadline:
+            yield from player.api(stats, 'api_port/port')
+            yield from asyncio.sleep(args.think)
+
+    results.append((yield from scenario(admin_url, 'steady api',
+                                        lambda stats: [steady(p, stats) for p in players])))
+
+    # World banners and assets, every player fetches the same files
+    @asyncio.coroutine
+    def assets(player, stats):
+        for size in 'lst':
+            yield from player.request(stats, 'GET', '/kcs/resources/image/world/0_%s.png' % size)
+        for i in range(args.assets):
+            yield from player.request(stats, 'GET', '/kcs/resources/swf/ships/%d.swf?VERSION=1' % i)
+
+    results.append((yield from scenario(admin_url, 'banners and assets',
+                                        lambda stats: [assets(p, stats) for p in players])))
+
+    # Large cached bodies only, every player fetches them at once round after round
+    @asyncio.coroutine
+    def cached(player, stats):
+        for i in range(args.rounds):
+            yield from player.api(stats, 'api_start2')
+            yield from player.request(stats, 'GET', '/kcs/resources/image/world/0_l.png')
+            yield from player.request(stats, 'GET', '/kcs/resources/swf/ships/%d.swf?VERSION=1' % (i % args.assets))
+
+    results.append((yield from scenario(admin_url, 'cached bodies',
+                                        lambda stats: [cached(p, stats) for p in players])))
+
+    for player in players:
+        player.close()
+    connector.close()
+    return results
+
+
+def report(results):
+    """ Print the results as a table
+
+    :param results: list of dict
+    :return: none
+    """
+    print('%-24s %9s %7s %9s %9s %9s %7s %6s %8s' %
+          ('scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'cpu s', 'cpu %', 'rss MB'))
+    for r in results:
+        print('%-24s %9d %7d %9.1f %9.1f %9.1f %7.2f %6.1f %8.1f' %
+              (r['scenario'], r['requests'], r['errors'], r['throughput'], r['p50_ms'], r['p99_ms'],
+               r['cpu_seconds'], r['cpu_percent'], r['rss_bytes'] / 1024 / 1024))
+
+
+def serve_ooi(sock, admin_sock, dmm_host, world_hosts, kcs_dir, zero_copy=True):
+    """ Run OOI on `sock` with dmm.com and the game worlds pointed at the fakes, every run starts cold
+
+    :param sock: socket.socket
+    :param admin_sock: socket.socket
+    :param dmm_host: str
+    :param world_hosts: list of str
+    :param kcs_dir: str
+    :param zero_copy: bool
+    :return: none
+    """
+    from auth.kancolle import KancolleAuth
+    from base import config
+    KancolleAuth.urls = fakes.local_urls(KancolleAuth.urls, dmm_host)
+    KancolleAuth.world_ip_list = tuple(world_hosts)
+    config.kcs_dir = kcs_dir
+    config.kcs_origin = world_hosts[0]
+    config.secret_key = os.urandom(32)
+    config.snapshot_enabled = False
+    # The login burst starts every player at once, the global bucket would turn most of them away
+    config.admission_enabled = False
+    config.zero_copy = zero_copy
+
+    # Imported after patching so the handlers see the fake worlds, with a loop of its own after the fork
+    import ooi
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    ooi.serve(sock=sock, admin_sock=admin_sock)
+
+
+def _listen():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1024)
+    return sock
+
+
+def _host(sock):
+    return '%s:%d' % sock.getsockname()
+
+
+def run(args, options, zero_copy):
+    """ Start the fakes and an OOI server, drive the scenarios and stop everything
+
+    :param args: argparse.Namespace
+    :param options: bench.fakes.FakeOptions
+    :param zero_copy: bool
+    :return: list of dict
+    """
+
+    # Sockets are bound here and inherited by the server processes, so no port can be taken in between
+    dmm_sock = _listen()
+    world_socks = [_listen() for _ in range(args.worlds)]
+    ooi_sock = _listen()
+    admin_sock = _listen()
+    kcs_dir = tempfile.mkdtemp(prefix='ooi-bench-')
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=fakes.run, args=(dmm_sock, world_socks, options)),
+                 context.Process(target=serve_ooi,
+                                 args=(ooi_sock, admin_sock, _host(dmm_sock), [_host(s) for s in world_socks], kcs_dir,
+                                       zero_copy))]
+    for process in processes:
+        process.start()
+    base_url = 'http://' + _host(ooi_sock)
+    admin_url = 'http://' + _host(admin_sock)
+    for sock in [dmm_sock, ooi_sock, admin_sock] + world_socks:
+        sock.close()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(drive(base_url, admin_url, args))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(kcs_dir, ignore_errors=True)
+        loop.close()
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    options = fakes.FakeOptions(dmm_latency=args.dmm_latency, world_latency=args.world_latency,
+                                login_page_size=args.login_page_size, api_size=args.api_size,
+                                start2_size=args.start2_size, asset_size=args.asset_size,
+                                banner_size=args.banner_size)
+
+    if args.compare_serving:
+        modes = [('zero-copy', True), ('copying', False)]
+    else:
+        modes = [('copying' if args.no_zero_copy else 'zero-copy', not args.no_zero_copy)]
+    runs = {}
+    for name, zero_copy in modes:
+        runs[name] = run(args, options, zero_copy)
+        if len(modes) > 1:
+            print('Serving path: %s' % name)
+        report(runs[name])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'results': runs}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
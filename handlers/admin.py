@@ -0,0 +1,148 @@
+"""OOI3 Admin Handler
+Operational endpoints, served on a listener of their own to local clients or to clients holding the admin token
+"""
+
+import asyncio
+import hmac
+import aiohttp
+import aiohttp.web
+
+from base import config
+from base.budget import budget
+from base.metrics import registry
+
+# Peers allowed to read the admin endpoints
+LOCAL_PEERS = ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+
+# Headers set by reverse proxies, a request carrying one was forwarded from another host
+FORWARDED_HEADERS = ('X-Forwarded-For', 'X-Real-IP', 'Forwarded')
+
+
+def is_local(request):
+    """ Check whether a request comes from the local host
+
+    :param request: aiohttp.web.Request
+    :return: bool
+    """
+    peername = request.transport.get_extra_info('peername') if request.transport is not None else None
+    return bool(peername) and peername[0] in LOCAL_PEERS
+
+
+def is_allowed(request):
+    """ Check whether a request may read the admin endpoints
+    Forwarded requests are refused, since a reverse proxy on the local host makes every client look local.
+    With admin_token set the token is required, otherwise the client must connect from the local host
+
+    :param request: aiohttp.web.Request
+    :return: bool
+    """
+    headers = FORWARDED_HEADERS + ((config.client_ip_header,) if config.client_ip_header else ())
+    if any(header in request.headers for header in headers):
+        return False
+    if config.admin_token:
+        authorization = request.headers.get(aiohttp.hdrs.AUTHORIZATION, '')
+        return hmac.compare_digest(authorization.encode('utf-8', 'replace'),
+                                   ('Bearer ' + config.admin_token).encode())
+    return is_local(request)
+
+
+class AdminHandler:
+    """This class exposes the metrics and the event loop diagnostics of this process"""
+
+    def __init__(self, api, assets, frontend, engine, diagnostics=None):
+        """ Init the handler and register the gauges reading the state of the other handlers
+
+        :param api: handlers.api.APIHandler
+        :param assets: handlers.assets.AssetHandler
+        :param frontend: handlers.frontend.FrontEndHandler
+        :param engine: auth.engine.LoginEngine
+        :param diagnostics: base.diagnostics.Diagnostics
+        :return: none
+        """
+        self.api = api
+        self.assets = assets
+        self.frontend = frontend
+        self.engine = engine
+        self.monitor = diagnostics
+
+        registry.gauge('ooi_login_running', 'Logins running', lambda: self.engine.running)
+        registry.gauge('ooi_login_waiting', 'Logins waiting for a free slot', lambda: self.engine.waiting)
+        registry.gauge('ooi_login_tokens', 'Pre-fetched login page tokens by state',
+                       lambda: {(k,): v for k, v in self.engine.tokens.status().items()}, ('state',))
+        registry.gauge('ooi_upstream_breaker_open', 'Worlds by breaker state, 1 while calls fail fast',
+                       lambda: self._worlds(lambda world: float(world['state'] != 'closed')), ('world',))
+        registry.gauge('ooi_upstream_error_rate', 'Error rate of recent upstream calls by world',
+                       lambda: self._worlds(lambda world: world['error_rate']), ('world',))
+        registry.gauge('ooi_upstream_latency_seconds', 'Mean latency of recent upstream calls by world',
+                       lambda: self._worlds(lambda world: world['latency']), ('world',))
+        registry.gauge('ooi_upstream_running', 'Game API calls in flight by world',
+                       lambda: self._scheduled('running'), ('world',))
+        registry.gauge('ooi_upstream_waiting', 'Game API calls waiting for a slot by world',
+                       lambda: self._scheduled('waiting'), ('world',))
+        registry.counter_func('ooi_upstream_queue_timeouts_total', 'Game API calls that gave up waiting for a slot',
+                              lambda: self.api.scheduler.timeouts + self.api.scheduler.rejected)
+        if self.frontend.admission is not None:
+            admission = self.frontend.admission
+            registry.gauge('ooi_admission_load', 'Load seen by login admission control, logins are shed at 1',
+                           admission.load)
+            registry.gauge('ooi_admission_limited_clients', 'Client addresses whose login bucket is not full',
+                           lambda: admission.status()['limited_clients'])
+        registry.gauge('ooi_cache_bytes', 'Bytes held by each cache, kcs is on disk', self._cache_sizes, ('cache',))
+        registry.gauge('ooi_cache_entries', 'Entries held by each cache', self._cache_entries, ('cache',))
+        registry.counter_func('ooi_cache_hits_total', 'Lookups served by each in-memory cache',
+                              lambda: self._caches('hits'), ('cache',))
+        registry.counter_func('ooi_cache_misses_total', 'Lookups missed by each in-memory cache',
+                              lambda: self._caches('misses'), ('cache',))
+        registry.gauge('ooi_cache_hit_rate', 'Hit rate of each in-memory cache',
+                       lambda: self._caches('hit_rate'), ('cache',))
+        registry.counter_func('ooi_cache_evictions_total', 'Entries evicted by the limit of each in-memory cache',
+                              lambda: self._caches('evictions'), ('cache',))
+        registry.counter_func('ooi_cache_budget_evictions_total',
+                              'Entries evicted by the memory budget from each cache',
+                              lambda: self._caches('budget_evictions'), ('cache',))
+        registry.gauge('ooi_cache_budget_bytes', 'Memory budget of all in-memory caches', lambda: budget.max_size)
+
+    def _worlds(self, value):
+        return {(world_ip,): value(world) for world_ip, world in self.api.upstream.health.status().items()}
+
+    def _scheduled(self, field):
+        return {(world_ip,): world[field] for world_ip, world in self.api.scheduler.status()['worlds'].items()}
+
+    def _caches(self, field):
+        return {(name,): cache[field] for name, cache in budget.status()['caches'].items()}
+
+    def _cache_sizes(self):
+        sizes = self._caches('size')
+        sizes[('kcs',)] = self.assets.size
+        return sizes
+
+    def _cache_entries(self):
+        entries = self._caches('entries')
+        entries[('kcs',)] = len(self.assets.index)
+        return entries
+
+    @asyncio.coroutine
+    def metrics(self, request):
+        """ Output the metrics of this process in the Prometheus text format
+
+        :param request: aiohttp.web.Request
+        :return: aiohttp.web.Response or aiohttp.web.HTTPForbidden
+        """
+        if not is_allowed(request):
+            return aiohttp.web.HTTPForbidden()
+        headers = aiohttp.MultiDict({'Content-Type': 'text/plain; version=0.0.4'})
+        return aiohttp.web.Response(body=registry.render().encode(), headers=headers)
+
+    @asyncio.coroutine
+    def diagnostics(self, request):
+        """ Output event loop lag, recent stalls and slow request profiles of this process
+
+        :param request: aiohttp.web.Request
+        :return: aiohttp.web.Response, aiohttp.web.HTTPForbidden or aiohttp.web.HTTPNotFound
+        """
+        if not is_allowed(request):
+            return aiohttp.web.HTTPForbidden()
+        if self.monitor is None:
+            return aiohttp.web.HTTPNotFound()
+        headers = aiohttp.MultiDict({'Content-Type': 'text/plain; charset=utf-8'})
+        return aiohttp.web.Response(body=self.monitor.dump().encode(), headers=headers)
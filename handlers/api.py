@@ -4,27 +4,218 @@
 import aiohttp
 import aiohttp.web
 import asyncio
-from aiohttp_session import get_session
+import hashlib
+from collections import namedtuple
+from email.utils import formatdate
 
+from auth.kancolle import KancolleAuth
 from base import config
+from base.budget import budget
+from base.cache import LRUCache, ResponseCache, SingleFlight
+from base.capture import CaptureLog
+from base.health import UpstreamUnavailable
+from base.metrics import LabelLimiter, Stopwatch, registry
+from base.scheduler import UpstreamBusy, UpstreamScheduler
+from base.serving import accepted_encoding, compress, send_body
+from base.upstream import UpstreamPool
+
+# A cached world banner with its HTTP validators and the response headers built from them
+Banner = namedtuple('Banner', ['body', 'etag', 'last_modified', 'headers'])
+
+# Headers of game API responses, keyed by whether a content coding may apply and the coding chosen
+API_HEADERS = {(vary, encoding): dict([('Content-Type', 'text/plain')] +
+                                      ([(aiohttp.hdrs.VARY, aiohttp.hdrs.ACCEPT_ENCODING)] if vary else []) +
+                                      ([(aiohttp.hdrs.CONTENT_ENCODING, encoding)] if encoding else []))
+               for vary, encoding in ((False, None), (True, None), (True, 'gzip'), (True, 'deflate'))}
+
+
+def make_banner(body, etag, last_modified):
+    """ Build a cached banner, its response headers are built once here
+
+    :param body: bytes or memoryview
+    :param etag: str
+    :param last_modified: str
+    :return: Banner
+    """
+    headers = {'Content-Type': 'image/png',
+               'Cache-Control': 'no-cache',
+               'ETag': etag,
+               'Last-Modified': last_modified}
+    return Banner(body=body, etag=etag, last_modified=last_modified, headers=headers)
+
+# Metrics of the proxy, labels are bounded so unknown actions or worlds cannot grow them without limit
+action_label = LabelLimiter(256)
+world_label = LabelLimiter(0, allowed=KancolleAuth.world_ip_list)
+api_requests = registry.counter('ooi_api_requests_total', 'Game API requests by cache result',
+                                ('action', 'world', 'cache'))
+api_responses = registry.counter('ooi_api_upstream_responses_total', 'Upstream game API responses by status',
+                                 ('action', 'world', 'status'))
+api_timeouts = registry.counter('ooi_api_upstream_timeouts_total', 'Upstream game API timeouts',
+                                ('action', 'world'))
+api_unavailable = registry.counter('ooi_api_unavailable_total', 'Game API calls failed fast by an open breaker',
+                                   ('action', 'world'))
+api_busy = registry.counter('ooi_api_busy_total',
+                            'Game API calls turned away by the scheduler, queue full or waited too long for a slot',
+                            ('action', 'world'))
+api_bytes = registry.counter('ooi_api_response_bytes_total', 'Bytes of game API responses sent to clients',
+                             ('action', 'world'))
+api_seconds = registry.histogram('ooi_api_phase_seconds',
+                                 'Game API latency by phase: session load, queueing, upstream wait and body transfer',
+                                 ('action', 'world', 'phase'))
+banner_requests = registry.counter('ooi_banner_requests_total', 'World banner requests by result', ('result',))
+banner_seconds = registry.histogram('ooi_banner_request_seconds', 'World banner request latency')
 
 
 class APIHandler:
     """ This class handles the forward proxy for API calls in game"""
 
-    def __init__(self):
-        """ Init the proxy service
+    # Size of the chunks relayed to the client in passthrough mode
+    chunk_size = 16384
+
+    def __init__(self, sessions, shared=None):
+        """ Init the proxy service, banners and cached responses are also kept in `shared` when running several
+        workers or nodes
+
+        :param sessions: base.sessions.SessionCache
+        :param shared: base.backends.CacheBackend
+        :return: none
+        """
+        self.sessions = sessions
+
+        # Keep-alive connections to game worlds, shared by all requests
+        self.upstream = UpstreamPool()
+        self.scheduler = UpstreamScheduler(config.upstream_world_limit, config.upstream_global_limit,
+                                           config.upstream_max_wait, config.upstream_max_waiting)
+
+        # Re-init server banner and game API response cache
+        self.shared = shared
+        self.cache = ResponseCache(config.api_cache_policy, config.api_cache_size, shared=shared, budget=budget,
+                                   timeout=self._timeout)
+        self.banners = LRUCache(config.banner_cache_size, sizeof=lambda banner: len(banner.body),
+                                name='banner', cost=60, budget=budget)
+        self.banner_flights = SingleFlight()
+
+        # Capture log of game API exchanges, written by a background thread
+        self.capture = None
+        if config.capture_enabled:
+            self.capture = CaptureLog(config.capture_dir, config.capture_actions, config.capture_queue_size,
+                                      segment_size=config.capture_segment_size,
+                                      segment_age=config.capture_segment_age,
+                                      max_segments=config.capture_max_segments)
+
+    def register_snapshot(self, snapshot):
+        """ Keep the response cache and the world banners in the warm-start snapshot
+
+        :param snapshot: base.snapshot.Snapshot
+        :return: none
+        """
+        snapshot.register('api', self.cache.dump, self.cache.restore)
+        snapshot.register('banner', self._dump_banners, self._restore_banners)
+
+    def _dump_banners(self):
+        return [(name, {'etag': banner.etag, 'last_modified': banner.last_modified}, [banner.body])
+                for name, banner in self.banners.items()]
+
+    def _restore_banners(self, records):
+        for name, meta, (body,) in records:
+            self.banners.set(name, make_banner(body, meta['etag'], meta['last_modified']))
+
+    @asyncio.coroutine
+    def prewarm(self):
+        """ Open keep-alive connections to all game worlds ahead of the first players
+
+        :return: none
+        """
+        yield from self.upstream.prewarm(KancolleAuth.world_ip_list, config.upstream_prewarm)
+
+    def close(self):
+        """ Close all upstream connections and flush the capture log
 
         :return: none
         """
-        if config.proxy:
-            self.connector = aiohttp.ProxyConnector(proxy=config.proxy, force_close=False)
+        self.upstream.close()
+        if self.capture is not None:
+            self.capture.close()
+
+    @staticmethod
+    def banner_name(world_ip, size):
+        """ Name of the banner image of a world, e.g. 203_104_209_071_l, a port after the address is ignored
+
+        :param world_ip: str
+        :param size: str
+        :return: str
+        """
+        ip_sections = map(int, world_ip.split(':')[0].split('.'))
+        return '_'.join([format(x, '03') for x in ip_sections]) + '_' + size
+
+    @asyncio.coroutine
+    def _download_banner(self, image_name):
+        """ Download a banner image with its validators
+
+        :param image_name: str
+        :return: tuple (body, meta, ttl) or None
+        """
+        response = yield from self.upstream.request('GET', config.kcs_origin,
+                                                    '/kcs/resources/image/world/' + image_name + '.png',
+                                                    timeout=5)
+        body = yield from response.read()
+        if response.status != 200:
+            return None
+        meta = {'etag': '"%s"' % hashlib.md5(body).hexdigest(),
+                'last_modified': response.headers.get(aiohttp.hdrs.LAST_MODIFIED) or formatdate(usegmt=True)}
+        return body, meta, 0
+
+    @asyncio.coroutine
+    def _fetch_banner(self, image_name):
+        """ Fetch a banner into the store, through the shared backend when running several workers or nodes
+
+        :param image_name: str
+        :return: Banner or None
+        """
+        if self.shared is not None:
+            blob = yield from self.shared.get_or_fill('banner/' + image_name,
+                                                      lambda: self._download_banner(image_name))
+            if blob is None:
+                return None
+            body, meta = blob.body, blob.meta
         else:
-            self.connector = None
+            result = yield from self._download_banner(image_name)
+            if result is None:
+                return None
+            body, meta, _ = result
+        banner = make_banner(body, meta['etag'], meta['last_modified'])
+        self.banners.set(image_name, banner)
+        return banner
+
+    @asyncio.coroutine
+    def get_banner(self, image_name):
+        """ Return a banner from the store, concurrent misses for the same image share one download
+
+        :param image_name: str
+        :return: Banner or None
+        """
+        banner = self.banners.get(image_name)
+        if banner is None:
+            banner, _ = yield from self.banner_flights.do(image_name, self._fetch_banner, image_name)
+        return banner
+
+    @asyncio.coroutine
+    def prefetch_banners(self, concurrency=4):
+        """ Download every banner size of every world into the store
 
-        # Re-init server banner and api_start2 cache
-        self.api_start2 = None
-        self.worlds = {}
+        :param concurrency: int
+        :return: none
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        @asyncio.coroutine
+        def prefetch(image_name):
+            with (yield from semaphore):
+                yield from self.get_banner(image_name)
+
+        coros = [prefetch(self.banner_name(world_ip, size))
+                 for world_ip in KancolleAuth.world_ip_list for size in 'lst']
+        yield from asyncio.gather(*coros, return_exceptions=True)
 
     @asyncio.coroutine
     def world_image(self, request):
@@ -33,63 +224,248 @@ class APIHandler:
 		This function is necessary or the banner will not be displayed properly
 		
         :param request: aiohttp.web.Request
-        :return: aiohttp.web.HTTPFound or aiohttp.web.HTTPBadRequest
+        :return: aiohttp.web.Response or aiohttp.web.HTTPBadRequest
         """
+        watch = Stopwatch()
         size = request.match_info['size']
-        session = yield from get_session(request)
-        world_ip = session['world_ip']
+        session = yield from self.sessions.get(request)
+        world_ip = session.world_ip
         if world_ip:
-            ip_sections = map(int, world_ip.split('.'))
-            image_name = '_'.join([format(x, '03') for x in ip_sections]) + '_' + size
-            if image_name in self.worlds:
-                body = self.worlds[image_name]
-            else:
-                url = 'http://203.104.209.102/kcs/resources/image/world/' + image_name + '.png'
-                coro = aiohttp.get(url, connector=self.connector)
-                try:
-                    response = yield from asyncio.wait_for(coro, timeout=5)
-                except asyncio.TimeoutError:
-                    return aiohttp.web.HTTPBadRequest()
-                body = yield from response.read()
-                self.worlds[image_name] = body
-            return aiohttp.web.Response(body=body, headers={'Content-Type': 'image/png', 'Cache-Control': 'no-cache'})
+            image_name = self.banner_name(world_ip, size)
+            result = 'hit' if image_name in self.banners else 'miss'
+            try:
+                banner = yield from self.get_banner(image_name)
+            except (asyncio.TimeoutError, UpstreamUnavailable):
+                banner = None
+            banner_seconds.observe((), watch.lap())
+            if banner is None:
+                banner_requests.inc(('error',))
+                return aiohttp.web.HTTPBadRequest()
+            banner_requests.inc((result,))
+            if request.headers.get(aiohttp.hdrs.IF_NONE_MATCH) == banner.etag:
+                return aiohttp.web.HTTPNotModified(headers=banner.headers)
+            return (yield from send_body(request, banner.body, banner.headers))
         else:
             return aiohttp.web.HTTPBadRequest()
 
+    @staticmethod
+    def _timeout(action):
+        """ Timeout of an upstream API call in seconds
+
+        :param action: str
+        :return: float
+        """
+        return config.api_timeouts.get(action, config.api_timeout)
+
+    def _headers(self, request, world_ip):
+        """ Build the headers of an upstream API request as if it came from the flash client
+
+        :param request: aiohttp.web.Request
+        :param world_ip: str
+        :return: aiohttp.MultiDict
+        """
+        referrer = request.headers.get('REFERER')
+        referrer = referrer.replace(request.host, world_ip)
+        referrer = referrer.replace('https://', 'http://')
+        return aiohttp.MultiDict({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko',
+            'Origin': 'http://' + world_ip + '/',
+            'Referer': referrer,
+            'X-Requested-With': 'ShockwaveFlash/18.0.0.232'
+        })
+
+    @asyncio.coroutine
+    def _read_data(self, request, headers):
+        """ Read the body of a client request, kept raw in passthrough mode and parsed otherwise
+
+        :param request: aiohttp.web.Request
+        :param headers: aiohttp.MultiDict
+        :return: bytes or aiohttp.MultiDictProxy
+        """
+        if config.api_passthrough:
+            if aiohttp.hdrs.CONTENT_TYPE in request.headers:
+                headers[aiohttp.hdrs.CONTENT_TYPE] = request.headers[aiohttp.hdrs.CONTENT_TYPE]
+            return (yield from request.read())
+        else:
+            return (yield from request.post())
+
+    @asyncio.coroutine
+    def _fetch(self, action, world_ip, data, headers, client):
+        """ Send an API request upstream once the scheduler has a slot for it and read the whole response
+
+        :param action: str
+        :param world_ip: str
+        :param data: bytes or aiohttp.MultiDictProxy
+        :param headers: aiohttp.MultiDict
+        :param client: str
+        :return: tuple (status, body)
+        """
+        labels = (action_label(action), world_label(world_ip))
+        watch = Stopwatch()
+        yield from self.scheduler.acquire(world_ip, client)
+        try:
+            api_seconds.observe(labels + ('queue',), watch.lap())
+            response = yield from self.upstream.request('POST', world_ip, '/kcsapi/' + action,
+                                                        data=data, headers=headers, timeout=self._timeout(action))
+            api_seconds.observe(labels + ('upstream',), watch.lap())
+            api_responses.inc(labels + (str(response.status),))
+            body = yield from response.read()
+            api_seconds.observe(labels + ('transfer',), watch.lap())
+        finally:
+            self.scheduler.release(world_ip)
+        return response.status, body
+
+    @asyncio.coroutine
+    def _respond(self, request, body, labels, gzipped=None):
+        """ Send an API response, compressed with the coding the client prefers when it is large enough
+        A pre-gzipped copy is sent as is, other bodies are compressed in a worker thread
+
+        :param request: aiohttp.web.Request
+        :param body: bytes or memoryview
+        :param labels: tuple
+        :param gzipped: bytes or memoryview
+        :return: aiohttp.web.StreamResponse
+        """
+        compressible = config.api_compression and len(body) >= config.api_compression_min_size
+        vary = gzipped is not None or compressible
+        encoding = None
+        if vary:
+            encoding = accepted_encoding(request)
+            if encoding == 'gzip' and gzipped is not None:
+                body = gzipped
+            elif encoding is not None and compressible:
+                body = yield from compress(body, encoding, config.api_compression_level)
+            else:
+                encoding = None
+        api_bytes.inc(labels, len(body))
+        return (yield from send_body(request, body, API_HEADERS[vary, encoding]))
+
+    @asyncio.coroutine
+    def _passthrough(self, request, action, world_ip, data, headers, client):
+        """ Forward the raw request body unchanged and stream the upstream response back as it arrives
+        The scheduler slot is held until the whole response was relayed
+
+        :param request: aiohttp.web.Request
+        :param action: str
+        :param world_ip: str
+        :param data: bytes
+        :param headers: aiohttp.MultiDict
+        :param client: str
+        :return: aiohttp.web.StreamResponse
+        """
+        yield from self.scheduler.acquire(world_ip, client)
+        try:
+            return (yield from self._relay(request, action, world_ip, data, headers))
+        finally:
+            self.scheduler.release(world_ip)
+
+    @asyncio.coroutine
+    def _relay(self, request, action, world_ip, data, headers):
+        """ Stream one upstream API response back to the client
+
+        :param request: aiohttp.web.Request
+        :param action: str
+        :param world_ip: str
+        :param data: bytes
+        :param headers: aiohttp.MultiDict
+        :return: aiohttp.web.StreamResponse
+        """
+        labels = (action_label(action), world_label(world_ip))
+        watch = Stopwatch()
+        response = yield from self.upstream.request('POST', world_ip, '/kcsapi/' + action,
+                                                    data=data, headers=headers, timeout=self._timeout(action))
+        api_seconds.observe(labels + ('upstream',), watch.lap())
+        api_responses.inc(labels + (str(response.status),))
+
+        resp = aiohttp.web.StreamResponse(headers=aiohttp.MultiDict({'Content-Type': 'text/plain'}))
+        # The client decodes compressed bodies, so the upstream length only holds for identity encoding
+        length = response.headers.get(aiohttp.hdrs.CONTENT_LENGTH)
+        if length is not None and aiohttp.hdrs.CONTENT_ENCODING not in response.headers:
+            resp.content_length = int(length)
+        size = 0
+        # The relayed chunks are only kept when the exchange is captured
+        chunks = [] if self.capture is not None and self.capture.wants(action) else None
+        try:
+            yield from resp.prepare(request)
+            while True:
+                chunk = yield from response.content.read(self.chunk_size)
+                if not chunk:
+                    break
+                resp.write(chunk)
+                yield from resp.drain()
+                size += len(chunk)
+                if chunks is not None:
+                    chunks.append(chunk)
+            yield from resp.write_eof()
+        except Exception:
+            response.close()
+            raise
+        finally:
+            api_seconds.observe(labels + ('transfer',), watch.lap())
+            api_bytes.inc(labels, size)
+        yield from response.release()
+        if chunks is not None:
+            self.capture.record(action, world_ip, data, response.status, b''.join(chunks))
+        return resp
+
     @asyncio.coroutine
     def api(self, request):
         """ Forward API requests between game client and server
+        Actions listed in the cache policy table are served from the response cache,
+        concurrent misses for the same cache key share one upstream request
 
         :param request: aiohttp.web.Request
         :return: aiohttp.web.Response or aiohttp.web.HTTPBadRequest
         """
+        watch = Stopwatch()
         action = request.match_info['action']
-        session = yield from get_session(request)
-        world_ip = session['world_ip']
+        session = yield from self.sessions.get(request)
+        world_ip = session.world_ip
         if world_ip:
-            if action == 'api_start2' and self.api_start2 is not None:
-                return aiohttp.web.Response(body=self.api_start2,
-                                            headers=aiohttp.MultiDict({'Content-Type': 'text/plain'}))
-            else:
-                referrer = request.headers.get('REFERER')
-                referrer = referrer.replace(request.host, world_ip)
-                referrer = referrer.replace('https://', 'http://')
-                url = 'http://' + world_ip + '/kcsapi/' + action
-                headers = aiohttp.MultiDict({
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64; Trident/7.0; rv:11.0) like Gecko',
-                    'Origin': 'http://' + world_ip + '/',
-                    'Referer': referrer,
-                    'X-Requested-With': 'ShockwaveFlash/18.0.0.232'
-                })
-                data = yield from request.post()
-                coro = aiohttp.post(url, data=data, headers=headers, connector=self.connector)
-                try:
-                    response = yield from asyncio.wait_for(coro, timeout=5)
-                except asyncio.TimeoutError:
-                    return aiohttp.web.HTTPBadRequest()
-                body = yield from response.read()
-                if action == 'api_start2' and len(body) > 100000:
-                    self.api_start2 = body
-                return aiohttp.web.Response(body=body, headers=aiohttp.MultiDict({'Content-Type': 'text/plain'}))
+            labels = (action_label(action), world_label(world_ip))
+            api_seconds.observe(labels + ('session',), watch.lap())
+            policy = self.cache.policy(action)
+            if policy is not None:
+                key = self.cache.key(action, policy, world_ip, session.api_token)
+                entry = yield from self.cache.get(key)
+                if entry is not None:
+                    api_requests.inc(labels + ('hit',))
+                    if self.capture is not None and self.capture.wants(action):
+                        # Cache hits never read the request, read it for the capture only
+                        data = yield from self._read_data(request, aiohttp.MultiDict())
+                        self.capture.record(action, world_ip, data, 200, entry.body, cached=True)
+                    return (yield from self._respond(request, entry.body, labels, entry.gzip))
+            api_requests.inc(labels + ('miss' if policy is not None else 'none',))
+
+            headers = self._headers(request, world_ip)
+            data = yield from self._read_data(request, headers)
+            try:
+                if policy is not None:
+                    entry, status, body = yield from self.cache.fetch(key, policy, self._fetch,
+                                                                      action, world_ip, data, headers,
+                                                                      session.api_token)
+                    if entry is not None:
+                        if self.capture is not None:
+                            self.capture.record(action, world_ip, data, 200, entry.body)
+                        return (yield from self._respond(request, entry.body, labels, entry.gzip))
+                elif config.api_passthrough:
+                    return (yield from self._passthrough(request, action, world_ip, data, headers,
+                                                         session.api_token))
+                else:
+                    status, body = yield from self._fetch(action, world_ip, data, headers, session.api_token)
+            except asyncio.TimeoutError:
+                api_timeouts.inc(labels)
+                return aiohttp.web.HTTPBadRequest()
+            except UpstreamBusy as e:
+                # The world is healthy but this process has too many calls to it in flight
+                api_busy.inc(labels)
+                return aiohttp.web.HTTPServiceUnavailable(headers={aiohttp.hdrs.RETRY_AFTER: str(e.retry_after)})
+            except UpstreamUnavailable as e:
+                # The world is down, answer at once instead of waiting for another timeout
+                api_unavailable.inc(labels)
+                return aiohttp.web.HTTPServiceUnavailable(headers={aiohttp.hdrs.RETRY_AFTER: str(e.retry_after)})
+            if self.capture is not None:
+                self.capture.record(action, world_ip, data, status, body)
+            return (yield from self._respond(request, body, labels))
         else:
             return aiohttp.web.HTTPBadRequest()
@@ -0,0 +1,385 @@
+"""OOI3 Asset Handler - pull-through disk cache for game assets under /kcs
+"""
+
+import aiohttp
+import aiohttp.web
+import asyncio
+import mimetypes
+import os
+import re
+import tempfile
+import time
+from collections import OrderedDict
+
+from base import config
+from base.cache import SingleFlight
+from base.health import UpstreamUnavailable
+from base.metrics import Stopwatch, registry
+from base.serving import send_file
+
+asset_requests = registry.counter('ooi_asset_requests_total', 'Game asset requests by cache result', ('result',))
+asset_bytes = registry.counter('ooi_asset_response_bytes_total', 'Bytes of game assets sent to clients')
+asset_seconds = registry.histogram('ooi_asset_request_seconds', 'Game asset request latency by cache result',
+                                   ('result',))
+
+
+class IncompleteDownload(Exception):
+    """Raised when an asset download ends before its Content-Length"""
+
+
+class AssetHandler:
+    """This class serves game assets from kcs_dir, fetching missing files once from the game server"""
+
+    # Size of the chunks used to download asset files, and to serve them where sendfile is not available
+    chunk_size = 65536
+
+    # Versions are used as directory names, anything else is not honoured
+    version_pattern = re.compile(r'^[\w.-]+$')
+
+    range_pattern = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+    # Seconds between access time updates of a cached file, through which other workers learn of its use
+    touch_interval = 60
+
+    def __init__(self, upstream, sessions, directory=None, max_size=None, shared=None):
+        """ Init the asset cache and index the files already in `directory`
+        With a shared store, downloads are coordinated with the other worker processes
+
+        :param upstream: base.upstream.UpstreamPool
+        :param sessions: base.sessions.SessionCache
+        :param directory: str
+        :param max_size: int
+        :param shared: base.shared.SharedStore
+        :return: none
+        """
+        self.upstream = upstream
+        self.sessions = sessions
+        self.shared = shared
+        self.directory = os.path.abspath(directory or config.kcs_dir)
+        self.max_size = config.kcs_cache_size if max_size is None else max_size
+        self.flights = SingleFlight()
+
+        # Cached files in least recently used order, relative path => size
+        self.index = OrderedDict()
+        self.size = 0
+        # Versions with files in the cache, anonymous clients may only pull these through
+        self.versions = set()
+        # Last use of the files used by this process since the last scan, relative path => timestamp
+        self.used = {}
+        self.rescan_task = None
+        self._load(self._walk(), time.time())
+
+    def _walk(self):
+        """ List the cached files with their last use, read from the access time; run in a worker thread
+
+        :return: list of (last use, relative path, size)
+        """
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another worker meanwhile
+                    continue
+                files.append((max(st.st_atime, st.st_mtime), os.path.relpath(path, self.directory), st.st_size))
+        return files
+
+    def _load(self, files, started):
+        """ Rebuild the index from a listing of the cache, least recently used first
+        Files used by this process keep their recency, files added since the listing `started` are kept
+
+        :param files: list of (last use, relative path, size)
+        :param started: float timestamp of the listing
+        :return: none
+        """
+        listed = {relpath for _, relpath, _ in files}
+        files = [(max(used, self.used.get(relpath, 0)), relpath, size) for used, relpath, size in files]
+        files.extend((self.used[relpath], relpath, size) for relpath, size in self.index.items()
+                     if relpath not in listed and self.used.get(relpath, 0) >= started)
+        self.index.clear()
+        self.size = 0
+        for _, relpath, size in sorted(files):
+            self.index[relpath] = size
+            self.size += size
+            self._add_version(relpath)
+        self.used = {relpath: used for relpath, used in self.used.items() if relpath in self.index}
+
+    @asyncio.coroutine
+    def _rescan(self):
+        """ Pick up the files downloaded and evicted by the other workers every kcs_rescan_interval seconds
+
+        :return: none
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            yield from asyncio.sleep(config.kcs_rescan_interval)
+            started = time.time()
+            try:
+                files = yield from loop.run_in_executor(None, self._walk)
+            except OSError as e:
+                print('Asset cache %s not scanned: %s' % (self.directory, e))
+                continue
+            self._load(files, started)
+
+    def start(self):
+        """ Start rescanning the cache when other workers share it
+
+        :return: none
+        """
+        if self.shared is not None and self.rescan_task is None:
+            self.rescan_task = asyncio.ensure_future(self._rescan())
+
+    def close(self):
+        """ Stop rescanning the cache
+
+        :return: none
+        """
+        if self.rescan_task is not None:
+            self.rescan_task.cancel()
+            self.rescan_task = None
+
+    def _add_version(self, relpath):
+        """ Remember the version of a cached file
+
+        :param relpath: str
+        :return: none
+        """
+        parts = relpath.split(os.sep)
+        if len(parts) > 2 and parts[0] == '_v':
+            self.versions.add(parts[1])
+
+    def _local_path(self, path, version):
+        """ Map a requested asset to its file in the cache, versioned assets live under _v/<version>/
+
+        :param path: str
+        :param version: str
+        :return: str or None
+        """
+        relpath = os.path.join('_v', version, path) if version else path
+        local = os.path.abspath(os.path.join(self.directory, relpath))
+        if not local.startswith(self.directory + os.sep):
+            return None
+        return local
+
+    def _touch(self, local):
+        """ Mark a cached file as recently used
+        With other workers, the access time of the file is updated at most every `touch_interval` seconds,
+        the modification time is kept since it is sent as Last-Modified
+
+        :param local: str
+        :return: none
+        """
+        relpath = os.path.relpath(local, self.directory)
+        if relpath in self.index:
+            self.index.move_to_end(relpath)
+        if self.shared is None:
+            return
+        now = time.time()
+        if now - self.used.get(relpath, 0) > self.touch_interval:
+            try:
+                os.utime(local, ns=(int(now * 1e9), os.stat(local).st_mtime_ns))
+            except OSError:
+                pass
+        self.used[relpath] = now
+
+    def _add(self, local, size):
+        """ Add a downloaded file to the index and evict the least recently used files over the size limit
+
+        :param local: str
+        :param size: int
+        :return: none
+        """
+        relpath = os.path.relpath(local, self.directory)
+        self.size -= self.index.pop(relpath, 0)
+        self.index[relpath] = size
+        self.size += size
+        self._add_version(relpath)
+        if self.shared is not None:
+            self.used[relpath] = time.time()
+        while self.max_size and self.size > self.max_size and len(self.index) > 1:
+            relpath, size = self.index.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, relpath))
+            except OSError:
+                pass
+
+    @asyncio.coroutine
+    def _download(self, origin, path, version, local):
+        """ Fetch an asset from the game server and move it into place atomically
+        A body shorter or longer than its Content-Length is discarded, so truncated files are never cached
+
+        :param origin: str
+        :param path: str
+        :param version: str
+        :param local: str
+        :return: bool
+        :raise IncompleteDownload: when the body does not match its Content-Length
+        """
+        url = '/kcs/' + path
+        if version:
+            url += '?version=' + version
+        response = yield from self.upstream.request('GET', origin, url, timeout=10)
+        if response.status != 200:
+            yield from response.release()
+            return False
+
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(local))
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = yield from response.content.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    size += len(chunk)
+            length = response.headers.get(aiohttp.hdrs.CONTENT_LENGTH)
+            if (length is not None and aiohttp.hdrs.CONTENT_ENCODING not in response.headers
+                    and int(length) != size):
+                raise IncompleteDownload('%s: %d of %s bytes' % (url, size, length))
+            os.replace(tmp, local)
+        except Exception:
+            response.close()
+            os.remove(tmp)
+            raise
+        yield from response.release()
+        self._add(local, size)
+        return True
+
+    @asyncio.coroutine
+    def _fetch(self, origin, path, version, local):
+        """ Download a missing asset, with several workers only one of them downloads a given file
+
+        :param origin: str
+        :param path: str
+        :param version: str
+        :param local: str
+        :return: bool
+        """
+        if self.shared is None:
+            return (yield from self._download(origin, path, version, local))
+
+        key = 'kcs/' + os.path.relpath(local, self.directory)
+        if not (yield from self.shared.lock(key)):
+            deadline = time.time() + self.shared.lock_timeout
+            while time.time() < deadline and (yield from self.shared.locked(key)):
+                yield from asyncio.sleep(0.05)
+            if os.path.isfile(local):
+                return True
+            if not (yield from self.shared.lock(key)):
+                return (yield from self._download(origin, path, version, local))
+        try:
+            return (yield from self._download(origin, path, version, local))
+        finally:
+            yield from self.shared.unlock(key)
+
+    def _range(self, request, size):
+        """ Parse a single byte range from the Range header
+
+        :param request: aiohttp.web.Request
+        :param size: int
+        :return: tuple (start, end) or None for the whole file
+        """
+        m = self.range_pattern.match(request.headers.get(aiohttp.hdrs.RANGE, ''))
+        if not m or not (m.group(1) or m.group(2)):
+            return None
+        if m.group(1):
+            start = int(m.group(1))
+            end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+        else:
+            start = max(size - int(m.group(2)), 0)
+            end = size - 1
+        if start > end:
+            raise aiohttp.web.HTTPRequestRangeNotSatisfiable(
+                headers={aiohttp.hdrs.CONTENT_RANGE: 'bytes */%d' % size})
+        return start, end
+
+    @asyncio.coroutine
+    def _serve(self, request, path, local):
+        """ Send a cached file with sendfile, honouring If-Modified-Since and Range
+
+        :param request: aiohttp.web.Request
+        :param path: str
+        :param local: str
+        :return: aiohttp.web.StreamResponse
+        """
+        with open(local, 'rb') as f:
+            st = os.fstat(f.fileno())
+            modsince = request.if_modified_since
+            if modsince is not None and st.st_mtime <= modsince.timestamp():
+                raise aiohttp.web.HTTPNotModified()
+
+            byte_range = self._range(request, st.st_size)
+            resp = aiohttp.web.StreamResponse()
+            if byte_range is None:
+                start, count = 0, st.st_size
+            else:
+                start, count = byte_range[0], byte_range[1] - byte_range[0] + 1
+                resp.set_status(206)
+                resp.headers[aiohttp.hdrs.CONTENT_RANGE] = 'bytes %d-%d/%d' % (byte_range + (st.st_size,))
+            resp.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            resp.last_modified = st.st_mtime
+            resp.headers[aiohttp.hdrs.ACCEPT_RANGES] = 'bytes'
+            resp.content_length = count
+
+            yield from resp.prepare(request)
+            yield from send_file(request, resp, f, start, count, self.chunk_size)
+            asset_bytes.inc((), count)
+        return resp
+
+    @asyncio.coroutine
+    def kcs(self, request):
+        """ Serve a game asset, pulling it from the game server on a cache miss
+        Concurrent misses for the same file share one download. Clients without a game session only pull through
+        unversioned files and versions already cached, so made-up versions cannot flood the cache
+
+        :param request: aiohttp.web.Request
+        :return: aiohttp.web.StreamResponse or aiohttp.web.HTTPNotFound
+        """
+        watch = Stopwatch()
+        path = request.match_info['path']
+        version = request.GET.get('version') or request.GET.get('VERSION')
+        if version and not self.version_pattern.match(version):
+            version = None
+        local = self._local_path(path, version)
+        if local is None:
+            return aiohttp.web.HTTPNotFound()
+
+        if os.path.isfile(local):
+            self._touch(local)
+            result = 'hit'
+        else:
+            session = yield from self.sessions.get(request)
+            if not session.world_ip and version and version not in self.versions:
+                asset_requests.inc(('rejected',))
+                return aiohttp.web.HTTPNotFound()
+            origin = session.world_ip or config.kcs_origin
+            try:
+                found, _ = yield from self.flights.do(local, self._fetch, origin, path, version, local)
+            except asyncio.TimeoutError:
+                asset_requests.inc(('timeout',))
+                return aiohttp.web.HTTPBadRequest()
+            except IncompleteDownload:
+                asset_requests.inc(('incomplete',))
+                return aiohttp.web.HTTPBadGateway()
+            except UpstreamUnavailable as e:
+                asset_requests.inc(('unavailable',))
+                return aiohttp.web.HTTPServiceUnavailable(headers={aiohttp.hdrs.RETRY_AFTER: str(e.retry_after)})
+            if not found:
+                asset_requests.inc(('notfound',))
+                return aiohttp.web.HTTPNotFound()
+            result = 'miss'
+
+        asset_requests.inc((result,))
+        try:
+            return (yield from self._serve(request, path, local))
+        except FileNotFoundError:
+            return aiohttp.web.HTTPNotFound()
+        finally:
+            asset_seconds.observe((result,), watch.lap())
@@ -2,16 +2,42 @@
 """
 
 import asyncio
+import aiohttp
 import aiohttp.web
 import aiohttp_jinja2
+import hashlib
+from collections import namedtuple
 from aiohttp_session import get_session
 
-from auth.kancolle import KancolleAuth, OOIAuthException
+from auth.exceptions import OOIAuthException
+from base import config
+from base.admission import client_address
+from base.budget import budget
+from base.cache import LRUCache
+
+# A rendered game page with its validator and response headers
+Page = namedtuple('Page', ['body', 'etag', 'headers'])
 
 
 class FrontEndHandler:
     """This class handles browser requests"""
 
+    def __init__(self, engine, sessions, admission=None):
+        """ Init the frontend with the login engine running dmm.com logins
+
+        :param engine: auth.engine.LoginEngine
+        :param sessions: base.sessions.SessionCache
+        :param admission: base.admission.AdmissionController
+        :return: none
+        """
+        self.engine = engine
+        self.sessions = sessions
+        self.admission = admission
+
+        # Rendered game pages, their output only depends on the template and its context
+        self.pages = LRUCache(config.page_cache_size, sizeof=lambda page: len(page.body),
+                              name='page', budget=budget)
+
     def clear_session(self, session):
         if 'api_token' in session:
             del session['api_token']
@@ -20,6 +46,30 @@ class FrontEndHandler:
         if 'world_ip' in session:
             del session['world_ip']
 
+    def render_page(self, request, template, context):
+        """ Render a game page, in production mode a page is rendered once and then served from the cache
+        Pages carry an ETag so reloading browsers get a 304
+
+        :param request: aiohttp.web.Request
+        :param template: str
+        :param context: dict
+        :return: aiohttp.web.Response or aiohttp.web.HTTPNotModified
+        """
+        key = (template,) + tuple(sorted(context.items()))
+        page = self.pages.get(key)
+        if page is None:
+            body = aiohttp_jinja2.render_string(template, request, context).encode()
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            headers = {'Content-Type': 'text/html; charset=utf-8',
+                       'Cache-Control': 'private, no-cache',
+                       'ETag': etag}
+            page = Page(body=body, etag=etag, headers=headers)
+            if config.template_production:
+                self.pages.set(key, page)
+        if request.headers.get(aiohttp.hdrs.IF_NONE_MATCH) == page.etag:
+            return aiohttp.web.HTTPNotModified(headers=page.headers)
+        return aiohttp.web.Response(body=page.body, headers=page.headers)
+
     @aiohttp_jinja2.template('form.html')
     @asyncio.coroutine
     def form(self, request):
@@ -46,6 +96,7 @@ class FrontEndHandler:
         """
         post = yield from request.post()
         session = yield from get_session(request)
+        self.sessions.discard(request)
 
         login_id = post.get('login_id', None)
         password = post.get('password', None)
@@ -54,10 +105,19 @@ class FrontEndHandler:
         session['mode'] = mode
 
         if login_id and password:
-            kancolle = KancolleAuth(login_id, password)
+            if self.admission is not None and mode in (1, 2, 3, 4):
+                reason, retry_after = self.admission.admit(client_address(request, config.client_ip_header),
+                                                           'login')
+                if reason is not None:
+                    context = {'errmsg': 'Too many logins in progress, please retry in %d seconds' % retry_after,
+                               'mode': mode}
+                    response = aiohttp_jinja2.render_template('form.html', request, context)
+                    response.set_status(503)
+                    response.headers[aiohttp.hdrs.RETRY_AFTER] = str(retry_after)
+                    return response
             if mode in (1, 2, 3):
                 try:
-                    yield from kancolle.get_flash()
+                    kancolle = yield from self.engine.get_flash(login_id, password)
                     session['api_token'] = kancolle.api_token
                     session['api_starttime'] = kancolle.api_starttime
                     session['world_ip'] = kancolle.world_ip
@@ -73,8 +133,8 @@ class FrontEndHandler:
                     return aiohttp_jinja2.render_template('form.html', request, context)
             elif mode == 4:
                 try:
-                    osapi_url = yield from kancolle.get_osapi()
-                    session['osapi_url'] = osapi_url
+                    kancolle = yield from self.engine.get_osapi(login_id, password)
+                    session['osapi_url'] = kancolle.osapi_url
                     return aiohttp.web.HTTPFound('/connector')
                 except OOIAuthException as e:
                     context = {'errmsg': e.message, 'mode': mode}
@@ -103,7 +163,7 @@ class FrontEndHandler:
                        'host': request.host,
                        'token': token,
                        'starttime': starttime}
-            return aiohttp_jinja2.render_template('normal.html', request, context)
+            return self.render_page(request, 'normal.html', context)
         else:
             self.clear_session(session)
             return aiohttp.web.HTTPFound('/')
@@ -120,7 +180,7 @@ class FrontEndHandler:
         starttime = session.get('api_starttime', None)
         world_ip = session.get('world_ip', None)
         if token and starttime and world_ip:
-            return aiohttp_jinja2.render_template('kcv.html', request, context={})
+            return self.render_page(request, 'kcv.html', {})
         else:
             self.clear_session(session)
             return aiohttp.web.HTTPFound('/')
@@ -141,7 +201,7 @@ class FrontEndHandler:
                        'host': request.host,
                        'token': token,
                        'starttime': starttime}
-            return aiohttp_jinja2.render_template('flash.html', request, context)
+            return self.render_page(request, 'flash.html', context)
         else:
             self.clear_session(session)
             return aiohttp.web.HTTPFound('/')
@@ -162,7 +222,7 @@ class FrontEndHandler:
                        'host': request.host,
                        'token': token,
                        'starttime': starttime}
-            return aiohttp_jinja2.render_template('poi.html', request, context)
+            return self.render_page(request, 'poi.html', context)
         else:
             self.clear_session(session)
             return aiohttp.web.HTTPFound('/')
@@ -192,4 +252,5 @@ class FrontEndHandler:
         """
         session = yield from get_session(request)
         self.clear_session(session)
+        self.sessions.discard(request)
         return aiohttp.web.HTTPFound('/')
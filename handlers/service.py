@@ -8,12 +8,41 @@ import aiohttp.web
 import json
 
 from auth.exceptions import OOIAuthException
-from auth.kancolle import KancolleAuth
+from base import config
+from base.admission import client_address
 
 
 class ServiceHandler:
     """This class defines the login service invoked twice during auth"""
 
+    def __init__(self, engine, admission=None):
+        """ Init the service with the login engine running dmm.com logins
+
+        :param engine: auth.engine.LoginEngine
+        :param admission: base.admission.AdmissionController
+        :return: none
+        """
+        self.engine = engine
+        self.admission = admission
+
+    def _shed(self, request, endpoint):
+        """ Turn a login away when the admission controller says so
+
+        :param request: aiohttp.web.Request
+        :param endpoint: str
+        :return: aiohttp.web.Response or None when the login may start
+        """
+        if self.admission is None:
+            return None
+        reason, retry_after = self.admission.admit(client_address(request, config.client_ip_header), endpoint)
+        if reason is None:
+            return None
+        headers = aiohttp.MultiDict({'Content-Type': 'application/json',
+                                     'Retry-After': str(retry_after)})
+        result = {'status': 0,
+                  'message': 'Error: Too many logins in progress, please retry in %d seconds' % retry_after}
+        return aiohttp.web.Response(status=503, body=json.dumps(result).encode(), headers=headers)
+
     @asyncio.coroutine
     def get_osapi(self, request):
         """Fetch osapi URL and output in a JSON-format tuple
@@ -25,12 +54,14 @@ class ServiceHandler:
         login_id = data.get('login_id', None)
         password = data.get('password', None)
         if login_id and password:
+            shed = self._shed(request, 'osapi')
+            if shed is not None:
+                return shed
             headers = aiohttp.MultiDict({'Content-Type': 'application/json'})
-            kancolle = KancolleAuth(login_id, password)
             try:
-                osapi_url = yield from kancolle.get_osapi()
+                kancolle = yield from self.engine.get_osapi(login_id, password)
                 result = {'status': 1,
-                          'osapi_url': osapi_url}
+                          'osapi_url': kancolle.osapi_url}
             except OOIAuthException as e:
                 result = {'status': 0,
                           'message': e.message}
@@ -50,12 +81,14 @@ class ServiceHandler:
         login_id = data.get('login_id', None)
         password = data.get('password', None)
         if login_id and password:
+            shed = self._shed(request, 'flash')
+            if shed is not None:
+                return shed
             headers = aiohttp.MultiDict({'Content-Type': 'application/json'})
-            kancolle = KancolleAuth(login_id, password)
             try:
-                flash_url = yield from kancolle.get_flash()
+                kancolle = yield from self.engine.get_flash(login_id, password)
                 result = {'status': 1,
-                          'flash_url': flash_url}
+                          'flash_url': kancolle.flash}
             except OOIAuthException as e:
                 result = {'status': 0,
                           'message': e.message}
@@ -2,6 +2,12 @@
 
 import argparse
 import asyncio
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
 
 import jinja2
 import aiohttp.web
@@ -9,8 +15,18 @@ import aiohttp_jinja2
 from aiohttp_session import session_middleware
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 
-from base import config
+from auth.engine import LoginEngine
+from base import config, metrics
+from base.admission import AdmissionController
+from base.backends import open_backend
+from base.diagnostics import Diagnostics
+from base.sessions import SessionCache
+from base.snapshot import Snapshot
+from base.shared import SharedStore
+from base.static import StaticPipeline
+from handlers.admin import AdminHandler
 from handlers.api import APIHandler
+from handlers.assets import AssetHandler
 from handlers.frontend import FrontEndHandler
 from handlers.service import ServiceHandler
 
@@ -19,35 +35,87 @@ parser.add_argument('-H', '--host', default='127.0.0.1',
                     help='The host of OOI server')
 parser.add_argument('-p', '--port', type=int, default=9999,
                     help='The port of OOI server')
+parser.add_argument('-w', '--workers', type=int, default=1,
+                    help='The number of OOI worker processes')
 
 
-def main():
-    """OOI运行主函数。
+def make_app(loop, shared=None):
+    """创建OOI应用，请求处理器保存在应用中，应用清理时关闭它们的连接池。
 
-    :return: none
+    :param loop: asyncio.AbstractEventLoop
+    :param shared: base.shared.SharedStore 多进程模式下各进程共享的缓存
+    :return: aiohttp.web.Application
     """
 
-    # 解析命令行参数
-    args = parser.parse_args()
-    host = args.host
-    port = args.port
+    # 初始化会话存储，游戏API等代理路由通过缓存读取会话，避免每次请求都解密cookie
+    storage = EncryptedCookieStorage(config.secret_key)
+    sessions = SessionCache(storage, config.session_cache_ttl, config.session_cache_size)
 
-    # 初始化事件循环
-    loop = asyncio.get_event_loop()
+    # 游戏API响应和服务器横幅的共享缓存层，多节点部署时通过缓存服务器共享；游戏资源保存在本机磁盘，只在本机进程间协调下载
+    backend = open_backend(config.cache_backend, shared, loop)
 
     # 初始化请求处理器
-    api = APIHandler()
-    frontend = FrontEndHandler()
-    service = ServiceHandler()
+    api = APIHandler(sessions, shared=backend)
+    assets = AssetHandler(api.upstream, sessions, shared=shared)
+    login_engine = LoginEngine()
+    diagnostics = None
+    if config.diag_enabled:
+        diagnostics = Diagnostics(loop, config.diag_interval, config.diag_stall_threshold,
+                                  config.diag_profile_threshold, config.diag_profile_interval)
+
+    # 登录入口的准入控制，事件循环延迟或进行中的登录过多时拒绝新登录，优先保证游戏API请求
+    admission = None
+    if config.admission_enabled:
+        admission = AdmissionController(config.admission_rate, config.admission_burst,
+                                        config.admission_client_rate, config.admission_client_burst,
+                                        config.admission_max_clients, config.admission_max_lag,
+                                        config.admission_max_inflight,
+                                        lag=lambda: diagnostics.last_lag if diagnostics is not None else 0.0,
+                                        inflight=lambda: login_engine.running + login_engine.waiting,
+                                        retry_after=config.admission_retry_after,
+                                        per_client=config.admission_per_client)
+    frontend = FrontEndHandler(login_engine, sessions, admission)
+    service = ServiceHandler(login_engine, admission)
+    admin = AdminHandler(api, assets, frontend, login_engine, diagnostics)
 
-    # 定义会话中间件
-    middlewares = [session_middleware(EncryptedCookieStorage(config.secret_key)), ]
+    # 从快照恢复游戏API响应缓存和服务器横幅，重启后的第一批请求不必等待上游
+    snapshot = None
+    if config.snapshot_enabled:
+        snapshot = Snapshot(config.snapshot_path, config.snapshot_interval, config.snapshot_max_age, loop=loop)
+        api.register_snapshot(snapshot)
+        snapshot.load()
+
+    # 定义统计中间件、诊断中间件和会话中间件，诊断中间件记录每个任务正在运行的处理器
+    middlewares = [metrics.middleware, session_middleware(storage), ]
+    if diagnostics is not None:
+        middlewares.insert(1, diagnostics.middleware)
 
     # 初始化应用
     app = aiohttp.web.Application(middlewares=middlewares, loop=loop)
+    app['api'] = api
+    app['assets'] = assets
+    app['login_engine'] = login_engine
+    app['diagnostics'] = diagnostics
+    app['snapshot'] = snapshot
+
+    # 管理接口在单独的监听地址上提供，不会经由反向代理暴露
+    admin_app = aiohttp.web.Application(loop=loop)
+    admin_app.router.add_route('GET', '/metrics', admin.metrics)
+    admin_app.router.add_route('GET', '/diagnostics', admin.diagnostics)
+    app['admin'] = admin_app
 
-    # 定义Jinja2模板位置
-    aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(config.template_dir))
+    # 构建带指纹和gzip压缩版本的静态文件，模板通过static_url和static_tags引用
+    pipeline = StaticPipeline()
+    pipeline.build()
+
+    # 定义Jinja2模板位置，生产模式下启动时编译全部模板，之后不再检查模板文件
+    aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(config.template_dir),
+                         auto_reload=not config.template_production)
+    env = aiohttp_jinja2.get_env(app)
+    env.globals.update(static_url=pipeline.url, static_tags=pipeline.tags)
+    if config.template_production:
+        for name in env.list_templates():
+            env.get_template(name)
 
     # 给应用添加路由
     app.router.add_route('GET', '/', frontend.form)
@@ -63,14 +131,94 @@ def main():
     app.router.add_route('GET', '/kcs/resources/image/world/{server:.+}_{size:[lst]}.png', api.world_image)
     app.router.add_route('POST', '/service/osapi', service.get_osapi)
     app.router.add_route('POST', '/service/flash', service.get_flash)
+    app.router.add_route('GET', pipeline.prefix + '{path:.+}', pipeline.serve)
     app.router.add_static('/static', config.static_dir)
-    app.router.add_static('/kcs', config.kcs_dir)
-    app.router.add_static('/_kcs', config.kcs_dir)
+    app.router.add_route('GET', '/kcs/{path:.+}', assets.kcs)
+    app.router.add_route('GET', '/_kcs/{path:.+}', assets.kcs)
+
+    # 应用清理时保存快照并关闭连接池
+    if snapshot is not None:
+        app.on_cleanup.append(lambda app: snapshot.close())
+    app.on_cleanup.append(lambda app: api.close())
+    app.on_cleanup.append(lambda app: assets.close())
+    if backend is not None:
+        app.on_cleanup.append(lambda app: backend.close())
+    app.on_cleanup.append(lambda app: login_engine.close())
+    if diagnostics is not None:
+        app.on_cleanup.append(lambda app: diagnostics.stop())
+    return app
+
+
+def start(app):
+    """启动应用的后台任务。
+
+    :param app: aiohttp.web.Application
+    :return: none
+    """
+
+    # 在后台预热到各游戏服务器的连接和服务器横幅缓存
+    if config.upstream_prewarm:
+        asyncio.ensure_future(app['api'].prewarm(), loop=app.loop)
+    if config.banner_prefetch:
+        asyncio.ensure_future(app['api'].prefetch_banners(), loop=app.loop)
+
+    # 在后台准备登录页令牌
+    app['login_engine'].start()
+
+    # 多进程模式下定期在后台重新扫描游戏资源缓存，获取其他进程下载和淘汰的文件
+    app['assets'].start()
+
+    # 定期保存缓存快照
+    if app['snapshot'] is not None:
+        app['snapshot'].start()
+
+    # 启动事件循环监视线程，收到SIGUSR1时把诊断报告输出到标准错误
+    diagnostics = app['diagnostics']
+    if diagnostics is not None:
+        diagnostics.start()
+        app.loop.add_signal_handler(signal.SIGUSR1, lambda: print(diagnostics.dump(), file=sys.stderr, flush=True))
+
+
+def serve(host=None, port=None, sock=None, shared=None, worker=None, admin_sock=None):
+    """运行一个OOI服务进程。
+
+    :param host: str
+    :param port: int
+    :param sock: socket.socket 多进程模式下由主进程创建的监听套接字
+    :param shared: base.shared.SharedStore 多进程模式下各进程共享的缓存
+    :param worker: int 多进程模式下工作进程的序号
+    :param admin_sock: socket.socket 管理接口的监听套接字，默认监听admin_host和admin_port
+    :return: none
+    """
+
+    # 多进程模式下每个工作进程的指标带有进程序号，管理接口监听admin_port加上进程序号
+    if worker is not None:
+        metrics.registry.set_worker(worker)
+
+    # 初始化事件循环和应用
+    loop = asyncio.get_event_loop()
+    app = make_app(loop, shared)
     app_handlers = app.make_handler()
+    admin_handlers = app['admin'].make_handler()
 
     # 启动OOI服务器
-    server = loop.run_until_complete(loop.create_server(app_handlers, host, port))
-    print('OOI serving on http://%s:%d' % server.sockets[0].getsockname())
+    if sock is None:
+        server = loop.run_until_complete(loop.create_server(app_handlers, host, port))
+        print('OOI serving on http://%s:%d' % server.sockets[0].getsockname())
+    else:
+        server = loop.run_until_complete(loop.create_server(app_handlers, sock=sock))
+        # 收到SIGTERM时优雅退出
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        print('OOI worker %d started' % os.getpid())
+    admin_server = None
+    if admin_sock is not None:
+        admin_server = loop.run_until_complete(loop.create_server(admin_handlers, sock=admin_sock))
+    elif config.admin_port:
+        admin_server = loop.run_until_complete(loop.create_server(admin_handlers, config.admin_host,
+                                                                  config.admin_port + (worker or 0)))
+        print('OOI admin endpoints on http://%s:%d' % admin_server.sockets[0].getsockname()[:2])
+    start(app)
+
     try:
         loop.run_forever()
     except KeyboardInterrupt:
@@ -79,8 +227,91 @@ def main():
         loop.run_until_complete(app_handlers.finish_connections(1.0))
         server.close()
         loop.run_until_complete(server.wait_closed())
+        if admin_server is not None:
+            loop.run_until_complete(admin_handlers.finish_connections(1.0))
+            admin_server.close()
+            loop.run_until_complete(admin_server.wait_closed())
         loop.run_until_complete(app.cleanup())
     loop.close()
 
+
+def supervise(sock, workers):
+    """启动多个共享监听套接字的工作进程，并重启意外退出的进程。
+
+    :param sock: socket.socket
+    :param workers: int
+    :return: none
+    """
+    children = {}
+    stopping = False
+
+    def spawn(worker):
+        pid = os.fork()
+        if pid == 0:
+            # 工作进程恢复默认的信号处理
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                serve(sock=sock, shared=SharedStore(config.shared_dir), worker=worker)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = (time.time(), worker)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for worker in range(workers):
+        spawn(worker)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        child = children.pop(pid, None)
+        if child is None or stopping:
+            continue
+        started, worker = child
+        print('OOI worker %d exited with status %d, restarting' % (pid, status))
+        # 避免崩溃的进程被频繁重启，新进程沿用原来的序号和管理接口端口
+        if time.time() - started < 1:
+            time.sleep(1)
+        spawn(worker)
+
+
+def main():
+    """OOI运行主函数。
+
+    :return: none
+    """
+
+    # 解析命令行参数
+    args = parser.parse_args()
+    host = args.host
+    port = args.port
+
+    if args.workers > 1:
+        # 多进程模式：主进程创建监听套接字，各工作进程继承后共同接受连接
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(1024)
+        print('OOI serving on http://%s:%d with %d workers' % (sock.getsockname() + (args.workers,)))
+        supervise(sock, args.workers)
+    else:
+        serve(host, port)
+
 if __name__ == '__main__':
     main()
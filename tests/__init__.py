@@ -0,0 +1,61 @@
+import asyncio
+import socket
+import unittest
+
+import aiohttp.web
+
+
+class ServerTestCase(unittest.TestCase):
+    """Base of tests serving a handler with aiohttp and reading its responses as raw HTTP/1.0"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.app = aiohttp.web.Application(loop=self.loop, middlewares=self.middlewares())
+        self.handler = self.app.make_handler()
+        self.server = self.wait(self.loop.create_server(self.handler, '127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.wait(self.handler.finish_connections(1))
+        self.server.close()
+        self.wait(self.server.wait_closed())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def middlewares(self):
+        return ()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def route(self, handler, path='/'):
+        self.app.router.add_route('GET', path, handler)
+
+    @asyncio.coroutine
+    def _get(self, path, headers, delay, rcvbuf):
+        reader, writer = yield from asyncio.open_connection('127.0.0.1', self.port, loop=self.loop)
+        if rcvbuf:
+            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        lines = ['GET %s HTTP/1.0' % path, 'Host: 127.0.0.1'] + ['%s: %s' % item for item in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        if delay:
+            # A slow client, the server fills the socket buffers before anything is read
+            yield from asyncio.sleep(delay, loop=self.loop)
+        data = yield from reader.read()
+        writer.close()
+        head, _, body = data.partition(b'\r\n\r\n')
+        status_line, *header_lines = head.decode('latin-1').split('\r\n')
+        response_headers = dict(line.split(': ', 1) for line in header_lines)
+        return int(status_line.split()[1]), response_headers, body
+
+    def get(self, path='/', headers=None, delay=0, rcvbuf=0):
+        """ Request `path` and read the response until the server closes the connection
+
+        :param path: str
+        :param headers: dict
+        :param delay: float seconds before the client starts reading
+        :param rcvbuf: int receive buffer of the client socket, 0 keeps the default
+        :return: tuple (status, headers, body)
+        """
+        return self.wait(self._get(path, headers or {}, delay, rcvbuf))
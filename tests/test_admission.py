@@ -0,0 +1,63 @@
+import types
+import unittest
+from unittest import mock
+
+from base import config
+from base.admission import AdmissionController, client_address
+from handlers.service import ServiceHandler
+
+
+def request(peer, headers=None):
+    transport = mock.Mock()
+    transport.get_extra_info.return_value = (peer, 40000)
+    return types.SimpleNamespace(headers=headers or {}, transport=transport)
+
+
+class ClientAddressTest(unittest.TestCase):
+
+    def test_peer(self):
+        self.assertEqual(client_address(request('198.51.100.1')), '198.51.100.1')
+
+    def test_header(self):
+        headers = {'X-Forwarded-For': '203.0.113.9, 198.51.100.7'}
+        self.assertEqual(client_address(request('127.0.0.1', headers), 'X-Forwarded-For'), '198.51.100.7')
+        self.assertEqual(client_address(request('127.0.0.1'), 'X-Forwarded-For'), '127.0.0.1')
+
+
+class AdmissionTest(unittest.TestCase):
+    """Logins through ServiceHandler with the controller built from the configuration as ooi.py does"""
+
+    def service(self):
+        admission = AdmissionController(10, 10, 0.2, 2, 100, 0, 0, per_client=config.admission_per_client)
+        return ServiceHandler(None, admission)
+
+    def shed(self, service, requests):
+        return [service._shed(r, 'osapi') is not None for r in requests]
+
+    def test_proxied_without_header(self):
+        # Every player comes from the local reverse proxy, only the global bucket applies
+        with mock.patch.object(config, 'client_ip_header', ''):
+            service = self.service()
+            self.assertFalse(service.admission.per_client)
+            self.assertEqual(self.shed(service, [request('127.0.0.1')] * 11), [False] * 10 + [True])
+        self.assertEqual(len(service.admission.clients), 0)
+
+    def test_proxied_with_header(self):
+        with mock.patch.object(config, 'client_ip_header', 'X-Forwarded-For'), \
+                mock.patch.object(config, 'admission_per_client', True):
+            service = self.service()
+            player = request('127.0.0.1', {'X-Forwarded-For': '198.51.100.7'})
+            others = [request('127.0.0.1', {'X-Forwarded-For': '198.51.100.%d' % i}) for i in range(10, 18)]
+            self.assertEqual(self.shed(service, [player] * 3), [False, False, True])
+            self.assertEqual(self.shed(service, others), [False] * 8)
+
+    def test_direct(self):
+        with mock.patch.object(config, 'client_ip_header', ''), \
+                mock.patch.object(config, 'admission_per_client', True):
+            service = self.service()
+            self.assertEqual(self.shed(service, [request('198.51.100.7')] * 3), [False, False, True])
+            self.assertEqual(self.shed(service, [request('198.51.100.8')]), [False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import types
+from email.utils import formatdate
+
+from handlers.assets import AssetHandler
+from tests import ServerTestCase
+
+CONTENT = bytes(range(256)) * 64
+
+
+class Sessions:
+    """Every request comes from a client without a game session"""
+
+    @asyncio.coroutine
+    def get(self, request):
+        return types.SimpleNamespace(world_ip='', api_token='')
+
+
+class AssetServeTest(ServerTestCase):
+    """Assets already in the cache, served without touching the game server"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        for relpath in ('scenes/port.swf', os.path.join('_v', '4.0.0', 'scenes', 'port.swf')):
+            path = os.path.join(self.directory, relpath)
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(CONTENT)
+        self.mtime = int(time.time()) - 3600
+        os.utime(os.path.join(self.directory, 'scenes', 'port.swf'), (self.mtime, self.mtime))
+        self.assets = AssetHandler(None, Sessions(), self.directory, 0)
+        self.route(self.assets.kcs, '/kcs/{path:.+}')
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_full(self):
+        status, headers, body = self.get('/kcs/scenes/port.swf')
+        self.assertEqual((status, body), (200, CONTENT))
+        self.assertEqual(headers['CONTENT-LENGTH'], str(len(CONTENT)))
+        self.assertEqual(headers['ACCEPT-RANGES'], 'bytes')
+        self.assertEqual(headers['LAST-MODIFIED'], formatdate(self.mtime, usegmt=True))
+
+    def test_versioned(self):
+        status, headers, body = self.get('/kcs/scenes/port.swf?version=4.0.0')
+        self.assertEqual((status, body), (200, CONTENT))
+        self.assertIn('4.0.0', self.assets.versions)
+
+    def test_range(self):
+        status, headers, body = self.get('/kcs/scenes/port.swf', {'Range': 'bytes=100-355'})
+        self.assertEqual((status, body), (206, CONTENT[100:356]))
+        self.assertEqual(headers['CONTENT-RANGE'], 'bytes 100-355/%d' % len(CONTENT))
+
+    def test_suffix_range(self):
+        status, headers, body = self.get('/kcs/scenes/port.swf', {'Range': 'bytes=-10'})
+        self.assertEqual((status, body), (206, CONTENT[-10:]))
+
+    def test_range_not_satisfiable(self):
+        status, headers, body = self.get('/kcs/scenes/port.swf', {'Range': 'bytes=%d-' % len(CONTENT)})
+        self.assertEqual(status, 416)
+        self.assertEqual(headers['CONTENT-RANGE'], 'bytes */%d' % len(CONTENT))
+
+    def test_not_modified(self):
+        status, headers, body = self.get('/kcs/scenes/port.swf',
+                                         {'If-Modified-Since': formatdate(time.time(), usegmt=True)})
+        self.assertEqual((status, body), (304, b''))
+        status, headers, body = self.get('/kcs/scenes/port.swf',
+                                         {'If-Modified-Since': formatdate(self.mtime - 60, usegmt=True)})
+        self.assertEqual((status, body), (200, CONTENT))
+
+    def test_unknown_version(self):
+        # Anonymous clients cannot pull made-up versions through the cache
+        status, headers, body = self.get('/kcs/scenes/port.swf?version=9.9.9')
+        self.assertEqual(status, 404)
+        self.assertNotIn('9.9.9', self.assets.versions)
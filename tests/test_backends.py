@@ -0,0 +1,147 @@
+import asyncio
+import time
+import unittest
+
+from base.backends import RemoteBackend
+from base.cache import ResponseCache
+from base.cacheserver import CacheServer
+
+SUCCESS = b'svdata={"api_result":1,"api_result_msg":"ok","api_data":{"api_mst_ship":[]}}'
+
+
+class RemoteBackendTest(unittest.TestCase):
+    """RemoteBackend of two nodes against the stand-in cache server"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = CacheServer()
+        self.port = self.wait(self.server.start('127.0.0.1', 0, self.loop)).sockets[0].getsockname()[1]
+        self.nodes = [RemoteBackend('127.0.0.1', self.port, retry=0.5, loop=self.loop) for _ in range(2)]
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.close()
+        self.wait(self.server.close())
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.loop.close()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_get_set(self):
+        a, b = self.nodes
+        self.assertIsNone(self.wait(a.get('api_start2')))
+        self.wait(a.set('api_start2', b'body', {'status': 200}, 60))
+        blob = self.wait(b.get('api_start2'))
+        self.assertEqual((blob.body, blob.meta), (b'body', {'status': 200}))
+        self.assertAlmostEqual(blob.expires, time.time() + 60, delta=1)
+
+    def test_quoted_key(self):
+        a, b = self.nodes
+        self.wait(a.set('api_get_member/ship2 203.104.209.7', b'body'))
+        blob = self.wait(b.get('api_get_member/ship2 203.104.209.7'))
+        self.assertEqual((blob.body, blob.expires), (b'body', 0))
+
+    def test_expiry(self):
+        a, b = self.nodes
+        self.wait(a.set('api_start2', b'body', None, 1))
+        self.assertIsNotNone(self.wait(b.get('api_start2')))
+        self.wait(asyncio.sleep(1.1, loop=self.loop))
+        self.assertIsNone(self.wait(b.get('api_start2')))
+        self.assertNotIn('api_start2', self.server.entries)
+
+    def test_lock_ownership(self):
+        a, b = self.nodes
+        self.assertTrue(self.wait(a.lock('api_start2')))
+        self.assertFalse(self.wait(b.lock('api_start2')))
+        self.assertTrue(self.wait(b.locked('api_start2')))
+        # Only the holder of the token releases the lock
+        self.wait(b.unlock('api_start2'))
+        self.server.unlock('api_start2', 'not-the-token')
+        self.assertTrue(self.wait(b.locked('api_start2')))
+        self.wait(a.unlock('api_start2'))
+        self.assertFalse(self.wait(b.locked('api_start2')))
+        self.assertTrue(self.wait(b.lock('api_start2')))
+
+    def test_stale_lock(self):
+        a, b = self.nodes
+        a.lock_timeout = 1
+        self.assertTrue(self.wait(a.lock('api_start2')))
+        self.wait(asyncio.sleep(1.1, loop=self.loop))
+        self.assertFalse(self.wait(b.locked('api_start2')))
+        self.assertTrue(self.wait(b.lock('api_start2')))
+
+    def test_wait_for_other_node(self):
+        a, b = self.nodes
+        fills = []
+
+        @asyncio.coroutine
+        def fill():
+            fills.append(1)
+            return b'body', {}, 60
+
+        @asyncio.coroutine
+        def other_node():
+            yield from asyncio.sleep(0.2, loop=self.loop)
+            yield from a.set('api_start2', b'filled by a', {}, 60)
+            yield from a.unlock('api_start2')
+
+        self.assertTrue(self.wait(a.lock('api_start2')))
+        task = self.loop.create_task(other_node())
+        blob = self.wait(b.get_or_fill('api_start2', fill, timeout=5))
+        self.wait(task)
+        self.assertEqual(blob.body, b'filled by a')
+        self.assertEqual(fills, [])
+
+    def test_server_down(self):
+        a, b = self.nodes
+        self.wait(a.set('api_start2', b'body', {}, 60))
+        self.wait(self.server.close())
+
+        # Every lookup misses and every lock is granted, so each node fetches on its own
+        self.assertIsNone(self.wait(a.get('api_start2')))
+        self.assertGreater(a.down_until, time.time())
+        self.assertTrue(self.wait(a.lock('api_start2')))
+        self.assertTrue(self.wait(b.lock('api_start2')))
+        self.assertFalse(self.wait(a.locked('api_start2')))
+        blob = self.wait(a.set('api_other', b'local', {}, 60))
+        self.assertEqual(blob.body, b'local')
+
+        # The server is left alone until the retry window is over, even once it is back
+        self.wait(self.server.start('127.0.0.1', self.port, self.loop))
+        self.assertIsNone(self.wait(a.get('api_start2')))
+        self.assertNotIn('api_other', self.server.entries)
+        self.wait(asyncio.sleep(a.retry, loop=self.loop))
+        self.wait(a.set('api_start2', b'body', {}, 60))
+        self.assertEqual(self.wait(a.get('api_start2')).body, b'body')
+
+    def test_response_cache_falls_back(self):
+        policies = {'api_start2': {'ttl': 60, 'key': ['world']}}
+        caches = [ResponseCache(policies, 1024 * 1024, shared=node, loop=self.loop) for node in self.nodes]
+        policy = caches[0].policy('api_start2')
+        key = caches[0].key('api_start2', policy, '203.104.209.7', 'token')
+        fetches = []
+
+        @asyncio.coroutine
+        def fetch():
+            fetches.append(1)
+            yield from asyncio.sleep(0.05, loop=self.loop)
+            return 200, SUCCESS
+
+        # One fetch upstream for both nodes while the server is up
+        self.wait(asyncio.gather(*[cache.fetch(key, policy, fetch) for cache in caches], loop=self.loop))
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(self.wait(caches[1].get(key)).body, SUCCESS)
+
+        # Each node fetches and keeps its own copy while the server is down
+        self.wait(self.server.close())
+        other = caches[0].key('api_start2', policy, '203.104.209.8', 'token')
+        for cache in caches:
+            entry, status, body = self.wait(cache.fetch(other, policy, fetch))
+            self.assertEqual(body, SUCCESS)
+            self.assertEqual(self.wait(cache.get(other)).body, SUCCESS)
+        self.assertEqual(len(fetches), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
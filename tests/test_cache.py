@@ -0,0 +1,55 @@
+import asyncio
+import unittest
+
+from base.cache import ResponseCache, api_result
+
+SUCCESS = b'svdata={"api_result":1,"api_result_msg":"ok","api_data":{"api_mst_ship":[]}}'
+EXPIRED = b'svdata={"api_result":201,"api_result_msg":"token expired"}'
+
+
+class APIResultTest(unittest.TestCase):
+
+    def test_head(self):
+        self.assertEqual(api_result(SUCCESS), 1)
+        self.assertEqual(api_result(EXPIRED), 201)
+
+    def test_other_member_order(self):
+        self.assertEqual(api_result(b'svdata={"api_data":{},"api_result":100}'), 100)
+
+    def test_not_svdata(self):
+        self.assertIsNone(api_result(b'<html>maintenance</html>'))
+        self.assertIsNone(api_result(b'svdata={broken'))
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.cache = ResponseCache({'api_get_member/require_info': {'ttl': 60, 'key': ['world']}}, 1024 * 1024,
+                                   loop=self.loop)
+        self.policy = self.cache.policy('api_get_member/require_info')
+        self.key = self.cache.key('api_get_member/require_info', self.policy, '203.104.209.7', 'token')
+
+    def tearDown(self):
+        self.loop.close()
+
+    def fetch(self, body):
+        @asyncio.coroutine
+        def fetch():
+            return 200, body
+        return self.loop.run_until_complete(self.cache.fetch(self.key, self.policy, fetch))
+
+    def test_success_is_cached(self):
+        entry, status, body = self.fetch(SUCCESS)
+        self.assertIsNotNone(entry)
+        self.assertEqual(self.loop.run_until_complete(self.cache.get(self.key)).body, SUCCESS)
+
+    def test_error_is_not_cached(self):
+        entry, status, body = self.fetch(EXPIRED)
+        self.assertIsNone(entry)
+        self.assertEqual((status, body), (200, EXPIRED))
+        self.assertIsNone(self.loop.run_until_complete(self.cache.get(self.key)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import aiohttp
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from base.capture import CaptureLog, capture_dropped
+
+TOKEN = '0123456789abcdef0123456789abcdef01234567'
+
+
+class CaptureLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def records(self):
+        lines = []
+        for name in sorted(os.listdir(self.directory)):
+            with gzip.open(os.path.join(self.directory, name)) as f:
+                lines.extend(json.loads(line.decode()) for line in f)
+        return lines
+
+    def test_record(self):
+        log = CaptureLog(self.directory, flush_interval=0.05)
+        log.record('api_port/port', '203.104.209.7', aiohttp.MultiDict([('api_token', TOKEN), ('api_verno', '1')]), 200,
+                   memoryview(b'svdata={"api_result":1,"api_data":{}}'), cached=True)
+        log.close()
+        record, = self.records()
+        self.assertEqual((record['action'], record['world'], record['status'], record['cached']),
+                         ('api_port/port', '203.104.209.7', 200, True))
+        self.assertEqual(record['request'], {'api_verno': '1'})
+        self.assertEqual(record['response'], 'svdata={"api_result":1,"api_data":{}}')
+
+    def test_token_scrubbed(self):
+        log = CaptureLog(self.directory, flush_interval=0.05)
+        body = ('svdata={"api_result":1,"api_data":{"api_token":"%s","api_url":"/kcs/?token=%s",'
+                '"api_other":{"api_token" : "fedcba9876543210"}}}' % (TOKEN, TOKEN)).encode()
+        log.record('api_auth_member/logincheck', '203.104.209.7',
+                   ('api_token=%s&api_verno=1&api_referer=%%2Fkcs%%3Ftoken%%3D%s' % (TOKEN, TOKEN)).encode(),
+                   200, body)
+        log.close()
+        record, = self.records()
+        self.assertNotIn(TOKEN, json.dumps(record))
+        self.assertNotIn('fedcba9876543210', record['response'])
+        self.assertEqual(record['request'], {'api_verno': '1', 'api_referer': '/kcs?token=<redacted>'})
+        self.assertEqual(json.loads(record['response'][len('svdata='):])['api_data']['api_token'], '<redacted>')
+
+    def test_dropped(self):
+        release = threading.Event()
+        dropped = capture_dropped.values.get((), 0)
+        with mock.patch.object(CaptureLog, '_write', lambda log, batch: release.wait()):
+            log = CaptureLog(self.directory, queue_size=1, batch_size=1, flush_interval=0.05)
+            queued = [log.record('api_port/port', '203.104.209.7', b'', 200, b'') for _ in range(5)]
+            release.set()
+            log.close()
+        # The writer holds one exchange and the queue another, the rest are dropped
+        self.assertEqual(queued.count(False), capture_dropped.values[()] - dropped)
+        self.assertGreaterEqual(queued.count(False), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
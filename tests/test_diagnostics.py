@@ -0,0 +1,44 @@
+import aiohttp.web
+import asyncio
+import time
+
+from base.diagnostics import Diagnostics
+from tests import ServerTestCase
+
+
+class DiagnosticsTest(ServerTestCase):
+
+    def middlewares(self):
+        self.diagnostics = Diagnostics(self.loop, interval=0.05, threshold=0.1, profile_threshold=0.05,
+                                       profile_interval=0.001)
+        return [self.diagnostics.middleware]
+
+    def setUp(self):
+        super().setUp()
+        self.diagnostics.start()
+
+        @asyncio.coroutine
+        def slow(request):
+            # Keep the loop busy, as a handler doing too much work between two yields would
+            deadline = time.monotonic() + 0.2
+            while time.monotonic() < deadline:
+                sum(range(1000))
+            return aiohttp.web.Response(body=b'done')
+        self.route(slow, '/slow')
+
+    def tearDown(self):
+        self.diagnostics.stop()
+        super().tearDown()
+
+    def test_profile_and_stall(self):
+        for _ in range(5):
+            status, headers, body = self.get('/slow')
+            self.assertEqual((status, body), (200, b'done'))
+        self.wait(asyncio.sleep(0.1, loop=self.loop))
+        self.assertEqual(len(self.diagnostics.profiles), 5)
+        profile = self.diagnostics.profiles[-1]
+        self.assertEqual((profile['method'], profile['path']), ('GET', '/slow'))
+        self.assertTrue(any('test_diagnostics.py:slow' in stack for stack, count in profile['samples']))
+        self.assertTrue(self.diagnostics.stalls)
+        self.assertIn('slow', self.diagnostics.stalls[-1]['handler'])
+        self.assertIn('/slow', self.diagnostics.dump())
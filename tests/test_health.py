@@ -0,0 +1,49 @@
+import unittest
+
+from base.health import CLOSED, HALF_OPEN, OPEN, HealthTracker, UpstreamUnavailable
+
+WORLD = '203.104.209.7'
+
+
+class HealthTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = HealthTracker(min_calls=2, error_rate=0.5, cooldown=0)
+
+    def state(self):
+        return self.tracker.status()[WORLD]['state']
+
+    def trip(self):
+        for _ in range(2):
+            self.assertIsNone(self.tracker.check(WORLD))
+            self.tracker.record(WORLD, False, 0.1)
+        self.assertEqual(self.state(), OPEN)
+
+    def test_probe_closes(self):
+        self.trip()
+        probe = self.tracker.check(WORLD)
+        self.assertIsNotNone(probe)
+        self.assertEqual(self.state(), HALF_OPEN)
+        with self.assertRaises(UpstreamUnavailable):
+            self.tracker.check(WORLD)
+        self.tracker.record(WORLD, True, 0.1, probe)
+        self.assertEqual(self.state(), CLOSED)
+
+    def test_call_started_before_opening_does_not_decide(self):
+        stale = self.tracker.check(WORLD)
+        self.trip()
+        probe = self.tracker.check(WORLD)
+        self.tracker.record(WORLD, True, 0.1, stale)
+        self.assertEqual(self.state(), HALF_OPEN)
+        self.tracker.record(WORLD, False, 0.1, probe)
+        self.assertEqual(self.state(), OPEN)
+
+    def test_abandoned_probe_is_replaced(self):
+        self.trip()
+        probe = self.tracker.check(WORLD)
+        self.tracker.abandon(WORLD, probe)
+        self.assertNotEqual(self.tracker.check(WORLD), probe)
+
+
+if __name__ == '__main__':
+    unittest.main()
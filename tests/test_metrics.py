@@ -0,0 +1,60 @@
+import unittest
+from unittest import mock
+
+from base.budget import budget
+from base.cache import LRUCache
+from base.metrics import Registry, registry
+from handlers.admin import AdminHandler
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_render(self):
+        metrics = Registry()
+        requests = metrics.counter('requests_total', 'Requests', ('route',))
+        metrics.counter_func('hits_total', 'Hits', lambda: {('a',): 3}, ('cache',))
+        metrics.gauge('bytes', 'Bytes', lambda: 10)
+        requests.inc(('/kcsapi/{action}',))
+        metrics.set_worker(2)
+        self.assertEqual(metrics.render().splitlines(), [
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{worker="2",route="/kcsapi/{action}"} 1.0',
+            '# HELP hits_total Hits',
+            '# TYPE hits_total counter',
+            'hits_total{worker="2",cache="a"} 3.0',
+            '# HELP bytes Bytes',
+            '# TYPE bytes gauge',
+            'bytes{worker="2"} 10.0'])
+
+
+class AdminMetricsTest(unittest.TestCase):
+
+    def test_cache_totals_are_counters(self):
+        cache = LRUCache(1024, name='test_admin_metrics', budget=budget)
+        cache.set('a', b'x')
+        cache.get('a')
+        cache.get('b')
+        api = mock.Mock()
+        api.upstream.health.status.return_value = {}
+        api.scheduler.status.return_value = {'worlds': {}}
+        api.scheduler.timeouts = api.scheduler.rejected = 0
+        assets = mock.Mock(size=0, index={})
+        frontend = mock.Mock(admission=None)
+        engine = mock.Mock(running=0, waiting=0)
+        engine.tokens.status.return_value = {}
+        AdminHandler(api, assets, frontend, engine)
+
+        lines = registry.render().splitlines()
+        for name in ('ooi_cache_hits_total', 'ooi_cache_misses_total', 'ooi_cache_evictions_total',
+                     'ooi_cache_budget_evictions_total', 'ooi_upstream_queue_timeouts_total',
+                     'ooi_process_cpu_seconds_total'):
+            self.assertIn('# TYPE %s counter' % name, lines)
+        for name in ('ooi_cache_bytes', 'ooi_cache_entries', 'ooi_cache_hit_rate', 'ooi_cache_budget_bytes'):
+            self.assertIn('# TYPE %s gauge' % name, lines)
+        self.assertIn('ooi_cache_hits_total{cache="test_admin_metrics"} 1.0', lines)
+        self.assertIn('ooi_cache_misses_total{cache="test_admin_metrics"} 1.0', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
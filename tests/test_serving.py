@@ -0,0 +1,131 @@
+import aiohttp.web
+import asyncio
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from base import config
+from base.serving import FileTruncated, send_body, send_file
+from base.shared import SharedStore
+from handlers.api import APIHandler
+from tests import ServerTestCase
+
+# A game API response large enough for the default api_start2 policy
+START2 = (b'svdata={"api_result":1,"api_result_msg":"ok","api_data":{"api_mst_ship":"' +
+          b'x' * 120000 + b'"}}')
+
+
+class SendBodyTest(ServerTestCase):
+
+    def test_bytes(self):
+        @asyncio.coroutine
+        def handler(request):
+            return (yield from send_body(request, b'body', {'Content-Type': 'text/plain'}))
+        self.route(handler)
+        status, headers, body = self.get()
+        self.assertEqual((status, headers['CONTENT-LENGTH'], body), (200, '4', b'body'))
+
+    def test_memoryview(self):
+        @asyncio.coroutine
+        def handler(request):
+            return (yield from send_body(request, memoryview(b'xxbodyxx')[2:6], {'Content-Type': 'text/plain'}))
+        self.route(handler)
+        status, headers, body = self.get()
+        self.assertEqual((status, headers['CONTENT-LENGTH'], body), (200, '4', b'body'))
+
+
+class SharedResponseTest(ServerTestCase):
+    """Responses cached by one worker in the shared store and served by another"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.workers = [APIHandler(None, SharedStore(self.directory, loop=self.loop)) for _ in range(2)]
+        cache = self.workers[0].cache
+        policy = cache.policy('api_start2')
+        self.key = cache.key('api_start2', policy, '203.104.209.7', 'token')
+
+        @asyncio.coroutine
+        def fetch():
+            return 200, START2
+        self.wait(cache.fetch(self.key, policy, fetch))
+
+        @asyncio.coroutine
+        def handler(request):
+            entry = yield from self.workers[1].cache.get(self.key)
+            self.assertIsInstance(entry.body, memoryview)
+            return (yield from self.workers[1]._respond(request, entry.body, ('api_start2', 'other'), entry.gzip))
+        self.route(handler)
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.close()
+        super().tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_identity(self):
+        status, headers, body = self.get()
+        self.assertEqual((status, body), (200, START2))
+        self.assertNotIn('CONTENT-ENCODING', headers)
+
+    def test_gzip(self):
+        status, headers, body = self.get(headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual((status, headers['CONTENT-ENCODING']), (200, 'gzip'))
+        self.assertEqual(gzip.decompress(body), START2)
+
+
+class SendFileTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.file = tempfile.NamedTemporaryFile()
+        # Larger than the socket buffers, so sendfile cannot send it in one call to a slow client
+        self.content = os.urandom(1024 * 1024) * 24
+        self.file.write(self.content)
+        self.file.flush()
+        self.count = len(self.content)
+        self.route(self.handler_for(self.file.name))
+
+    def tearDown(self):
+        super().tearDown()
+        self.file.close()
+
+    def handler_for(self, path):
+        @asyncio.coroutine
+        def handler(request):
+            resp = aiohttp.web.StreamResponse()
+            resp.content_length = self.count
+            yield from resp.prepare(request)
+            with open(path, 'rb') as f:
+                try:
+                    yield from send_file(request, resp, f, 0, self.count)
+                except FileTruncated:
+                    return resp
+            yield from resp.write_eof()
+            return resp
+        return handler
+
+    def test_fast_client(self):
+        status, headers, body = self.get()
+        self.assertEqual((status, len(body)), (200, self.count))
+        self.assertTrue(body == self.content)
+
+    def test_slow_client(self):
+        status, headers, body = self.get(delay=0.5, rcvbuf=65536)
+        self.assertEqual((status, len(body)), (200, self.count))
+        self.assertTrue(body == self.content)
+
+    def test_copying(self):
+        with mock.patch.object(config, 'zero_copy', False):
+            status, headers, body = self.get(delay=0.2)
+        self.assertEqual(len(body), self.count)
+        self.assertTrue(body == self.content)
+
+    def test_truncated(self):
+        # The file shrank after its length was announced, the connection is closed short of it
+        self.count += 1000
+        status, headers, body = self.get()
+        self.assertEqual((status, headers['CONTENT-LENGTH']), (200, str(self.count)))
+        self.assertTrue(body == self.content)
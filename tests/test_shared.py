@@ -0,0 +1,93 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from base.shared import SharedStore
+
+
+class SharedStoreTest(unittest.TestCase):
+    """Two stores over one directory, as two worker processes would open it"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.directory = tempfile.mkdtemp()
+        self.workers = [SharedStore(self.directory, loop=self.loop) for _ in range(2)]
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.directory)
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_get_set(self):
+        a, b = self.workers
+        self.assertIsNone(self.wait(b.get('api_start2')))
+        self.wait(a.set('api_start2', b'body', {'status': 200}, 60))
+        blob = self.wait(b.get('api_start2'))
+        self.assertIsInstance(blob.body, memoryview)
+        self.assertEqual((bytes(blob.body), blob.meta), (b'body', {'status': 200}))
+        self.assertAlmostEqual(blob.expires, time.time() + 60, delta=1)
+        # Mapped once per version of the file
+        self.assertIs(self.wait(b.get('api_start2')), blob)
+
+    def test_replaced(self):
+        a, b = self.workers
+        self.wait(a.set('api_start2', b'old'))
+        old = self.wait(b.get('api_start2'))
+        self.wait(a.set('api_start2', b'new body'))
+        self.assertEqual(bytes(self.wait(b.get('api_start2')).body), b'new body')
+        # Readers of the old version keep their mapping
+        self.assertEqual(bytes(old.body), b'old')
+
+    def test_expiry(self):
+        a, b = self.workers
+        self.wait(a.set('api_start2', b'body', None, 1))
+        self.assertIsNotNone(self.wait(b.get('api_start2')))
+        time.sleep(1.1)
+        self.assertIsNone(self.wait(b.get('api_start2')))
+
+    def test_corrupt(self):
+        a, b = self.workers
+        self.wait(a.set('api_start2', b'body'))
+        with open(a._path('api_start2'), 'r+b') as f:
+            f.truncate(a.header.size + 1)
+        self.assertIsNone(self.wait(b.get('api_start2')))
+
+    def test_lock(self):
+        a, b = self.workers
+        self.assertTrue(self.wait(a.lock('api_start2')))
+        self.assertFalse(self.wait(b.lock('api_start2')))
+        self.assertTrue(self.wait(b.locked('api_start2')))
+        self.wait(a.unlock('api_start2'))
+        self.assertFalse(self.wait(b.locked('api_start2')))
+        self.assertTrue(self.wait(b.lock('api_start2')))
+
+    def test_stale_lock(self):
+        a, b = self.workers
+        self.assertTrue(self.wait(a.lock('api_start2')))
+        stale = time.time() - a.lock_timeout - 1
+        os.utime(a._path('api_start2') + '.lock', (stale, stale))
+        self.assertTrue(self.wait(b.lock('api_start2')))
+
+    def test_get_or_fill(self):
+        fills = []
+
+        @asyncio.coroutine
+        def fill():
+            fills.append(1)
+            yield from asyncio.sleep(0.1, loop=self.loop)
+            return b'filled', {}, 60
+
+        blobs = self.wait(asyncio.gather(*[worker.get_or_fill('api_start2', fill) for worker in self.workers],
+                                         loop=self.loop))
+        self.assertEqual([bytes(blob.body) for blob in blobs], [b'filled', b'filled'])
+        self.assertEqual(fills, [1])
+        self.assertFalse(self.wait(self.workers[0].locked('api_start2')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import types
+
+from base.snapshot import Snapshot
+from handlers.api import APIHandler, make_banner
+from tests import ServerTestCase
+from tests.test_serving import START2
+
+WORLD_IP = '203.104.209.7'
+
+
+class Sessions:
+    """Every request belongs to a player of the same world"""
+
+    @asyncio.coroutine
+    def get(self, request):
+        return types.SimpleNamespace(world_ip=WORLD_IP, api_token='token')
+
+
+class SnapshotTest(ServerTestCase):
+    """Caches saved by one process and served by the next from the mapped snapshot"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'caches.snapshot')
+
+        before = APIHandler(Sessions())
+        cache = before.cache
+        policy = cache.policy('api_start2')
+
+        @asyncio.coroutine
+        def fetch():
+            return 200, START2
+        self.wait(cache.fetch(cache.key('api_start2', policy, WORLD_IP, 'token'), policy, fetch))
+        before.banners.set(before.banner_name(WORLD_IP, 'l'), make_banner(b'banner', '"etag"', 'yesterday'))
+        snapshot = Snapshot(self.path, loop=self.loop)
+        before.register_snapshot(snapshot)
+        snapshot.save()
+        before.close()
+
+        self.api = APIHandler(Sessions())
+        snapshot = Snapshot(self.path, loop=self.loop)
+        self.api.register_snapshot(snapshot)
+        self.assertEqual(snapshot.load(), 2)
+        self.route(self.api.api, '/kcsapi/{action:.+}')
+        self.route(self.api.world_image, '/world/{size}')
+
+    def tearDown(self):
+        self.api.close()
+        super().tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_response(self):
+        entry = self.wait(self.api.cache.get(('api_start2', None, None)))
+        self.assertIsInstance(entry.body, memoryview)
+        status, headers, body = self.get('/kcsapi/api_start2')
+        self.assertEqual((status, body), (200, START2))
+
+    def test_banner(self):
+        self.assertIsInstance(self.api.banners.get(self.api.banner_name(WORLD_IP, 'l')).body, memoryview)
+        status, headers, body = self.get('/world/l')
+        self.assertEqual((status, headers['ETAG'], body), (200, '"etag"', b'banner'))
+        status, headers, body = self.get('/world/l', headers={'If-None-Match': '"etag"'})
+        self.assertEqual((status, body), (304, b''))
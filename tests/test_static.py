@@ -0,0 +1,113 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from base.static import StaticPipeline
+from tests import ServerTestCase
+
+CSS = b'body { background: url("../img/bg.png") no-repeat; }\n.logo { background: url(data:image/png;base64,AA); }\n'
+JS = b'var ooi = {};\n' * 200
+
+
+def make_tree(root):
+    files = {'css/main.css': CSS,
+             'js/a.js': JS,
+             'js/b.js': b'ooi.b = 1;\n',
+             'img/bg.png': b'\x89PNG not really'}
+    for relpath, data in files.items():
+        path = os.path.join(root, 'static', *relpath.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    os.makedirs(os.path.join(root, 'templates'))
+    with open(os.path.join(root, 'templates', 'base.html'), 'w') as f:
+        f.write("{{ static_tags('js', 'js/a.js', 'js/b.js') }}\n")
+
+
+class StaticPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        make_tree(self.root)
+        self.pipeline = StaticPipeline(os.path.join(self.root, 'static'), os.path.join(self.root, '_static'),
+                                       enabled=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_fingerprint(self):
+        url = self.pipeline.url('img/bg.png')
+        self.assertRegex(url, r'^/static/build/img/bg\.[0-9a-f]{12}\.png$')
+        self.assertEqual(self.pipeline.url('img/bg.png'), url)
+        self.assertEqual(self.pipeline.url('img/missing.png'), '/static/img/missing.png')
+
+    def test_css_references(self):
+        name = self.pipeline.url('css/main.css')[len(self.pipeline.prefix):]
+        with open(self.pipeline.files[name][0], 'rb') as f:
+            css = f.read()
+        self.assertIn(('url(%s)' % self.pipeline.url('img/bg.png')).encode(), css)
+        self.assertIn(b'url(data:image/png;base64,AA)', css)
+
+    def test_build(self):
+        manifest = self.pipeline.build(os.path.join(self.root, 'templates'))
+        self.assertIn('js:js/a.js+js/b.js', manifest)
+        with open(os.path.join(self.root, '_static', 'manifest.json')) as f:
+            self.assertEqual(json.load(f), manifest)
+        path, content_type, gzip_path = self.pipeline.files[manifest['js:js/a.js+js/b.js']]
+        self.assertRegex(content_type, r'javascript; charset=utf-8$')
+        with gzip.open(gzip_path) as f:
+            self.assertEqual(f.read(), JS + b'\n;\n' + b'ooi.b = 1;\n')
+        # Images are not worth a gzip variant
+        self.assertIsNone(self.pipeline.files[manifest['img/bg.png']][2])
+
+    def test_disabled(self):
+        pipeline = StaticPipeline(os.path.join(self.root, 'static'), os.path.join(self.root, '_static'),
+                                  enabled=False)
+        self.assertEqual(pipeline.url('img/bg.png'), '/static/img/bg.png')
+        self.assertEqual(pipeline.tags('js', 'js/a.js', 'js/b.js'),
+                         '<script src="/static/js/a.js"></script>\n<script src="/static/js/b.js"></script>')
+        self.assertFalse(os.path.exists(os.path.join(self.root, '_static')))
+
+
+class StaticServeTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp()
+        make_tree(self.root)
+        self.pipeline = StaticPipeline(os.path.join(self.root, 'static'), os.path.join(self.root, '_static'),
+                                       enabled=True)
+        self.pipeline.build(os.path.join(self.root, 'templates'))
+        self.route(self.pipeline.serve, '/static/build/{path:.+}')
+        self.js = self.pipeline.manifest['js/a.js']
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.root)
+
+    def test_identity(self):
+        status, headers, body = self.get(self.pipeline.prefix + self.js)
+        self.assertEqual((status, body), (200, JS))
+        self.assertEqual(headers['CACHE-CONTROL'], 'public, max-age=31536000, immutable')
+        self.assertEqual(headers['VARY'].lower(), 'accept-encoding')
+        self.assertNotIn('CONTENT-ENCODING', headers)
+
+    def test_gzip(self):
+        status, headers, body = self.get(self.pipeline.prefix + self.js, {'Accept-Encoding': 'deflate, gzip'})
+        self.assertEqual((status, headers['CONTENT-ENCODING']), (200, 'gzip'))
+        self.assertEqual(gzip.decompress(body), JS)
+
+    def test_gzip_refused(self):
+        status, headers, body = self.get(self.pipeline.prefix + self.js, {'Accept-Encoding': 'gzip;q=0'})
+        self.assertEqual((status, body), (200, JS))
+
+    def test_unknown(self):
+        status, headers, body = self.get(self.pipeline.prefix + 'js/a.000000000000.js')
+        self.assertEqual(status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()